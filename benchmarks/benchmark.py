@@ -0,0 +1,357 @@
+#! /usr/bin/env python
+"""
+Benchmarks detection stages on CPU without the real YOLO weights.
+
+Generates a small YOLO_v2 shaped Darknet config (or uses the one passed with
+--cfg) with random weights, converts it with yad2k and measures latency and
+throughput of get_image, the network forward pass, decoding, NMS, draw_boxes
+and the web app's own get_candidates and run_script, imported in a child
+process per size. Results are written as JSON and can be compared against a
+previous run.
+
+Run from the repository root:
+
+    python -m benchmarks.benchmark --sizes 416 608 --batch_sizes 1 4 --output bench.json
+    python -m benchmarks.benchmark --baseline bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(
+    description='Benchmark detection stages with random weights.')
+parser.add_argument('--cfg', help='Darknet cfg to benchmark instead of the generated small one.')
+parser.add_argument('--sizes', type=int, nargs='+', default=[608], help='Model input sizes.')
+parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='Batch sizes of forward pass.')
+parser.add_argument('--image_size', type=int, nargs=2, default=[1280, 720], help='Source image width and height.')
+parser.add_argument('--fold_batchnorm', action='store_true', help='Convert with batch norm folded into conv.')
+parser.add_argument('--num_classes', type=int, default=80, help='Number of classes of generated model.')
+parser.add_argument('--repeat', type=int, default=20, help='Measured iterations per stage.')
+parser.add_argument('--warmup', type=int, default=3, help='Unmeasured iterations per stage.')
+parser.add_argument('--output', help='Write results to this JSON file.')
+parser.add_argument('--baseline', help='Compare results with this JSON file.')
+parser.add_argument('--tolerance', type=float, default=.1, help='Allowed relative p50 slowdown against baseline.')
+parser.add_argument('--web_app_dir', help=argparse.SUPPRESS)
+
+# Startup threads of web_app, joined before its request path is measured.
+WEB_APP_THREADS = ('tensor-store-build', 'thumbnails-build', 'result-store-warm-up')
+
+ANCHORS = '0.57273, 0.677385, 1.87446, 2.06253, 3.33843, 5.47434, 7.88282, 3.52778, 9.77052, 9.16828'
+
+# (section, options) of a YOLO_v2 shaped network with fewer filters.
+SMALL_NETWORK = [
+    ('convolutional', dict(batch_normalize=1, filters=16, size=3, stride=1, pad=1, activation='leaky')),
+    ('maxpool', dict(size=2, stride=2)),
+    ('convolutional', dict(batch_normalize=1, filters=32, size=3, stride=1, pad=1, activation='leaky')),
+    ('maxpool', dict(size=2, stride=2)),
+    ('convolutional', dict(batch_normalize=1, filters=64, size=3, stride=1, pad=1, activation='leaky')),
+    ('maxpool', dict(size=2, stride=2)),
+    ('convolutional', dict(batch_normalize=1, filters=128, size=3, stride=1, pad=1, activation='leaky')),
+    ('maxpool', dict(size=2, stride=2)),
+    ('convolutional', dict(batch_normalize=1, filters=256, size=3, stride=1, pad=1, activation='leaky')),
+    ('maxpool', dict(size=2, stride=2)),
+    ('convolutional', dict(batch_normalize=1, filters=512, size=3, stride=1, pad=1, activation='leaky')),
+    ('convolutional', dict(batch_normalize=1, filters=512, size=3, stride=1, pad=1, activation='leaky')),
+    ('route', dict(layers=-4)),
+    ('convolutional', dict(batch_normalize=1, filters=32, size=1, stride=1, pad=1, activation='leaky')),
+    ('reorg', dict(stride=2)),
+    ('route', dict(layers='-1,-4')),
+    ('convolutional', dict(batch_normalize=1, filters=512, size=3, stride=1, pad=1, activation='leaky')),
+]
+
+
+def write_small_cfg(cfg_path, size, num_classes, num_anchors=5):
+    """Write small YOLO_v2 shaped Darknet config.
+
+    :param cfg_path: output cfg path.
+    :param size: model input height and width.
+    :param num_classes: number of classes.
+    :param num_anchors: number of anchors.
+    """
+    sections = [('net', dict(batch=1, subdivisions=1, width=size, height=size, channels=3, decay=0.0005))]
+    sections += SMALL_NETWORK
+    sections.append(('convolutional', dict(size=1, stride=1, pad=1, filters=num_anchors * (num_classes + 5),
+                                           activation='linear')))
+    sections.append(('region', dict(anchors=ANCHORS, classes=num_classes, num=num_anchors)))
+    with open(cfg_path, 'w') as f:
+        for section, options in sections:
+            f.write('[{}]\n'.format(section))
+            for key, value in options.items():
+                f.write('{}={}\n'.format(key, value))
+            f.write('\n')
+
+
+def write_random_weights(cfg_path, weights_path, seed=0):
+    """Write Darknet weights file with random weights matching config.
+
+    Batch norm layers get unit scale and variance, kernels He initialization,
+    so activations stay in a sensible range.
+
+    :param cfg_path: Darknet cfg path.
+    :param weights_path: output weights path.
+    :param seed: random seed.
+    """
+    import configparser
+    from yad2k import conv_weight_shapes, unique_config_sections
+
+    cfg_parser = configparser.ConfigParser()
+    cfg_parser.read_file(unique_config_sections(cfg_path))
+    random = np.random.RandomState(seed)
+    with open(weights_path, 'wb') as f:
+        np.array([0, 2, 0, 0], dtype='int32').tofile(f)
+        for _, filters, in_channels, size, batch_normalize in conv_weight_shapes(cfg_parser):
+            fan_in = in_channels * size * size
+            random.normal(0., .1, filters).astype('float32').tofile(f)
+            if batch_normalize:
+                np.ones(filters, dtype='float32').tofile(f)
+                np.zeros(filters, dtype='float32').tofile(f)
+                np.ones(filters, dtype='float32').tofile(f)
+            random.normal(0., np.sqrt(2. / fan_in), (filters, in_channels, size, size)).astype('float32').tofile(f)
+
+
+def convert(cfg_path, weights_path, output_path, fold_batchnorm=False):
+    """Convert Darknet model to Keras with yad2k, silencing its output."""
+    import yad2k
+
+    argv = [cfg_path, weights_path, output_path] + (['--fold_batchnorm'] if fold_batchnorm else [])
+    args = yad2k.parser.parse_args(argv)
+    with contextlib.redirect_stdout(io.StringIO()):
+        yad2k._main(args)
+
+
+def measure(function, repeat, warmup, items=1):
+    """Measure latency of function.
+
+    :param function: function without arguments.
+    :param repeat: measured iterations.
+    :param warmup: unmeasured iterations.
+    :param items: number of images processed by one call.
+    :return: latency statistics in milliseconds and throughput.
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e3
+    return {'mean_ms': float(times.mean()),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'images_per_s': float(items * 1e3 / times.mean())}
+
+
+def synthetic_image(path, size, seed=0):
+    """Write JPEG with smooth gradients and noise, closer to photos than pure noise."""
+    width, height = size
+    random = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255. / width, y * 255. / height, (x + y) * 127. / (width + height)], axis=-1)
+    image += random.normal(0., 20., image.shape)
+    Image.fromarray(np.clip(image, 0, 255).astype('uint8')).save(path, quality=90)
+
+
+def benchmark_size(args, size, work_dir, image_name, results):
+    """Run all stages for one model input size."""
+    from keras import backend as K
+    from keras.models import load_model
+
+    from src import numpy_yolo
+    from src.detector import YoloDetector
+    from src.numpy_yolo import yolo_eval_candidates
+    from src.yolo_utils import get_anchors, get_colors_for_classes, get_image, draw_boxes, encode_image
+
+    K.clear_session()
+    cfg_path = os.path.join(work_dir, 'bench_{}.cfg'.format(size))
+    if args.cfg:
+        with open(args.cfg) as fin, open(cfg_path, 'w') as fout:
+            for line in fin:
+                key = line.split('=')[0].strip()
+                fout.write('{}={}\n'.format(key, size) if key in ('width', 'height') else line)
+    else:
+        write_small_cfg(cfg_path, size, args.num_classes)
+    weights_path = os.path.join(work_dir, 'bench_{}.weights'.format(size))
+    model_path = os.path.join(work_dir, 'bench_{}.h5'.format(size))
+    write_random_weights(cfg_path, weights_path)
+    convert(cfg_path, weights_path, model_path, args.fold_batchnorm)
+
+    start = time.perf_counter()
+    yolo_model = load_model(model_path)
+    results['load_model@{}'.format(size)] = {'seconds': time.perf_counter() - start}
+
+    anchors = get_anchors(os.path.join(work_dir, 'bench_{}_anchors.txt'.format(size)))
+    num_classes = yolo_model.output_shape[-1] // len(anchors) - 5
+    class_names = ['class_{}'.format(i) for i in range(num_classes)]
+    colors = get_colors_for_classes(class_names)
+    detector = YoloDetector(yolo_model, anchors, class_names)
+    model_image_size = detector.model_image_size
+
+    def stage(name, function, items=1, batch_size=None):
+        key = '{}@{}'.format(name, size) + ('/b{}'.format(batch_size) if batch_size else '')
+        results[key] = measure(function, args.repeat, args.warmup, items=items)
+        print('{:<28} p50 {:8.2f} ms  {:8.1f} images/s'.format(key, results[key]['p50_ms'],
+                                                               results[key]['images_per_s']))
+
+    stage('get_image', lambda: get_image(image_name, work_dir, model_image_size))
+    image_data, image = get_image(image_name, work_dir, model_image_size)
+    for batch_size in args.batch_sizes:
+        image_batch = np.repeat(image_data, batch_size, axis=0)
+        stage('forward', lambda: detector.candidates_batch(image_batch), items=batch_size, batch_size=batch_size)
+    feats = detector.sess.run(detector.feats, feed_dict=detector._feed_dict(image_data))
+    stage('decode_numpy', lambda: numpy_yolo.yolo_head(feats, anchors, num_classes))
+
+    # Candidates the slider floor keeps, as the web app passes them to NMS.
+    boxes, box_scores = detector.candidates(image_data, score_floor=.2)
+    results['candidates@{}'.format(size)] = {'count': len(boxes)}
+    image_shape = [image.size[1], image.size[0]]
+    stage('nms', lambda: yolo_eval_candidates(boxes, box_scores, image_shape, score_threshold=.2))
+    out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, image_shape, score_threshold=.2)
+    stage('draw_boxes', lambda: draw_boxes(image.copy(), out_classes, out_boxes, out_scores, class_names, colors))
+    stage('encode', lambda: encode_image(image))
+
+    app_dir = os.path.join(work_dir, 'app_{}'.format(size))
+    write_web_app_dir(app_dir, model_path, os.path.join(work_dir, 'bench_{}_anchors.txt'.format(size)),
+                      class_names, os.path.join(work_dir, image_name))
+    command = [sys.executable, '-m', 'benchmarks.benchmark', '--web_app_dir', app_dir,
+               '--repeat', str(args.repeat), '--warmup', str(args.warmup)]
+    output = subprocess.run(command, cwd=ROOT_DIR, env=dict(os.environ, JOB_PROCESSES='0'),
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    for name, result in json.loads(output.splitlines()[-1]).items():
+        key = '{}@{}'.format(name, size)
+        results[key] = result
+        print('{:<28} p50 {:8.2f} ms  {:8.1f} images/s'.format(key, result['p50_ms'], result['images_per_s']))
+
+
+def write_web_app_dir(app_dir, model_path, anchors_path, class_names, image_path):
+    """Lay out the files web_app reads relative to its working directory.
+
+    :param app_dir: directory to create.
+    :param model_path: Keras model.
+    :param anchors_path: anchors file.
+    :param class_names: classes names.
+    :param image_path: gallery image.
+    """
+    os.makedirs(os.path.join(app_dir, 'model_data'))
+    os.makedirs(os.path.join(app_dir, 'images'))
+    shutil.copy(model_path, os.path.join(app_dir, 'model_data', 'yolo.h5'))
+    shutil.copy(anchors_path, os.path.join(app_dir, 'model_data', 'yolo_anchors.txt'))
+    with open(os.path.join(app_dir, 'model_data', 'coco_classes.txt'), 'w') as f:
+        f.write('\n'.join(class_names) + '\n')
+    shutil.copy(image_path, os.path.join(app_dir, 'images', os.path.basename(image_path)))
+    os.symlink(os.path.join(ROOT_DIR, 'font'), os.path.join(app_dir, 'font'))
+
+
+def benchmark_web_app(app_dir, repeat, warmup):
+    """Measure the request path of web_app, run in a child process from app_dir.
+
+    :param app_dir: directory prepared by write_web_app_dir.
+    :param repeat: measured iterations.
+    :param warmup: unmeasured iterations.
+    :return: latency statistics keyed by stage name.
+    """
+    import inspect
+    import threading
+
+    os.chdir(app_dir)
+    sys.path.insert(0, ROOT_DIR)
+    import web_app
+
+    for thread in threading.enumerate():
+        if thread.name in WEB_APP_THREADS:
+            thread.join()
+    # Stored results would skip the network on every iteration.
+    web_app.result_store = None
+    image_name = web_app.TEST_IMAGE_LIST[0]
+    # Dash callbacks are wrapped to answer HTTP requests, time the function itself.
+    run_script = inspect.unwrap(web_app.run_script)
+
+    def get_candidates():
+        web_app.candidates_cache.clear()
+        web_app.get_candidates(image_name)
+
+    def render():
+        web_app.candidates_cache.clear()
+        web_app.rendered_index.clear()
+        run_script(image_name, .2, 'server', None)
+
+    def render_slider():
+        # Candidates stay cached, as when only the slider moves.
+        web_app.rendered_index.clear()
+        run_script(image_name, .2, 'server', None)
+
+    return {'get_candidates': measure(get_candidates, repeat, warmup),
+            'run_script': measure(render, repeat, warmup),
+            'run_script_cached': measure(render_slider, repeat, warmup)}
+
+
+def compare(results, baseline, tolerance):
+    """Print p50 latency change against baseline.
+
+    :return: list of regressed stages.
+    """
+    regressions = []
+    print('\n{:<28} {:>12} {:>12} {:>8}'.format('stage', 'baseline ms', 'current ms', 'change'))
+    for key in sorted(set(results) & set(baseline)):
+        if 'p50_ms' not in results[key] or 'p50_ms' not in baseline[key]:
+            continue
+        old, new = baseline[key]['p50_ms'], results[key]['p50_ms']
+        change = new / old - 1.
+        flag = ''
+        if change > tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('{:<28} {:12.2f} {:12.2f} {:+7.1%}{}'.format(key, old, new, change, flag))
+    return regressions
+
+
+def _main(args):
+    if args.web_app_dir:
+        print(json.dumps(benchmark_web_app(args.web_app_dir, args.repeat, args.warmup)))
+        return
+    os.chdir(ROOT_DIR)
+    sys.path.insert(0, ROOT_DIR)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='detapp_bench_') as work_dir:
+        image_name = 'bench.jpg'
+        synthetic_image(os.path.join(work_dir, image_name), args.image_size)
+        for size in args.sizes:
+            benchmark_size(args, size, work_dir, image_name, results)
+
+    import tensorflow as tf
+    report = {'meta': {'python': platform.python_version(),
+                       'tensorflow': tf.__version__,
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'cpu_count': os.cpu_count(),
+                       'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')}},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Saved results to {}'.format(args.output))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('{} stages slower than baseline by more than {:.0%}.'.format(len(regressions), args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+"""
+Compares reduced-precision exports against a reference model on a directory of images.
+
+Each model runs in a fresh process over the same images. The script reports
+how far the candidate detections drift from the reference ones (matched
+recall and precision overall and per class, IoU, corner offset, score
+difference), plus latency, peak resident memory and artifact size.
+
+    ./export_graph.py model_data/yolo.h5 model_data/yolo.pb
+    ./export_graph.py model_data/yolo.h5 model_data/yolo_int8.pb --weights_dtype int8
+    python -m benchmarks.quantization images/ model_data/yolo.pb model_data/yolo_int8.pb
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Compare detections, latency and memory of exported models.')
+parser.add_argument('images_dir', help='Directory with .jpg images.')
+parser.add_argument('reference_path', help='Reference Keras model or frozen graph.')
+parser.add_argument('model_paths', nargs='+', help='Models compared with the reference.')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt', help='Path to anchors file.')
+parser.add_argument('--classes_path', default='model_data/coco_classes.txt', help='Path to classes file.')
+parser.add_argument('--max_images', type=int, default=100, help='Maximum number of compared images.')
+parser.add_argument('--score_threshold', type=float, default=.3, help='Minimum confidence threshold.')
+parser.add_argument('--iou_threshold', type=float, default=.5, help='NMS overlap threshold.')
+parser.add_argument('--match_iou', type=float, default=.5, help='Minimum IoU of boxes matched to reference.')
+parser.add_argument('--output', help='Write report to this JSON file.')
+parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+
+
+def run_model(model_path, image_paths, args):
+    """Detect objects on every image with one model in this process.
+
+    :return: detections per image, latencies and peak RSS in MB.
+    """
+    import resource
+
+    from src.detector import load_detector
+    from src.numpy_yolo import yolo_eval_candidates
+    from src.yolo_utils import get_anchors, get_classes, get_image
+
+    detector = load_detector(model_path, get_anchors(args.anchors_path), get_classes(args.classes_path))
+    model_image_size = [size or 608 for size in detector.model_image_size]
+    detections = []
+    latencies = []
+    for image_path in image_paths:
+        image_data, image = get_image(os.path.basename(image_path), os.path.dirname(image_path), model_image_size)
+        start = time.perf_counter()
+        boxes, box_scores = detector.candidates(image_data, score_floor=args.score_threshold)
+        latencies.append(time.perf_counter() - start)
+        out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, [image.size[1], image.size[0]],
+                                                                  score_threshold=args.score_threshold,
+                                                                  iou_threshold=args.iou_threshold)
+        detections.append({'boxes': out_boxes.tolist(), 'scores': out_scores.tolist(),
+                           'classes': out_classes.tolist()})
+    return {'detections': detections,
+            'latency_ms_p50': float(np.percentile(latencies[1:] or latencies, 50) * 1e3),
+            'first_run_ms': latencies[0] * 1e3,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def compare_detections(reference, candidate, match_iou=.5, class_names=None):
+    """Match candidate boxes to reference boxes of the same class.
+
+    :param reference: reference detections per image.
+    :param candidate: candidate detections per image.
+    :param match_iou: minimum IoU of a match.
+    :param class_names: classes names keying per-class figures, class indices if None.
+    :return: recall and precision against reference, overall and per class, and drift of matched boxes.
+    """
+    from src.numpy_yolo import box_iou_matrix
+
+    num_reference, num_candidate, num_matched = Counter(), Counter(), Counter()
+    ious, offsets, score_diffs = [], [], []
+    for ref, cand in zip(reference, candidate):
+        num_reference.update(ref['classes'])
+        num_candidate.update(cand['classes'])
+        for c in set(ref['classes']) & set(cand['classes']):
+            ref_index = np.flatnonzero(np.array(ref['classes']) == c)
+            cand_index = np.flatnonzero(np.array(cand['classes']) == c)
+            ref_boxes = np.array(ref['boxes'], dtype='float32')[ref_index]
+            cand_boxes = np.array(cand['boxes'], dtype='float32')[cand_index]
+            iou = box_iou_matrix(ref_boxes, cand_boxes)
+            while iou.size and iou.max() >= match_iou:
+                i, j = np.unravel_index(np.argmax(iou), iou.shape)
+                num_matched[c] += 1
+                ious.append(float(iou[i, j]))
+                offsets.append(float(np.abs(ref_boxes[i] - cand_boxes[j]).mean()))
+                score_diffs.append(abs(ref['scores'][ref_index[i]] - cand['scores'][cand_index[j]]))
+                iou[i, :] = -1.
+                iou[:, j] = -1.
+
+    def rates(matched, references, candidates):
+        return {'reference_boxes': references,
+                'candidate_boxes': candidates,
+                'recall': matched / references if references else 1.,
+                'precision': matched / candidates if candidates else 1.}
+
+    per_class = {class_names[c] if class_names else str(c): rates(num_matched[c], num_reference[c], num_candidate[c])
+                 for c in sorted(set(num_reference) | set(num_candidate))}
+    report = rates(sum(num_matched.values()), sum(num_reference.values()), sum(num_candidate.values()))
+    report.update({'per_class': per_class,
+                   'min_class_recall': min([r['recall'] for r in per_class.values()] or [1.]),
+                   'min_class_precision': min([r['precision'] for r in per_class.values()] or [1.]),
+                   'mean_iou': float(np.mean(ious)) if ious else None,
+                   'mean_corner_offset_px': float(np.mean(offsets)) if offsets else None,
+                   'mean_score_diff': float(np.mean(score_diffs)) if score_diffs else None,
+                   'max_score_diff': float(np.max(score_diffs)) if score_diffs else None})
+    return report
+
+
+def _main(args):
+    image_paths = sorted(glob.glob(os.path.join(os.path.abspath(args.images_dir), '*.jpg')))[:args.max_images]
+    if args.child:
+        print(json.dumps(run_model(args.reference_path, image_paths, args)))
+        return
+
+    runs = {}
+    for model_path in [args.reference_path] + args.model_paths:
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.quantization', '--child', os.path.abspath(args.images_dir),
+             model_path, model_path, '--max_images', str(args.max_images),
+             '--anchors_path', args.anchors_path, '--classes_path', args.classes_path,
+             '--score_threshold', str(args.score_threshold), '--iou_threshold', str(args.iou_threshold)],
+            cwd=ROOT_DIR)
+        runs[model_path] = json.loads(output.decode().strip().splitlines()[-1])
+
+    from src.yolo_utils import get_classes
+
+    class_names = get_classes(os.path.join(ROOT_DIR, args.classes_path))
+    report = {}
+    reference = runs[args.reference_path]
+    for model_path, run in runs.items():
+        report[model_path] = dict(compare_detections(reference['detections'], run['detections'], args.match_iou,
+                                                     class_names),
+                                  size_mb=os.path.getsize(os.path.join(ROOT_DIR, model_path)) / 2 ** 20,
+                                  latency_ms_p50=run['latency_ms_p50'],
+                                  first_run_ms=run['first_run_ms'],
+                                  max_rss_mb=run['max_rss_mb'])
+        print('{:<32} {size_mb:7.1f} MB  p50 {latency_ms_p50:7.1f} ms  RSS {max_rss_mb:7.1f} MB  '
+              'recall {recall:.3f}  precision {precision:.3f}  worst class recall {min_class_recall:.3f}  '
+              'precision {min_class_precision:.3f}  mean score diff {mean_score_diff}'.format(
+                  model_path, **report[model_path]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+"""
+Measures cold start of the detector from a Keras model or a frozen graph.
+
+Every run is a fresh Python process that imports the detection stack, loads
+the model, builds the detector and runs a first inference, so the numbers
+match what a new web worker pays. Peak resident memory is reported per run.
+
+    python -m benchmarks.startup model_data/yolo.h5 model_data/yolo.pb --repeat 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Benchmark detector startup time and memory.')
+parser.add_argument('model_paths', nargs='+', help='Keras .h5 models or frozen .pb graphs.')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt', help='Path to anchors file.')
+parser.add_argument('--classes_path', default='model_data/coco_classes.txt', help='Path to classes file.')
+parser.add_argument('--repeat', type=int, default=3, help='Processes started per model.')
+parser.add_argument('--output', help='Write results to this JSON file.')
+parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+
+
+def measure_startup(model_path, anchors_path, classes_path):
+    """Load detector in this process and time each startup step.
+
+    :return: import, load and first inference seconds and peak RSS in MB.
+    """
+    import resource
+
+    start = time.perf_counter()
+    import numpy as np
+    from src.detector import load_detector
+    from src.yolo_utils import get_anchors, get_classes
+    imported = time.perf_counter()
+
+    detector = load_detector(model_path, get_anchors(anchors_path), get_classes(classes_path))
+    loaded = time.perf_counter()
+
+    height, width = [size or 608 for size in detector.model_image_size]
+    detector.candidates(np.zeros((1, height, width, 3), dtype='float32'))
+    inferred = time.perf_counter()
+    return {'import_s': imported - start,
+            'load_s': loaded - imported,
+            'first_inference_s': inferred - loaded,
+            'total_s': inferred - start,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def _main(args):
+    if args.child:
+        print(json.dumps(measure_startup(args.model_paths[0], args.anchors_path, args.classes_path)))
+        return
+
+    results = {}
+    for model_path in args.model_paths:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.startup', '--child', model_path,
+                 '--anchors_path', args.anchors_path, '--classes_path', args.classes_path], cwd=ROOT_DIR)
+            runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+        results[model_path] = {key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]}
+        print('{:<32} total {total_s:6.2f}s  load {load_s:6.2f}s  first inference {first_inference_s:6.2f}s  '
+              'peak RSS {max_rss_mb:7.1f} MB'.format(model_path, **results[model_path]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,37 @@
+#! /usr/bin/env python
+"""
+Preprocesses gallery images into a memory-mapped tensor store served by web_app.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+from src.tensor_store import TensorStore
+from src.yolo_utils import RESAMPLE_FILTERS
+
+parser = argparse.ArgumentParser(
+    description='Preprocess images into a memory-mapped tensor store.')
+parser.add_argument('images_dir', help='Directory with .jpg images.')
+parser.add_argument('store_dir', help='Tensor store directory.')
+parser.add_argument('--height', type=int, default=608, help='Model input height.')
+parser.add_argument('--width', type=int, default=608, help='Model input width.')
+parser.add_argument('--resample', choices=sorted(RESAMPLE_FILTERS), default='bicubic', help='Resize filter.')
+parser.add_argument(
+    '--draft',
+    help='Decode large JPEGs at reduced size, must match DRAFT_DECODE of the web app.',
+    action='store_true')
+
+
+def _main(args):
+    store = TensorStore(os.path.expanduser(args.store_dir), (args.height, args.width),
+                        resample=RESAMPLE_FILTERS[args.resample], draft=args.draft)
+    image_paths = sorted(glob.glob(os.path.join(os.path.expanduser(args.images_dir), '*.jpg')))
+    start = time.time()
+    count = store.build(image_paths)
+    print('Processed {} of {} images in {:.1f}s.'.format(count, len(image_paths), time.time() - start))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+"""
+Runs YOLO detector over a directory or list of images and writes detections as JSON Lines.
+
+Images are decoded and resized on a thread pool while the session runs the
+previous batch. Already processed images found in the output file are skipped,
+so an interrupted run can be restarted with the same arguments.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.detector import load_detector
+from src.numpy_yolo import yolo_eval_candidates
+from src.yolo_utils import (get_image, get_classes, get_anchors, get_colors_for_classes, draw_boxes, encode_image,
+                            save_encoded_image, create_output_dir, detections_to_list, RESAMPLE_FILTERS)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+parser = argparse.ArgumentParser(
+    description='Run YOLO detector on a directory or list of images.')
+parser.add_argument('input_path', help='Directory with images or text file with one image path per line.')
+parser.add_argument('output_path', help='Path to output JSON Lines file.')
+parser.add_argument('--model_path', default='model_data/yolo.h5', help='Path to Keras model or frozen graph file.')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt', help='Path to anchors file.')
+parser.add_argument('--classes_path', default='model_data/coco_classes.txt', help='Path to classes file.')
+parser.add_argument('--annotated_dir', help='Also write annotated images to this directory.')
+parser.add_argument('--resolution', type=int, default=608,
+                    help='Input size of fully convolutional models, a multiple of 32.')
+parser.add_argument('--batch_size', type=int, default=8, help='Number of images in one session run.')
+parser.add_argument('--workers', type=int, default=4, help='Number of image decoding threads.')
+parser.add_argument('--prefetch', type=int, default=2, help='Number of batches decoded ahead of the session.')
+parser.add_argument('--resample', choices=sorted(RESAMPLE_FILTERS), default='bicubic', help='Resize filter.')
+parser.add_argument(
+    '--draft',
+    help='Decode large JPEGs at reduced size. Boxes and annotated images are then in the reduced resolution.',
+    action='store_true')
+parser.add_argument('--score_threshold', type=float, default=.6, help='Minimum confidence threshold.')
+parser.add_argument('--iou_threshold', type=float, default=.5, help='NMS overlap threshold.')
+parser.add_argument('--max_boxes', type=int, default=10, help='Maximum number of boxes per image.')
+parser.add_argument('--overwrite', action='store_true', help='Start from scratch instead of resuming.')
+parser.add_argument('--log_every', type=int, default=100, help='Report throughput every N batches.')
+
+
+def iter_image_paths(input_path):
+    """Lazily list images in directory tree or text file.
+
+    :param input_path: directory with images or text file with image paths.
+    :return: generator of image paths.
+    """
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+    else:
+        with open(input_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def read_done(output_path):
+    """Collect image paths already present in output file.
+
+    A partially written last line of an interrupted run is truncated, so its
+    image is processed again.
+
+    :param output_path: path to output JSON Lines file.
+    :return: set of processed image paths.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        valid_end = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            valid_end += len(line)
+            try:
+                done.add(json.loads(line.decode('utf-8'))['image'])
+            except (ValueError, KeyError):
+                continue
+        f.truncate(valid_end)
+    return done
+
+
+def load(image_path, model_image_size, resample, draft, out, keep_image):
+    """Decode and preprocess one image on a worker thread into its batch slot."""
+    try:
+        image_data, image = get_image(os.path.basename(image_path), os.path.dirname(image_path), model_image_size,
+                                      resample=resample, draft=draft, out=out)
+    except Exception as e:
+        return image_path, None, e
+    if not keep_image:
+        image.close()
+    return image_path, image, None
+
+
+def iter_batches(paths, pool, model_image_size, batch_size, prefetch, keep_image, resample=RESAMPLE_FILTERS['bicubic'],
+                 draft=False):
+    """Decode images on thread pool, keeping prefetch batches in flight.
+
+    Workers write straight into preallocated batch arrays. The arrays are used
+    as a ring: the one of a yielded batch is reused once the next batch is
+    requested, so it must not be kept after that.
+
+    :return: generator of (image_batch, items), items are lists of (image_path, image, error).
+                          Slots of images that failed to load contain garbage.
+    """
+    # The yielded batch, prefetch batches being decoded and the first images of the next one.
+    ring_size = prefetch + 2
+    buffers = np.empty((ring_size, batch_size) + tuple(model_image_size) + (3,), dtype='float32')
+    pending = deque()
+    paths = iter(paths)
+    num_submitted = 0
+    batch = []
+    while True:
+        while len(pending) < batch_size * (prefetch + 1):
+            image_path = next(paths, None)
+            if image_path is None:
+                break
+            slot, index = divmod(num_submitted, batch_size)
+            out = buffers[slot % ring_size, index:index + 1]
+            pending.append(pool.submit(load, image_path, model_image_size, resample, draft, out, keep_image))
+            num_submitted += 1
+        if not pending:
+            break
+        batch.append(pending.popleft().result())
+        if len(batch) == batch_size:
+            yield buffers[(num_submitted - len(pending) - 1) // batch_size % ring_size], batch
+            batch = []
+    if batch:
+        yield buffers[(num_submitted - 1) // batch_size % ring_size, :len(batch)], batch
+
+
+def annotate(image, out_boxes, out_scores, out_classes, class_names, colors, image_path, annotated_dir):
+    """Draw detections and write annotated image."""
+    draw_boxes(image, out_classes, out_boxes, out_scores, class_names, colors)
+    # Flatten the path so images with the same name in different directories do not collide.
+    name = os.path.splitext(image_path.strip(os.sep))[0].replace(os.sep, '_') + '.jpg'
+    save_encoded_image(encode_image(image), name, annotated_dir)
+
+
+def _main(args):
+    output_path = os.path.expanduser(args.output_path)
+    if args.overwrite and os.path.exists(output_path):
+        os.remove(output_path)
+    done = read_done(output_path)
+    if done:
+        print('Resuming, skipping {} processed images.'.format(len(done)))
+    if args.annotated_dir:
+        create_output_dir(args.annotated_dir)
+
+    detector = load_detector(args.model_path, get_anchors(args.anchors_path), get_classes(args.classes_path))
+    class_names = detector.class_names
+    colors = get_colors_for_classes(class_names)
+    model_image_size = detector.model_image_size
+    if None in model_image_size:
+        model_image_size = (args.resolution, args.resolution)
+
+    paths = (p for p in iter_image_paths(args.input_path) if p not in done)
+    num_images = 0
+    start = time.time()
+    with ThreadPoolExecutor(args.workers) as pool, open(output_path, 'a') as out:
+        annotations = deque()
+        batches = iter_batches(paths, pool, model_image_size, args.batch_size, args.prefetch,
+                               keep_image=args.annotated_dir is not None, resample=RESAMPLE_FILTERS[args.resample],
+                               draft=args.draft)
+        for num_batches, (image_batch, batch) in enumerate(batches, 1):
+            loaded = np.array([error is None for _, _, error in batch])
+            results = []
+            if loaded.any():
+                if not loaded.all():
+                    image_batch = image_batch[loaded]
+                results = detector.candidates_batch(image_batch, score_floor=args.score_threshold)
+            results = iter(results)
+
+            for image_path, image, error in batch:
+                if error is not None:
+                    out.write(json.dumps({'image': image_path, 'error': str(error)}) + '\n')
+                    continue
+                boxes, box_scores = next(results)
+                out_boxes, out_scores, out_classes = yolo_eval_candidates(
+                    boxes, box_scores, [image.size[1], image.size[0]], max_boxes=args.max_boxes,
+                    score_threshold=args.score_threshold, iou_threshold=args.iou_threshold)
+                out.write(json.dumps({'image': image_path,
+                                      'width': image.size[0],
+                                      'height': image.size[1],
+                                      'detections': detections_to_list(out_boxes, out_scores, out_classes,
+                                                                       class_names)}) + '\n')
+                if args.annotated_dir:
+                    annotations.append(pool.submit(annotate, image, out_boxes, out_scores, out_classes,
+                                                   class_names, colors, image_path, args.annotated_dir))
+            out.flush()
+
+            while annotations and annotations[0].done():
+                annotations.popleft().result()
+            num_images += len(batch)
+            if num_batches % args.log_every == 0:
+                print('{} images, {:.2f} images/s'.format(num_images, num_images / (time.time() - start)))
+                sys.stdout.flush()
+        for future in annotations:
+            future.result()
+
+    elapsed = time.time() - start
+    print('Processed {} images in {:.1f}s, {:.2f} images/s'.format(num_images, elapsed,
+                                                                    num_images / elapsed if elapsed else 0.))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+"""
+Runs YOLO detector on a video or an image sequence.
+
+Only every stride-th frame goes through the network, keyframes are batched
+into single session runs and boxes of the frames in between are interpolated
+along tracks matched between keyframes. Frames are streamed, at most
+stride * batch_size of them are held in memory.
+"""
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+
+import imageio
+import numpy as np
+from PIL import Image
+
+from detect_batch import iter_image_paths
+from src.detector import load_detector
+from src.numpy_yolo import yolo_eval_candidates
+from src.tracking import KeyframeTracker, interpolate_detections
+from src.yolo_utils import (get_classes, get_anchors, get_colors_for_classes, draw_boxes, detections_to_list,
+                            preprocess_image, RESAMPLE_FILTERS)
+
+parser = argparse.ArgumentParser(
+    description='Run YOLO detector on a video or a directory of frames.')
+parser.add_argument('input_path', help='Video file or directory with frame images.')
+parser.add_argument('output_path', help='Path to output JSON Lines file with detections of every frame.')
+parser.add_argument('--output_video', help='Also write annotated video to this file.')
+parser.add_argument('--model_path', default='model_data/yolo.h5', help='Path to Keras model or frozen graph file.')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt', help='Path to anchors file.')
+parser.add_argument('--classes_path', default='model_data/coco_classes.txt', help='Path to classes file.')
+parser.add_argument('--resolution', type=int, default=608,
+                    help='Input size of fully convolutional models, a multiple of 32.')
+parser.add_argument('--stride', type=int, default=5, help='Run the network on every N-th frame.')
+parser.add_argument('--batch_size', type=int, default=8, help='Number of keyframes in one session run.')
+parser.add_argument('--fps', type=float, default=25., help='Frame rate of image sequences.')
+parser.add_argument('--resample', choices=sorted(RESAMPLE_FILTERS), default='bilinear', help='Resize filter.')
+parser.add_argument('--score_threshold', type=float, default=.6, help='Minimum confidence threshold.')
+parser.add_argument('--iou_threshold', type=float, default=.5, help='NMS overlap threshold.')
+parser.add_argument('--max_boxes', type=int, default=10, help='Maximum number of boxes per frame.')
+parser.add_argument('--match_iou', type=float, default=.3, help='Minimum IoU to continue a track between keyframes.')
+
+
+def open_frames(input_path, fps=25.):
+    """Open video file or image sequence for streaming.
+
+    :param input_path: video file or directory with frame images.
+    :param fps: frame rate of image sequences.
+    :return: frame rate and generator of RGB frames as uint8 arrays.
+    """
+    if os.path.isdir(input_path):
+        def frames():
+            for image_path in iter_image_paths(input_path):
+                with Image.open(image_path) as image:
+                    yield np.asarray(image.convert('RGB'))
+        return fps, frames()
+
+    reader = imageio.get_reader(input_path)
+
+    def frames():
+        try:
+            for frame in reader:
+                yield frame[..., :3]
+        finally:
+            reader.close()
+    return reader.get_meta_data().get('fps', fps), frames()
+
+
+class VideoDetector(object):
+    """Streams frames, detects keyframes in batches and interpolates the rest."""
+
+    def __init__(self, detector, model_image_size, args, emit):
+        """
+        :param detector: YoloDetector.
+        :param model_image_size: model image size.
+        :param args: parsed command line arguments.
+        :param emit: called with (index, frame, detections) for every frame in order.
+        """
+        self.detector = detector
+        self.model_image_size = model_image_size
+        self.args = args
+        self.emit = emit
+        self.tracker = KeyframeTracker(match_iou=args.match_iou)
+        self.batch = np.empty((args.batch_size,) + tuple(model_image_size) + (3,), dtype='float32')
+        self.batch_frames = []
+        # [index, frame, frame shape, detections] of frames waiting for their next keyframe.
+        self.frames = deque()
+
+    def add(self, index, frame, keep_frame):
+        """Queue next frame."""
+        entry = [index, frame if keep_frame else None, frame.shape[:2], None]
+        if index % self.args.stride == 0:
+            slot = len(self.batch_frames)
+            preprocess_image(Image.fromarray(frame), self.model_image_size,
+                             resample=RESAMPLE_FILTERS[self.args.resample], out=self.batch[slot:slot + 1])
+            self.batch_frames.append(entry)
+        self.frames.append(entry)
+        if len(self.batch_frames) == self.args.batch_size:
+            self._run_batch()
+            self._flush()
+
+    def close(self):
+        """Detect remaining keyframes and emit every queued frame."""
+        if self.batch_frames:
+            self._run_batch()
+        self._flush(final=True)
+
+    def _run_batch(self):
+        results = self.detector.candidates_batch(self.batch[:len(self.batch_frames)],
+                                                 score_floor=self.args.score_threshold)
+        for entry, (boxes, box_scores) in zip(self.batch_frames, results):
+            out_boxes, out_scores, out_classes = yolo_eval_candidates(
+                boxes, box_scores, entry[2], max_boxes=self.args.max_boxes,
+                score_threshold=self.args.score_threshold, iou_threshold=self.args.iou_threshold)
+            entry[3] = self.tracker.update(out_boxes, out_scores, out_classes)
+        self.batch_frames = []
+
+    def _flush(self, final=False):
+        # The first queued frame is always a keyframe with detections.
+        while self.frames:
+            start = self.frames[0]
+            end_position = next((i for i, entry in enumerate(self.frames)
+                                 if i > 0 and entry[0] % self.args.stride == 0), None)
+            if end_position is None:
+                if final:
+                    while self.frames:
+                        index, frame, _, _ = self.frames.popleft()
+                        self.emit(index, frame, start[3])
+                return
+            end = self.frames[end_position]
+            if end[3] is None:
+                return
+            for _ in range(end_position):
+                index, frame, _, detections = self.frames.popleft()
+                if detections is None:
+                    detections = interpolate_detections(start[3], end[3], (index - start[0]) / (end[0] - start[0]))
+                self.emit(index, frame, detections)
+
+
+def _main(args):
+    detector = load_detector(args.model_path, get_anchors(args.anchors_path), get_classes(args.classes_path))
+    class_names = detector.class_names
+    colors = get_colors_for_classes(class_names)
+    model_image_size = detector.model_image_size
+    if None in model_image_size:
+        model_image_size = (args.resolution, args.resolution)
+
+    fps, frames = open_frames(args.input_path, fps=args.fps)
+    writer = imageio.get_writer(args.output_video, fps=fps) if args.output_video else None
+    start_time = time.time()
+    with open(os.path.expanduser(args.output_path), 'w') as out:
+        def emit(index, frame, detections):
+            line = {'frame': index,
+                    'keyframe': index % args.stride == 0,
+                    'detections': detections_to_list(detections['boxes'], detections['scores'],
+                                                     detections['classes'], class_names)}
+            for detection, track_id in zip(line['detections'], detections['track_ids']):
+                detection['track_id'] = int(track_id)
+            out.write(json.dumps(line) + '\n')
+            if writer is not None:
+                image = Image.fromarray(frame)
+                draw_boxes(image, detections['classes'], detections['boxes'], detections['scores'], class_names,
+                           colors)
+                writer.append_data(np.asarray(image))
+
+        video_detector = VideoDetector(detector, model_image_size, args, emit)
+        num_frames = 0
+        for num_frames, frame in enumerate(frames, 1):
+            video_detector.add(num_frames - 1, frame, keep_frame=writer is not None)
+        video_detector.close()
+    if writer is not None:
+        writer.close()
+
+    elapsed = time.time() - start_time
+    print('Processed {} frames in {:.1f}s, {:.2f} frames/s'.format(num_frames, elapsed,
+                                                                    num_frames / elapsed if elapsed else 0.))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
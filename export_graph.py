@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+"""
+Exports Keras YOLO model with decode, filter and NMS heads as a single frozen graph.
+"""
+
+import argparse
+import os
+import time
+
+from keras import backend as K
+from keras.models import load_model
+
+from src.detector import SIGNATURE_NODE, YoloDetector
+from src.quantize import WEIGHTS_DTYPES, quantize_graph_def
+from src.yolo_utils import get_anchors, get_classes
+
+parser = argparse.ArgumentParser(
+    description='Export frozen inference graph loaded by web_app and detect_batch.')
+parser.add_argument('model_path', help='Path to Keras model file.')
+parser.add_argument('output_path', help='Path to output frozen graph .pb file.')
+parser.add_argument('--anchors_path', default='model_data/yolo_anchors.txt', help='Path to anchors file.')
+parser.add_argument('--classes_path', default='model_data/coco_classes.txt', help='Path to classes file.')
+parser.add_argument('--weights_dtype', choices=WEIGHTS_DTYPES, default='float32',
+                    help='Store weights as float16 or per-channel int8, dequantized inside the graph.')
+
+
+def _main(args):
+    output_path = os.path.expanduser(args.output_path)
+    assert output_path.endswith('.pb'), 'output path {} is not a .pb file'.format(output_path)
+
+    start = time.time()
+    # Build inference-only layers, batch normalization uses moving statistics.
+    K.set_learning_phase(0)
+    yolo_model = load_model(os.path.expanduser(args.model_path), compile=False)
+    detector = YoloDetector(yolo_model, get_anchors(args.anchors_path), get_classes(args.classes_path))
+    graph_def = quantize_graph_def(detector.frozen_graph_def(), args.weights_dtype, signature_node=SIGNATURE_NODE)
+    with open(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Saved frozen graph with {} nodes to {} ({:.1f} MB) in {:.1f}s.'.format(
+        len(graph_def.node), output_path, os.path.getsize(output_path) / 2 ** 20, time.time() - start))
+
+
+if __name__ == '__main__':
+    _main(parser.parse_args())
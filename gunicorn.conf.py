@@ -0,0 +1,19 @@
+"""Gunicorn config for concurrent serving of web_app:server.
+
+TensorFlow sessions are not fork-safe, so the model is not preloaded in the
+master process. Instead a single worker process loads it once and serves
+requests from a pool of threads: Session.run releases the GIL and uses all
+cores, and the batch scheduler merges concurrent requests, so there is only
+one copy of the weights in memory.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 2 * multiprocessing.cpu_count()))
+preload_app = False
+# Loading the model can take a while on cold start.
+timeout = 120
@@ -0,0 +1,267 @@
+"""JSON REST detection API served by the Flask server of the Dash app."""
+
+import hashlib
+import json
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, wait
+
+import flask
+from src.jobs import JobQueueFull, detect_images
+from src.metrics import REGISTRY, count_request, stage_timer
+from src.numpy_yolo import yolo_eval_candidates
+from src.uploads import UploadDecoder, UploadError
+from src.yolo_utils import preprocess_image, detections_to_list
+
+MAX_BATCH_IMAGES = 64
+MAX_BOXES = 1000
+MAX_JOB_IMAGES = 512
+MAX_JOB_WAIT = 30.  # Seconds a status request may block for a job to finish.
+
+
+class ApiError(Exception):
+    """Error reported to the client as JSON."""
+
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+def create_api(scheduler, class_names, model_image_size, draft=True, metrics=REGISTRY, image_sizes=None, tiler=None,
+               jobs=None, decoder=None, results=None):
+    """Create blueprint with detection endpoints.
+
+    POST /api/detect takes an image as request body (or multipart field
+    'image') and returns its detections. POST /api/detect/batch takes
+    multipart files 'images' and streams one JSON line per image as soon as
+    its detections are ready, or with an error if it fails. Both accept
+    score_threshold, iou_threshold, max_boxes, classes (comma separated
+    names), resolution and tiled query parameters. Boxes are
+    [top, left, bottom, right] in pixels of the uploaded image.
+
+    With a job queue, POST /api/jobs takes the same input as the batch
+    endpoint and returns a job id at once. GET /api/jobs/<id> returns the job
+    status and, when done, the per-image results (wait=<seconds> blocks until
+    it finishes), GET /api/jobs/<id>/stream streams status lines followed by
+    the results, or an 'expired' status if the job is dropped meanwhile.
+
+    :param scheduler: BatchScheduler running the network.
+    :param class_names: classes names.
+    :param model_image_size: default model image size.
+    :param draft: decode large JPEGs at reduced size.
+    :param metrics: metrics registry.
+    :param image_sizes: model image sizes selectable with the resolution parameter, keyed by resolution.
+    :param tiler: Tiler used for requests with tiled=1, None disables tiled detection.
+    :param jobs: JobQueue for background jobs, None disables the job endpoints.
+    :param decoder: UploadDecoder enforcing upload limits, defaults to one with default limits.
+    :param results: ResultStore read before running the network and filled after it.
+    :return: Flask blueprint.
+    """
+    image_sizes = image_sizes or {}
+    decoder = decoder or UploadDecoder(draft=draft)
+    class_index = {name: i for i, name in enumerate(class_names)}
+    api = flask.Blueprint('api', __name__, url_prefix='/api')
+
+    @api.errorhandler(ApiError)
+    def handle_api_error(e):
+        return flask.jsonify(error=str(e)), e.status
+
+    def read_params():
+        args = flask.request.args
+        try:
+            params = {'score_threshold': float(args.get('score_threshold', .6)),
+                      'iou_threshold': float(args.get('iou_threshold', .5)),
+                      'max_boxes': int(args.get('max_boxes', 10))}
+        except ValueError as e:
+            raise ApiError('Invalid parameter: {}'.format(e))
+        if params['score_threshold'] < scheduler.score_floor:
+            raise ApiError('score_threshold must be at least {}'.format(scheduler.score_floor))
+        if not 0 < params['max_boxes'] <= MAX_BOXES:
+            raise ApiError('max_boxes must be between 1 and {}'.format(MAX_BOXES))
+        if args.get('classes'):
+            names = [name.strip() for name in args['classes'].split(',') if name.strip()]
+            unknown = [name for name in names if name not in class_index]
+            if unknown:
+                raise ApiError('Unknown classes: {}'.format(', '.join(unknown)))
+            params['class_ids'] = sorted(set(class_index[name] for name in names))
+        return params
+
+    def read_image_size():
+        resolution = flask.request.args.get('resolution')
+        if resolution is None:
+            return model_image_size
+        try:
+            return image_sizes[int(resolution)]
+        except (KeyError, ValueError):
+            raise ApiError('resolution must be one of {}'.format(sorted(image_sizes)))
+
+    def read_tiled():
+        tiled = flask.request.args.get('tiled', '').lower() in ('1', 'true')
+        if tiled and tiler is None:
+            raise ApiError('Tiled detection is not enabled.')
+        return tiled
+
+    def read_upload(f):
+        try:
+            return decoder.read(f)
+        except UploadError as e:
+            raise ApiError(str(e), status=e.status)
+
+    def submit(data, image_size, tiled=False):
+        """Decode image and queue it, or its tiles, for the network.
+
+        :return: future of candidates, image shape and result store key of new candidates.
+        """
+        store_key = None
+        if results is not None and not tiled:
+            store_key = (hashlib.sha1(data).hexdigest(), tuple(image_size))
+            candidates = results.get(*store_key, draft=decoder.draft)
+            if candidates is not None:
+                try:
+                    width, height = decoder.open(data).size
+                except UploadError as e:
+                    raise ApiError(str(e), status=e.status)
+                future = Future()
+                future.set_result(candidates)
+                return future, [height, width], None
+        try:
+            with stage_timer('decode', metrics):
+                # Tiles are cut from the full resolution image.
+                image, (width, height) = decoder.decode(data, None if tiled else image_size)
+        except UploadError as e:
+            raise ApiError(str(e), status=e.status)
+        with stage_timer('tiles' if tiled else 'resize', metrics):
+            if tiled:
+                return tiler.submit(scheduler, image, image_size), [height, width], None
+            image_data, _ = preprocess_image(image, image_size)
+        return scheduler.submit(image_data), [height, width], store_key
+
+    def result(candidates, image_shape, params, endpoint, store_key=None):
+        if store_key is not None:
+            results.put(store_key[0], store_key[1], candidates, draft=decoder.draft)
+        boxes, box_scores = candidates
+        with stage_timer('nms', metrics):
+            out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, image_shape, **params)
+        count_request(endpoint, len(out_boxes), metrics)
+        return {'width': image_shape[1],
+                'height': image_shape[0],
+                'detections': detections_to_list(out_boxes, out_scores, out_classes, class_names)}
+
+    @api.route('/detect', methods=['POST'])
+    def detect():
+        params = read_params()
+        image_size = read_image_size()
+        tiled = read_tiled()
+        if 'image' in flask.request.files:
+            data = read_upload(flask.request.files['image'])
+        else:
+            data = read_upload(flask.request.stream)
+        if not data:
+            raise ApiError('Missing image.')
+        future, image_shape, store_key = submit(data, image_size, tiled)
+        return flask.jsonify(result(future.result(), image_shape, params, 'api_detect', store_key))
+
+    @api.route('/detect/batch', methods=['POST'])
+    def detect_batch():
+        params = read_params()
+        image_size = read_image_size()
+        tiled = read_tiled()
+        files = flask.request.files.getlist('images')
+        if not files:
+            raise ApiError('Missing images.')
+        if len(files) > MAX_BATCH_IMAGES:
+            raise ApiError('At most {} images per request.'.format(MAX_BATCH_IMAGES))
+
+        def finished(pending, return_when):
+            done, _ = wait(pending, return_when=return_when)
+            for future in done:
+                index, filename, image_shape, store_key = pending.pop(future)
+                line = {'index': index, 'filename': filename}
+                try:
+                    line.update(result(future.result(), image_shape, params, 'api_detect', store_key))
+                except Exception as e:
+                    line['error'] = str(e)
+                yield json.dumps(line) + '\n'
+
+        def generate():
+            # Images are decoded as the stream goes, at most one batch ahead of the network.
+            pending = {}
+            for index, f in enumerate(files):
+                try:
+                    future, image_shape, store_key = submit(read_upload(f), image_size, tiled)
+                except ApiError as e:
+                    yield json.dumps({'index': index, 'filename': f.filename, 'error': str(e)}) + '\n'
+                    continue
+                pending[future] = (index, f.filename, image_shape, store_key)
+                if len(pending) >= scheduler.max_batch_size:
+                    yield from finished(pending, FIRST_COMPLETED)
+            yield from finished(pending, ALL_COMPLETED)
+
+        return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if jobs is None:
+        return api
+
+    def read_job(job_id, wait=0.):
+        status = jobs.wait(job_id, wait) if wait > 0 else jobs.status(job_id)
+        if status is None:
+            raise ApiError('Unknown job {}.'.format(job_id), status=404)
+        return status
+
+    @api.route('/jobs', methods=['POST'])
+    def submit_job():
+        params = read_params()
+        image_size = read_image_size()
+        tiled = read_tiled()
+        images = [(f.filename, read_upload(f)) for f in flask.request.files.getlist('images')]
+        if not images and flask.request.content_length:
+            images = [(None, read_upload(flask.request.stream))]
+        if not images:
+            raise ApiError('Missing images.')
+        if len(images) > MAX_JOB_IMAGES:
+            raise ApiError('At most {} images per job.'.format(MAX_JOB_IMAGES))
+        for filename, data in images:
+            # Workers decode the images, reject oversized ones before they are queued.
+            try:
+                decoder.open(data)
+            except UploadError as e:
+                if e.status != 400:
+                    raise ApiError('{}: {}'.format(filename, e), status=e.status)
+        try:
+            job_id = jobs.submit(detect_images, images, class_names, image_size, params, scheduler.score_floor,
+                                 tiler if tiled else None, decoder.draft, results=results)
+        except JobQueueFull as e:
+            raise ApiError(str(e), status=503)
+        response = flask.jsonify(jobs.status(job_id))
+        response.status_code = 202
+        response.headers['Location'] = flask.url_for('.job_status', job_id=job_id)
+        return response
+
+    @api.route('/jobs/<job_id>')
+    def job_status(job_id):
+        try:
+            wait = min(float(flask.request.args.get('wait', 0.)), MAX_JOB_WAIT)
+        except ValueError as e:
+            raise ApiError('Invalid parameter: {}'.format(e))
+        return flask.jsonify(read_job(job_id, wait))
+
+    @api.route('/jobs/<job_id>/stream')
+    def job_stream(job_id):
+        status = read_job(job_id)
+
+        def generate(status):
+            # Status lines double as keep-alives until the job finishes.
+            while True:
+                lines = status.pop('result', [])
+                yield json.dumps(status) + '\n'
+                if status['status'] not in ('queued', 'running'):
+                    break
+                try:
+                    status = read_job(job_id, MAX_JOB_WAIT)
+                except ApiError:
+                    # Headers are sent already, report the job dropped in the stream.
+                    status = {'id': job_id, 'status': 'expired'}
+            for line in lines:
+                yield json.dumps(line) + '\n'
+
+        return flask.Response(flask.stream_with_context(generate(status)), mimetype='application/x-ndjson')
+
+    return api
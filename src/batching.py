@@ -0,0 +1,130 @@
+"""Dynamic micro-batching of network runs."""
+
+import queue
+import threading
+import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import Future
+
+import numpy as np
+
+from src.metrics import REGISTRY, COUNT_BUCKETS, stage_timer
+
+# Live schedulers of every registry, its queue depth gauge reports their sum.
+_schedulers = weakref.WeakKeyDictionary()
+
+
+class BatchScheduler(object):
+    """Collect concurrent requests and run them through the network as one batch.
+
+    The first queued request opens a wait window of max_wait seconds. Every
+    request arriving inside the window (up to max_batch_size) is stacked into
+    the same session run and the candidates are handed back per request.
+    """
+
+    def __init__(self, detector, max_batch_size=8, max_wait=0.005, score_floor=0., metrics=REGISTRY):
+        """Start scheduler worker thread.
+
+        :param detector: YoloDetector used to run the network.
+        :param max_batch_size: maximum number of images in one session run.
+        :param max_wait: seconds to wait for more requests before running a batch.
+        :param score_floor: lowest confidence threshold that will be applied.
+        :param metrics: registry for queue depth, batch size and inference time.
+        """
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.score_floor = score_floor
+        self._queue = queue.Queue()
+        self.metrics = metrics
+        schedulers = _schedulers.setdefault(metrics, weakref.WeakSet())
+        schedulers.add(self)
+        metrics.gauge('detapp_queue_depth', 'Images waiting for the network.',
+                      lambda: sum(scheduler._queue.qsize() for scheduler in list(schedulers)))
+        self._batch_sizes = metrics.histogram('detapp_batch_size', 'Images per network run.', buckets=COUNT_BUCKETS)
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def submit(self, image_data):
+        """Queue preprocessed image for the next batch.
+
+        :param image_data: preprocessed image batch with a single image.
+        :return: future resolving to (boxes, box_scores) candidates.
+        """
+        future = Future()
+        self._queue.put((image_data, future))
+        return future
+
+    def candidates(self, image_data):
+        """Run the network on image through the scheduler and wait for the result.
+
+        :param image_data: preprocessed image batch with a single image.
+        :return:    boxes: normalized box corners.
+
+                    box_scores: box confidence times class probabilities.
+        """
+        return self.submit(image_data).result()
+
+    def candidates_batch(self, image_batch, score_floor=None):
+        """Run several images through the scheduler, so it can stand in for a YoloDetector.
+
+        :param image_batch: preprocessed images batch.
+        :param score_floor: ignored, the scheduler applies its own score_floor.
+        :return: list of (boxes, box_scores) candidates for every image.
+        """
+        futures = [self.submit(image_batch[i:i + 1]) for i in range(len(image_batch))]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Run queued requests and stop worker thread."""
+        self._queue.put(None)
+        self._thread.join()
+        _schedulers[self.metrics].discard(self)
+
+    def _collect(self):
+        """Block for the first request, then gather more until the window closes."""
+        item = self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            # Images of different resolution can not share one input tensor.
+            groups = defaultdict(list)
+            for image_data, future in batch:
+                groups[image_data.shape[1:]].append((image_data, future))
+            for items in groups.values():
+                self._run_batch(items)
+
+    def _run_batch(self, items):
+        items = [(image_data, future) for image_data, future in items if future.set_running_or_notify_cancel()]
+        if not items:
+            return
+        image_batch = np.concatenate([image_data for image_data, _ in items])
+        self._batch_sizes.observe(len(items))
+        try:
+            with stage_timer('inference', self.metrics):
+                results = self.detector.candidates_batch(image_batch, score_floor=self.score_floor)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(items, results):
+            future.set_result(result)
@@ -0,0 +1,174 @@
+"""Small caches shared between requests, in memory or in a directory shared by worker processes."""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with a bounded number of entries."""
+
+    def __init__(self, maxsize=128):
+        """Create empty cache.
+
+        :param maxsize: maximum number of stored entries.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value and mark it as recently used.
+
+        :param key: cache key.
+        :param default: value returned on cache miss.
+        :return: cached value.
+        """
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        """Store value, evicting the least recently used entry if full.
+
+        :param key: cache key.
+        :param value: value to store.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class DirectoryStore(object):
+    """Files in a directory shared by worker processes, bounded in total size.
+
+    Files are written under a temporary name and renamed, so readers never see
+    a partial file. Reads refresh the modification time and once the files
+    this process knows of exceed max_bytes, the least recently used ones are
+    deleted until the directory is below PRUNE_TO of max_bytes. The store can
+    be pickled to worker processes.
+    """
+
+    PRUNE_TO = .9
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20):
+        """Open or create store.
+
+        :param directory: directory of the files.
+        :param max_bytes: maximum total size of the files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, _, size in self._files())
+
+    def path(self, name):
+        """Path of a stored file, marking it as recently used.
+
+        :param name: file name.
+        :return: path, None if the file is not stored.
+        """
+        if not self._valid(name):
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get(self, name, default=None):
+        """Contents of a stored file.
+
+        :param name: file name.
+        :param default: value returned for missing files.
+        :return: bytes.
+        """
+        path = self.path(name)
+        if path is None:
+            return default
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:  # Pruned by another process meanwhile.
+            return default
+
+    def put(self, name, data):
+        """Store a file, replacing one with the same name.
+
+        :param name: file name without directories.
+        :param data: bytes.
+        :return: path of the file.
+        """
+        if not self._valid(name):
+            raise ValueError('Invalid file name {!r}.'.format(name))
+        path = os.path.join(self.directory, name)
+        tmp_path = '.{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident())
+        with open(os.path.join(self.directory, tmp_path), 'wb') as f:
+            f.write(data)
+        os.replace(os.path.join(self.directory, tmp_path), path)
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._prune()
+        return path
+
+    def __contains__(self, name):
+        return self._valid(name) and os.path.exists(os.path.join(self.directory, name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _valid(name):
+        return bool(name) and os.path.basename(name) == name and not name.startswith('.')
+
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def _prune(self):
+        """Delete least recently used files, called with the lock held."""
+        files = sorted(self._files())
+        self._size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self._size <= self.max_bytes * self.PRUNE_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
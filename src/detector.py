@@ -0,0 +1,224 @@
+"""Persistent YOLO detection pipeline."""
+
+import json
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+from src import numpy_yolo
+from src.keras_yolo import yolo_boxes_to_corners, yolo_eval, yolo_head
+from src.quantize import session_config
+
+BACKENDS = ('tensorflow', 'numpy')
+SIGNATURE_NODE = 'detector_signature'
+INPUT_TENSORS = ('image_input', 'input_image_shape', 'score_threshold', 'iou_threshold', 'max_boxes', 'class_mask')
+OUTPUT_TENSORS = ('feats', 'boxes', 'scores', 'classes', 'candidate_boxes', 'candidate_scores')
+
+
+class YoloDetector(object):
+    """YOLO detection graph built once and reused for every request.
+
+    Score threshold, IoU threshold and max boxes are fed through placeholders,
+    so running a detection never adds new ops or variables to the graph. All
+    methods only call Session.run, which is thread-safe, so one detector can be
+    shared by every request thread of the process. The detected classes are
+    fed as a mask, see detect's class_ids.
+    """
+
+    def __init__(self, yolo_model, anchors, class_names, sess=None, backend='tensorflow'):
+        """Build decode, filter and NMS ops on top of the model.
+
+        :param yolo_model: loaded Keras YOLO model.
+        :param anchors: anchor box widths and heights.
+        :param class_names: classes names.
+        :param sess: TF session, defaults to the Keras session.
+        :param backend: post-processing backend of candidates, 'tensorflow' decodes boxes in the graph,
+                        'numpy' fetches raw conv output and decodes it with numpy_yolo.
+        """
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend `{}`, expected one of {}'.format(backend, BACKENDS))
+        self.backend = backend
+        self.sess = sess or K.get_session()
+        self.yolo_model = yolo_model
+        self.anchors = anchors
+        self.class_names = class_names
+        self.model_image_size = yolo_model.layers[0].input_shape[1:3]
+        # Models loaded after K.set_learning_phase(0) have no learning phase to feed.
+        self.learning_phase = K.learning_phase() if tf.is_tensor(K.learning_phase()) else None
+        self.image_input = yolo_model.input
+        self.feats = yolo_model.output
+
+        self.input_image_shape = K.placeholder(shape=(2,), name='input_image_shape')
+        self.score_threshold = K.placeholder(shape=(), name='score_threshold')
+        self.iou_threshold = K.placeholder(shape=(), name='iou_threshold')
+        self.max_boxes = K.placeholder(shape=(), dtype='int32', name='max_boxes')
+        self.class_mask = tf.placeholder_with_default(tf.ones([len(class_names)]), shape=(len(class_names),),
+                                                      name='class_mask')
+
+        self.yolo_outputs = yolo_head(yolo_model.output, anchors, len(class_names))
+        self.boxes, self.scores, self.classes = yolo_eval(self.yolo_outputs,
+                                                          self.input_image_shape,
+                                                          max_boxes=self.max_boxes,
+                                                          score_threshold=self.score_threshold,
+                                                          iou_threshold=self.iou_threshold,
+                                                          class_mask=self.class_mask)
+
+        # Per-box corners and class scores before any filtering, so that
+        # threshold changes can be re-evaluated without the network.
+        box_xy, box_wh, box_confidence, box_class_probs = self.yolo_outputs
+        batch_size = K.shape(box_xy)[0]
+        self.candidate_boxes = K.reshape(yolo_boxes_to_corners(box_xy, box_wh), [batch_size, -1, 4])
+        self.candidate_scores = K.reshape(box_confidence * box_class_probs, [batch_size, -1, len(class_names)])
+
+    @classmethod
+    def from_frozen_graph(cls, graph_path, backend='tensorflow', config=None):
+        """Load detector exported with frozen_graph_def, without Keras or the HDF5 model.
+
+        :param graph_path: path to serialized GraphDef.
+        :param backend: post-processing backend of candidates, see __init__.
+        :param config: TF session config, defaults to one keeping reduced-precision weights in memory.
+        :return: detector running in its own graph and session.
+        """
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend `{}`, expected one of {}'.format(backend, BACKENDS))
+        graph_def = tf.GraphDef()
+        with open(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        signature_value = next(node.attr['value'].tensor for node in graph_def.node if node.name == SIGNATURE_NODE)
+        signature = json.loads(tf.make_ndarray(signature_value).item().decode())
+        missing = sorted(set(INPUT_TENSORS + OUTPUT_TENSORS) - set(signature['tensors']))
+        if missing:
+            raise ValueError('{} has no tensors {}, export it again.'.format(graph_path, ', '.join(missing)))
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        if config is None:
+            config = session_config(signature.get('weights_dtype', 'float32'))
+        sess = tf.Session(graph=graph, config=config)
+
+        detector = cls.__new__(cls)
+        detector.backend = backend
+        detector.sess = sess
+        detector.yolo_model = None
+        detector.anchors = np.array(signature['anchors'], dtype='float32')
+        detector.class_names = signature['class_names']
+        detector.model_image_size = tuple(signature['model_image_size'])
+        detector.learning_phase = None
+        for name, tensor_name in signature['tensors'].items():
+            setattr(detector, name, graph.get_tensor_by_name(tensor_name))
+        return detector
+
+    def frozen_graph_def(self):
+        """Export detection graph with weights as constants and training-only nodes removed.
+
+        The graph keeps the decode, filter and NMS heads and a signature node
+        holding tensor names, anchors and class names, so from_frozen_graph
+        needs nothing else. Adds the signature node to the session graph.
+
+        :return: optimized GraphDef.
+        """
+        from tensorflow.tools.graph_transforms import TransformGraph
+
+        signature = {'anchors': np.asarray(self.anchors).tolist(),
+                     'class_names': list(self.class_names),
+                     'model_image_size': list(self.model_image_size),
+                     'tensors': {name: getattr(self, name).name for name in INPUT_TENSORS + OUTPUT_TENSORS}}
+        with self.sess.graph.as_default():
+            tf.constant(json.dumps(signature), name=SIGNATURE_NODE)
+        inputs = [getattr(self, name).op.name for name in INPUT_TENSORS]
+        outputs = [getattr(self, name).op.name for name in OUTPUT_TENSORS] + [SIGNATURE_NODE]
+
+        graph_def = tf.graph_util.convert_variables_to_constants(self.sess, self.sess.graph.as_graph_def(), outputs)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=inputs + outputs)
+        return TransformGraph(graph_def, inputs, outputs, ['fold_constants(ignore_errors=true)',
+                                                           'fold_batch_norms',
+                                                           'fold_old_batch_norms'])
+
+    def warmup(self, image_sizes, batch_size=1):
+        """Run the network once per input size.
+
+        The first run at a new size allocates buffers and picks kernels, and
+        the numpy backend caches its grid per conv size, so warming up keeps
+        that cost out of the first requests.
+
+        :param image_sizes: model input (height, width) pairs, multiples of 32.
+        :param batch_size: batch size of warm-up runs.
+        """
+        for height, width in image_sizes:
+            self.candidates_batch(np.zeros((batch_size, height, width, 3), dtype='float32'))
+
+    def _feed_dict(self, image_batch):
+        feed_dict = {self.image_input: image_batch}
+        if self.learning_phase is not None:
+            feed_dict[self.learning_phase] = 0
+        return feed_dict
+
+    def detect(self, image_data, image_shape, score_threshold=.6, iou_threshold=.5, max_boxes=10, class_ids=None):
+        """Find objects on preprocessed image.
+
+        :param image_data: preprocessed image batch.
+        :param image_shape: original image (height, width).
+        :param score_threshold: minimum confidence threshold.
+        :param iou_threshold: NMS overlap threshold.
+        :param max_boxes: maximum number of returned boxes.
+        :param class_ids: indices of classes to detect, None detects every class.
+        :return: boxes, scores, classes.
+        """
+        feed_dict = self._feed_dict(image_data)
+        feed_dict.update({self.input_image_shape: image_shape,
+                          self.score_threshold: score_threshold,
+                          self.iou_threshold: iou_threshold,
+                          self.max_boxes: max_boxes})
+        if class_ids is not None:
+            class_mask = np.zeros(len(self.class_names), dtype='float32')
+            class_mask[list(class_ids)] = 1.
+            feed_dict[self.class_mask] = class_mask
+        return self.sess.run([self.boxes, self.scores, self.classes], feed_dict=feed_dict)
+
+    def candidates(self, image_data, score_floor=0.):
+        """Run the network and keep every box that can pass score_floor.
+
+        A box whose best class score is below score_floor can not pass any
+        higher threshold, so the result can be re-filtered with
+        numpy_yolo.yolo_eval_candidates for every threshold >= score_floor.
+
+        :param image_data: preprocessed image batch with a single image.
+        :param score_floor: lowest confidence threshold that will be applied.
+        :return:    boxes: normalized box corners.
+
+                    box_scores: box confidence times class probabilities.
+        """
+        return self.candidates_batch(image_data, score_floor=score_floor)[0]
+
+    def candidates_batch(self, image_batch, score_floor=0.):
+        """Run the network on a batch of images in a single session run.
+
+        :param image_batch: preprocessed images stacked along the first axis.
+        :param score_floor: lowest confidence threshold that will be applied.
+        :return: list of (boxes, box_scores) candidates, one per image.
+        """
+        feed_dict = self._feed_dict(image_batch)
+        if self.backend == 'numpy':
+            feats = self.sess.run(self.feats, feed_dict=feed_dict)
+            yolo_outputs = numpy_yolo.yolo_head(feats, self.anchors, len(self.class_names))
+            return numpy_yolo.yolo_candidates(yolo_outputs, score_floor=score_floor)
+
+        boxes, box_scores = self.sess.run([self.candidate_boxes, self.candidate_scores], feed_dict=feed_dict)
+        masks = np.max(box_scores, axis=-1) >= score_floor
+        return [(b[mask], s[mask]) for b, s, mask in zip(boxes, box_scores, masks)]
+
+
+def load_detector(model_path, anchors, class_names, backend='tensorflow'):
+    """Load detector from a frozen graph (.pb) or a Keras model file.
+
+    :param model_path: path to .pb exported by export_graph.py or to Keras .h5 model.
+    :param anchors: anchor box widths and heights, frozen graphs use their own.
+    :param class_names: classes names, frozen graphs use their own.
+    :param backend: post-processing backend of candidates.
+    :return: YoloDetector.
+    """
+    if model_path.endswith('.pb'):
+        return YoloDetector.from_frozen_graph(model_path, backend=backend)
+    from keras.models import load_model
+    return YoloDetector(load_model(model_path), anchors, class_names, backend=backend)
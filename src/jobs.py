@@ -0,0 +1,322 @@
+"""Asynchronous detection jobs run by a pool of workers."""
+
+import hashlib
+import io
+import json
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from src.metrics import REGISTRY
+from src.numpy_yolo import yolo_eval_candidates
+from src.yolo_utils import preprocess_image, detections_to_list
+
+# Detector of a process_executor worker process, loaded by its initializer.
+_worker_detector = None
+# Seconds between reads of the shared record of a job submitted to another process.
+RECORD_POLL_INTERVAL = .25
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are queued or running."""
+
+
+class JobTimeout(Exception):
+    """Raised when a job runs past its deadline."""
+
+
+def _load_worker_detector(model_path, anchors_path, classes_path, backend):
+    from src.detector import load_detector
+    from src.yolo_utils import get_anchors, get_classes
+
+    global _worker_detector
+    _worker_detector = load_detector(model_path, get_anchors(anchors_path), get_classes(classes_path),
+                                     backend=backend)
+    _worker_detector.sess.graph.finalize()
+
+
+class _LocalExecutor(ThreadPoolExecutor):
+    """Thread pool passing its detector to every submitted job."""
+
+    def __init__(self, detector, workers):
+        super(_LocalExecutor, self).__init__(workers, thread_name_prefix='job-worker')
+        self.detector = detector
+
+    def submit(self, fn, *args, **kwargs):
+        if self.detector is not None:
+            fn = partial(fn, detector=self.detector)
+        return super(_LocalExecutor, self).submit(fn, *args, **kwargs)
+
+
+def _run_job(records, record, fn, *args, **kwargs):
+    """Mark the shared record of a job running, then run the job."""
+    records.put('{}.json'.format(record['id']), json.dumps(dict(record, status='running')).encode())
+    return fn(*args, **kwargs)
+
+
+def local_executor(detector, workers=2):
+    """Job worker threads of the web process.
+
+    :param detector: YoloDetector or BatchScheduler shared with interactive requests,
+                     passed to jobs as detector keyword argument.
+    :param workers: number of jobs run at once.
+    :return: executor for JobQueue.
+    """
+    return _LocalExecutor(detector, workers)
+
+
+def process_executor(workers, model_path, anchors_path, classes_path, backend='tensorflow'):
+    """Job worker processes, each loading its own model.
+
+    Processes are spawned rather than forked because TensorFlow sessions are
+    not fork-safe. Spawned processes re-import the __main__ module, so it
+    must not load a model at import time (gunicorn's entry point does not).
+
+    :param workers: number of worker processes.
+    :param model_path: Keras model or frozen graph file.
+    :param anchors_path: path to anchors file.
+    :param classes_path: path to classes file.
+    :param backend: post-processing backend, 'tensorflow' or 'numpy'.
+    :return: executor for JobQueue.
+    """
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_load_worker_detector,
+                               initargs=(model_path, anchors_path, classes_path, backend))
+
+
+def detect_images(images, class_names, image_size, params, score_floor=0., tiler=None, draft=True, batch_size=8,
+                  results=None, deadline=None, detector=None):
+    """Detect objects on the images of a job.
+
+    :param images: list of (filename, encoded image) pairs.
+    :param class_names: classes names.
+    :param image_size: model image size.
+    :param params: keyword arguments of yolo_eval_candidates.
+    :param score_floor: lowest confidence threshold that will be applied.
+    :param tiler: Tiler for tiled detection, None to detect on whole images.
+    :param draft: decode large JPEGs at reduced size.
+    :param batch_size: number of images in one network run.
+    :param results: ResultStore read before running the network and filled after it, not used for tiled detection.
+    :param deadline: time.time() after which the job is abandoned.
+    :param detector: detector bound by local_executor, None for the detector of this worker process.
+    :return: one dict per image with index, filename, width, height and detections, or error.
+    """
+    run_batch = partial((detector or _worker_detector).candidates_batch, score_floor=score_floor)
+    lines = []
+    for start in range(0, len(images), batch_size):
+        if deadline is not None and time.time() > deadline:
+            raise JobTimeout('Deadline passed after {} of {} images.'.format(start, len(images)))
+        chunk = []
+        for index in range(start, min(start + batch_size, len(images))):
+            filename, data = images[index]
+            line = {'index': index, 'filename': filename}
+            lines.append(line)
+            candidates = image_data = image_sha1 = None
+            try:
+                image = Image.open(io.BytesIO(data))
+                image_shape = [image.size[1], image.size[0]]
+                if results is not None and tiler is None:
+                    image_sha1 = hashlib.sha1(data).hexdigest()
+                    candidates = results.get(image_sha1, image_size, draft=draft)
+                if candidates is None:
+                    if draft and tiler is None:
+                        image.draft('RGB', tuple(reversed(image_size)))
+                    image.load()
+                    if tiler is not None:
+                        candidates = tiler.candidates(image, image_size, run_batch)
+                    else:
+                        image_data, _ = preprocess_image(image, image_size)
+            except (IOError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+                line['error'] = 'Can not decode image: {}'.format(e)
+                continue
+            chunk.append((line, image_shape, candidates, image_data, image_sha1))
+
+        batch = [image_data for _, _, candidates, image_data, _ in chunk if candidates is None]
+        batch_candidates = iter(run_batch(np.concatenate(batch)) if batch else [])
+        for line, image_shape, candidates, _, image_sha1 in chunk:
+            if candidates is None:
+                candidates = next(batch_candidates)
+                if image_sha1 is not None:
+                    results.put(image_sha1, image_size, candidates, draft=draft)
+            boxes, box_scores = candidates
+            out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, image_shape, **params)
+            line.update({'width': image_shape[1],
+                         'height': image_shape[0],
+                         'detections': detections_to_list(out_boxes, out_scores, out_classes, class_names)})
+    return lines
+
+
+class JobQueue(object):
+    """Bounded queue of background jobs polled by id.
+
+    Jobs run on an executor, local_executor threads share the model of the
+    web process and process_executor workers hold their own. A job that is
+    not finished by its deadline is reported as timed out, cancelled if it
+    has not started, and its worker stops at the next check. Finished jobs
+    are kept for keep_finished seconds.
+
+    Jobs run in the process that queued them. With a records store shared by
+    the web server's worker processes, each job's status and result are also
+    written there, so status and wait answer for jobs of any process.
+    """
+
+    def __init__(self, executor, max_pending=32, timeout=300., keep_finished=600., records=None, metrics=REGISTRY):
+        """
+        :param executor: executor running the jobs.
+        :param max_pending: maximum number of queued and running jobs of this process.
+        :param timeout: seconds from submission until a job times out.
+        :param keep_finished: seconds finished jobs stay available.
+        :param records: DirectoryStore for job records shared by worker processes, None keeps jobs in this process.
+        :param metrics: metrics registry.
+        """
+        self.executor = executor
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.keep_finished = keep_finished
+        self.records = records
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+        metrics.gauge('detapp_jobs_pending', 'Jobs queued or running.', lambda: self._pending)
+        self._durations = metrics.histogram('detapp_job_seconds', 'Job duration from submission.',
+                                            buckets=(.1, .5, 1., 5., 10., 30., 60., 300., 900.))
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a job.
+
+        :param fn: picklable function called as fn(*args, **kwargs, deadline=deadline), local_executor
+                   also passes its detector.
+        :param args: picklable arguments.
+        :param kwargs: picklable keyword arguments.
+        :return: job id.
+        """
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_pending:
+                raise JobQueueFull('Job queue is full, {} jobs pending.'.format(self._pending))
+            self._pending += 1
+            now = time.time()
+            job = {'id': uuid.uuid4().hex, 'status': 'queued', 'submitted': now, 'deadline': now + self.timeout,
+                   'finished': None, 'future': None, 'event': threading.Event()}
+            self._jobs[job['id']] = job
+        self._write_record(job)
+        if self.records is not None:
+            fn = partial(_run_job, self.records, self._record(job), fn)
+        try:
+            job['future'] = self.executor.submit(fn, *args, deadline=job['deadline'], **kwargs)
+        except Exception as e:
+            self._finish(job, 'failed', error=str(e))
+            raise
+        job['future'].add_done_callback(partial(self._done, job))
+        return job['id']
+
+    def status(self, job_id):
+        """Current state of a job.
+
+        :param job_id: job id.
+        :return: dict with id and status ('queued', 'running', 'done', 'failed' or 'timeout'),
+                 plus result or error of finished jobs; None for unknown jobs.
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is None:
+            return self._read_record(job_id)
+        status = {'id': job['id'], 'status': job['status']}
+        if job['finished'] is None:
+            if job['future'] is not None and job['future'].running():
+                status['status'] = 'running'
+            return status
+        for key in ('result', 'error'):
+            if key in job:
+                status[key] = job[key]
+        return status
+
+    def wait(self, job_id, timeout):
+        """Wait until a job finishes, its deadline passes or timeout seconds elapse.
+
+        :param job_id: job id.
+        :param timeout: maximum seconds to wait.
+        :return: job status, see status.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job['event'].wait(max(0., min(timeout, job['deadline'] - time.time())))
+            return self.status(job_id)
+        # Jobs of other processes are polled through their records.
+        end = time.time() + timeout
+        status = self.status(job_id)
+        while status is not None and status['status'] in ('queued', 'running') and time.time() < end:
+            time.sleep(min(RECORD_POLL_INTERVAL, max(0., end - time.time())))
+            status = self.status(job_id)
+        return status
+
+    def close(self):
+        """Stop accepting jobs and wait for running ones."""
+        self.executor.shutdown(wait=True)
+
+    def _done(self, job, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self._finish(job, 'done', result=future.result())
+        elif isinstance(error, JobTimeout):
+            self._finish(job, 'timeout', error=str(error))
+        else:
+            self._finish(job, 'failed', error='{}: {}'.format(type(error).__name__, error))
+
+    def _finish(self, job, status, **fields):
+        with self._lock:
+            if job['finished'] is not None:
+                return
+            job.update(fields, status=status, finished=time.time())
+            self._pending -= 1
+        self._write_record(job)
+        self._durations.observe(job['finished'] - job['submitted'])
+        job['event'].set()
+
+    @staticmethod
+    def _record(job):
+        return {key: job[key] for key in ('id', 'status', 'deadline', 'finished', 'result', 'error') if key in job}
+
+    def _write_record(self, job):
+        if self.records is not None:
+            self.records.put('{}.json'.format(job['id']), json.dumps(self._record(job)).encode())
+
+    def _read_record(self, job_id):
+        """Status of a job queued by another process, None if unknown or forgotten."""
+        data = self.records.get('{}.json'.format(job_id)) if self.records is not None else None
+        if data is None:
+            return None
+        record = json.loads(data.decode('utf-8'))
+        now = time.time()
+        if record['finished'] is None and now > record['deadline']:
+            # The owning process times out the job, or it exited meanwhile.
+            record.update(status='timeout', error='Not finished within {} s.'.format(self.timeout))
+        elif record['finished'] is not None and now - record['finished'] > self.keep_finished:
+            return None
+        return {key: record[key] for key in ('id', 'status', 'result', 'error') if key in record}
+
+    def _expire(self):
+        """Time out overdue jobs and forget old finished ones, called with the lock held."""
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job['finished'] is None and now > job['deadline']:
+                if job['future'] is not None:
+                    job['future'].cancel()
+                job.update(status='timeout', error='Not finished within {} s.'.format(self.timeout),
+                           finished=now)
+                self._pending -= 1
+                self._write_record(job)
+                job['event'].set()
+            elif job['finished'] is not None and now - job['finished'] > self.keep_finished:
+                del self._jobs[job_id]
@@ -20,7 +20,7 @@ def yolo_head(feats, anchors, num_classes):
     """
     num_anchors = len(anchors)
     # Reshape to batch, height, width, num_anchors, box_params.
-    anchors_tensor = K.reshape(K.variable(anchors), [1, 1, 1, num_anchors, 2])
+    anchors_tensor = K.reshape(K.constant(anchors), [1, 1, 1, num_anchors, 2])
 
     # Static implementation for fixed models.
     # TODO: Remove or add option for static implementation.
@@ -29,23 +29,17 @@ def yolo_head(feats, anchors, num_classes):
 
     # Dynamic implementation of conv dims for fully convolutional model.
     conv_dims = K.shape(feats)[1:3]  # assuming channels last
-    # In YOLO the height index is the inner most iteration.
-    conv_height_index = K.arange(0, stop=conv_dims[0])
-    conv_width_index = K.arange(0, stop=conv_dims[1])
-    conv_height_index = K.tile(conv_height_index, [conv_dims[1]])
-
-    # TODO: Repeat_elements and tf.split doesn't support dynamic splits.
-    # conv_width_index = K.repeat_elements(conv_width_index, conv_dims[1], axis=0)
-    conv_width_index = K.tile(
-        K.expand_dims(conv_width_index, 0), [conv_dims[0], 1])
-    conv_width_index = K.flatten(K.transpose(conv_width_index))
-    conv_index = K.transpose(K.stack([conv_height_index, conv_width_index]))
+    # Offset of every grid cell as (x, y) = (column, row), also for non-square grids.
+    conv_height_index = K.tile(K.expand_dims(K.arange(0, stop=conv_dims[0]), 1), [1, conv_dims[1]])
+    conv_width_index = K.tile(K.expand_dims(K.arange(0, stop=conv_dims[1]), 0), [conv_dims[0], 1])
+    conv_index = K.stack([conv_width_index, conv_height_index], axis=-1)
     conv_index = K.reshape(conv_index, [1, conv_dims[0], conv_dims[1], 1, 2])
     conv_index = K.cast(conv_index, K.dtype(feats))
 
     feats = K.reshape(
         feats, [-1, conv_dims[0], conv_dims[1], num_anchors, num_classes + 5])
-    conv_dims = K.cast(K.reshape(conv_dims, [1, 1, 1, 1, 2]), K.dtype(feats))
+    # Boxes are (x, y, w, h), so divide by (width, height).
+    conv_dims = K.cast(K.reshape(K.reverse(conv_dims, 0), [1, 1, 1, 1, 2]), K.dtype(feats))
 
     box_xy = K.sigmoid(feats[..., :2])
     box_wh = K.exp(feats[..., 2:4])
@@ -53,7 +47,6 @@ def yolo_head(feats, anchors, num_classes):
     box_class_probs = K.softmax(feats[..., 5:])
 
     # Adjust preditions to each spatial grid point and anchor size.
-    # Note: YOLO iterates over height index before width index.
     box_xy = (box_xy + conv_index) / conv_dims
     box_wh = box_wh * anchors_tensor / conv_dims
 
@@ -73,8 +66,14 @@ def yolo_boxes_to_corners(box_xy, box_wh):
     ])
 
 
-def yolo_filter_boxes(boxes, box_confidence, box_class_probs, threshold=.6):
-    """Filter YOLO boxes based on object and class confidence."""
+def yolo_filter_boxes(boxes, box_confidence, box_class_probs, threshold=.6, class_mask=None):
+    """Filter YOLO boxes based on object and class confidence.
+
+    class_mask, if given, is multiplied with the class probabilities (1 keeps
+    a class, 0 drops it) before the best class is picked and thresholded.
+    """
+    if class_mask is not None:
+        box_class_probs = box_class_probs * class_mask
     box_scores = box_confidence * box_class_probs
     box_classes = K.argmax(box_scores, axis=-1)
     box_class_scores = K.max(box_scores, axis=-1)
@@ -91,12 +90,20 @@ def yolo_eval(yolo_outputs,
               image_shape,
               max_boxes=10,
               score_threshold=.6,
-              iou_threshold=.5):
-    """Evaluate YOLO model on given input batch and return filtered boxes."""
+              iou_threshold=.5,
+              class_mask=None,
+              per_class=True):
+    """Evaluate YOLO model on given input batch and return filtered boxes.
+
+    max_boxes, score_threshold, iou_threshold and class_mask may be Python
+    values or tensors (e.g. placeholders fed at run time). With per_class,
+    boxes of different classes never suppress each other, still in a single
+    NMS op.
+    """
     box_xy, box_wh, box_confidence, box_class_probs = yolo_outputs
     boxes = yolo_boxes_to_corners(box_xy, box_wh)
     boxes, scores, classes = yolo_filter_boxes(
-        boxes, box_confidence, box_class_probs, threshold=score_threshold)
+        boxes, box_confidence, box_class_probs, threshold=score_threshold, class_mask=class_mask)
 
     # Scale boxes back to original image shape.
     height = image_shape[0]
@@ -105,11 +112,13 @@ def yolo_eval(yolo_outputs,
     image_dims = K.reshape(image_dims, [1, 4])
     boxes = boxes * image_dims
 
-    # TODO: Something must be done about this ugly hack!
-    max_boxes_tensor = K.variable(max_boxes, dtype='int32')
-    K.get_session().run(tf.variables_initializer([max_boxes_tensor]))
+    nms_boxes = boxes
+    if per_class:
+        # Move every class to its own region, boxes of different classes never overlap.
+        offsets = K.cast(classes, K.dtype(boxes)) * (K.max(boxes) - K.min(boxes) + 1.)
+        nms_boxes = boxes + K.expand_dims(offsets, -1)
     nms_index = tf.image.non_max_suppression(
-        boxes, scores, max_boxes_tensor, iou_threshold=iou_threshold)
+        nms_boxes, scores, max_boxes, iou_threshold=iou_threshold)
     boxes = K.gather(boxes, nms_index)
     scores = K.gather(scores, nms_index)
     classes = K.gather(classes, nms_index)
@@ -0,0 +1,168 @@
+"""Lightweight in-process metrics rendered in Prometheus text format."""
+
+import bisect
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+
+    type_name = 'counter'
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self._value = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.):
+        """Increase counter by amount."""
+        with self._lock:
+            self._value += amount
+
+    def samples(self):
+        return [(self.name + '_total', self.labels, self._value)]
+
+
+class Gauge(object):
+    """Value read from a callback when metrics are rendered."""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, function, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.function = function
+
+    def samples(self):
+        return [(self.name, self.labels, float(self.function()))]
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one value."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observe duration of the with block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = dict(self.labels, le='+Inf' if bound == float('inf') else repr(bound))
+            samples.append((self.name + '_bucket', labels, cumulative))
+        samples.append((self.name + '_sum', self.labels, total))
+        samples.append((self.name + '_count', self.labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """Collection of metrics, one instance per name and label set."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, labels=labels, **kwargs)
+                self._help.setdefault(name, (documentation, cls.type_name))
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric {} is already registered as {}'.format(name, metric.type_name))
+        return metric
+
+    def counter(self, name, documentation, labels=None):
+        """Get or create counter."""
+        return self._get(Counter, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=None, buckets=DEFAULT_BUCKETS):
+        """Get or create histogram."""
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def gauge(self, name, documentation, function, labels=None):
+        """Get or create gauge reading its value from function."""
+        return self._get(Gauge, name, documentation, labels, function=function)
+
+    def render(self):
+        """Render all metrics in Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+            help_texts = dict(self._help)
+        lines = []
+        last_name = None
+        for (name, _), metric in metrics:
+            if name != last_name:
+                documentation, type_name = help_texts[name]
+                lines.append('# HELP {} {}'.format(name, documentation))
+                lines.append('# TYPE {} {}'.format(name, type_name))
+                last_name = name
+            for sample_name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(sample_name, _format_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def stage_timer(stage, registry=REGISTRY):
+    """Time a processing stage into the detapp_stage_seconds histogram.
+
+    :param stage: stage name.
+    :param registry: metrics registry.
+    :return: context manager.
+    """
+    return registry.histogram('detapp_stage_seconds', 'Time spent in each processing stage.',
+                              labels={'stage': stage}).time()
+
+
+def count_request(endpoint, num_detections, registry=REGISTRY):
+    """Count served image and its number of detections.
+
+    :param endpoint: name of serving endpoint.
+    :param num_detections: number of returned boxes.
+    :param registry: metrics registry.
+    """
+    registry.counter('detapp_requests', 'Served detection requests.', labels={'endpoint': endpoint}).inc()
+    registry.histogram('detapp_detections_per_image', 'Returned boxes per image.',
+                       buckets=COUNT_BUCKETS).observe(num_detections)
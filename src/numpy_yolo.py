@@ -0,0 +1,184 @@
+"""YOLO_v2 post-processing implemented in NumPy.
+
+Mirrors the graph ops in keras_yolo, but works on the raw output of the last
+convolutional layer fetched from the session.
+"""
+
+import functools
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=16)
+def yolo_grid(conv_height, conv_width, anchors_key):
+    """Precompute grid offsets and anchor sizes for one conv resolution.
+
+    :param conv_height: conv layer height.
+    :param conv_width: conv layer width.
+    :param anchors_key: anchors as tuple of (width, height) pairs.
+    :return:    conv_index: x, y offset of every grid cell, shape (1, H, W, 1, 2).
+
+                conv_dims: conv layer (width, height), shape (1, 1, 1, 1, 2).
+
+                anchors_table: anchors divided by conv dims, shape (1, 1, 1, num_anchors, 2).
+    """
+    conv_x, conv_y = np.meshgrid(np.arange(conv_width), np.arange(conv_height))
+    conv_index = np.stack([conv_x, conv_y], axis=-1).reshape(1, conv_height, conv_width, 1, 2).astype('float32')
+    conv_dims = np.array([conv_width, conv_height], dtype='float32').reshape(1, 1, 1, 1, 2)
+    anchors_table = np.array(anchors_key, dtype='float32').reshape(1, 1, 1, -1, 2) / conv_dims
+    return conv_index, conv_dims, anchors_table
+
+
+def sigmoid(x):
+    """Elementwise logistic function."""
+    with np.errstate(over='ignore'):
+        return 1. / (1. + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    """Softmax along axis."""
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def yolo_head(feats, anchors, num_classes):
+    """Convert final layer features to bounding box parameters.
+
+    :param feats: final convolutional layer features, shape (batch, H, W, num_anchors * (num_classes + 5)).
+    :param anchors: anchor box widths and heights.
+    :param num_classes: number of target classes.
+    :return: box_xy, box_wh, box_confidence, box_class_probs as in keras_yolo.yolo_head.
+    """
+    batch_size, conv_height, conv_width = feats.shape[:3]
+    conv_index, conv_dims, anchors_table = yolo_grid(conv_height, conv_width, tuple(map(tuple, anchors)))
+    feats = feats.reshape(batch_size, conv_height, conv_width, len(anchors), num_classes + 5)
+
+    box_xy = (sigmoid(feats[..., :2]) + conv_index) / conv_dims
+    box_wh = np.exp(feats[..., 2:4]) * anchors_table
+    box_confidence = sigmoid(feats[..., 4:5])
+    box_class_probs = softmax(feats[..., 5:])
+    return box_xy, box_wh, box_confidence, box_class_probs
+
+
+def yolo_boxes_to_corners(box_xy, box_wh):
+    """Convert YOLO box predictions to bounding box corners."""
+    box_mins = box_xy - (box_wh / 2.)
+    box_maxes = box_xy + (box_wh / 2.)
+    return np.concatenate([box_mins[..., ::-1], box_maxes[..., ::-1]], axis=-1)
+
+
+def yolo_candidates(yolo_outputs, score_floor=0.):
+    """Keep every box of every image that can pass score_floor.
+
+    :param yolo_outputs: yolo_head outputs for a batch of images.
+    :param score_floor: lowest confidence threshold that will be applied.
+    :return: list of (boxes, box_scores) candidates, one per image.
+    """
+    box_xy, box_wh, box_confidence, box_class_probs = yolo_outputs
+    batch_size, num_classes = box_xy.shape[0], box_class_probs.shape[-1]
+    boxes = yolo_boxes_to_corners(box_xy, box_wh).reshape(batch_size, -1, 4)
+    box_scores = (box_confidence * box_class_probs).reshape(batch_size, -1, num_classes)
+    masks = np.max(box_scores, axis=-1) >= score_floor
+    return [(b[mask], s[mask]) for b, s, mask in zip(boxes, box_scores, masks)]
+
+
+def box_iou_matrix(boxes1, boxes2):
+    """Compute IoU between every pair of boxes.
+
+    :param boxes1: box corners (y_min, x_min, y_max, x_max) with shape (N, 4).
+    :param boxes2: box corners with shape (M, 4).
+    :return: IoU values with shape (N, M).
+    """
+    mins1 = np.minimum(boxes1[:, None, :2], boxes1[:, None, 2:])
+    maxes1 = np.maximum(boxes1[:, None, :2], boxes1[:, None, 2:])
+    mins2 = np.minimum(boxes2[None, :, :2], boxes2[None, :, 2:])
+    maxes2 = np.maximum(boxes2[None, :, :2], boxes2[None, :, 2:])
+
+    intersect_wh = np.maximum(np.minimum(maxes1, maxes2) - np.maximum(mins1, mins2), 0.)
+    intersect_area = intersect_wh[..., 0] * intersect_wh[..., 1]
+    areas1 = np.prod(maxes1 - mins1, axis=-1)
+    areas2 = np.prod(maxes2 - mins2, axis=-1)
+    union_area = areas1 + areas2 - intersect_area
+    # Degenerate boxes never overlap, same as tf.image.non_max_suppression.
+    valid = (areas1 > 0) & (areas2 > 0)
+    return np.where(valid, intersect_area / np.where(valid, union_area, 1.), 0.)
+
+
+def non_max_suppression(boxes, scores, max_boxes=10, iou_threshold=.5):
+    """Greedily select boxes with the highest score, pruning overlapping ones.
+
+    :param boxes: box corners with shape (N, 4).
+    :param scores: box scores with shape (N,).
+    :param max_boxes: maximum number of selected boxes.
+    :param iou_threshold: boxes overlapping more than this are suppressed.
+    :return: indices of selected boxes.
+    """
+    order = np.argsort(-scores, kind='stable')
+    overlaps = box_iou_matrix(boxes[order], boxes[order]) > iou_threshold
+    remaining = np.ones(len(order), dtype=bool)
+    keep = []
+    while len(keep) < max_boxes and remaining.any():
+        i = np.argmax(remaining)
+        keep.append(order[i])
+        remaining &= ~overlaps[i]
+        remaining[i] = False
+    return np.array(keep, dtype='int32')
+
+
+def yolo_filter_boxes(boxes, box_scores, threshold=.6, class_ids=None):
+    """Filter boxes based on the best class score.
+
+    :param boxes: box corners with shape (N, 4).
+    :param box_scores: box confidence times class probabilities with shape (N, num_classes).
+    :param threshold: minimum confidence threshold.
+    :param class_ids: indices of classes to keep, None keeps every class.
+    :return: boxes, scores, classes.
+    """
+    if class_ids is not None:
+        # Other classes never compete for the best class, nor reach NMS.
+        class_ids = np.asarray(class_ids, dtype='int64')
+        box_scores = box_scores[:, class_ids]
+    box_classes = np.argmax(box_scores, axis=-1)
+    if class_ids is not None:
+        box_classes = class_ids[box_classes]
+    box_class_scores = np.max(box_scores, axis=-1)
+    prediction_mask = box_class_scores >= threshold
+    return boxes[prediction_mask], box_class_scores[prediction_mask], box_classes[prediction_mask]
+
+
+def yolo_eval_candidates(boxes, box_scores, image_shape, max_boxes=10, score_threshold=.6, iou_threshold=.5,
+                         class_ids=None, per_class=True):
+    """Filter candidate boxes and scale them back to original image shape.
+
+    :param boxes: normalized box corners with shape (N, 4).
+    :param box_scores: box confidence times class probabilities with shape (N, num_classes).
+    :param image_shape: original image (height, width).
+    :param max_boxes: maximum number of returned boxes.
+    :param score_threshold: minimum confidence threshold.
+    :param iou_threshold: NMS overlap threshold.
+    :param class_ids: indices of classes to detect, None detects every class.
+    :param per_class: only suppress overlapping boxes of the same class, False suppresses across classes.
+    :return: boxes, scores, classes.
+    """
+    boxes, scores, classes = yolo_filter_boxes(boxes, box_scores, threshold=score_threshold, class_ids=class_ids)
+
+    height, width = image_shape
+    boxes = boxes * np.array([height, width, height, width], dtype=boxes.dtype)
+
+    nms_boxes = boxes
+    if per_class and len(boxes):
+        # Move every class to its own region, so a single NMS pass never compares classes.
+        nms_boxes = boxes + (classes * (boxes.max() - boxes.min() + 1.))[:, None].astype(boxes.dtype)
+    nms_index = non_max_suppression(nms_boxes, scores, max_boxes, iou_threshold=iou_threshold)
+    return boxes[nms_index], scores[nms_index], classes[nms_index]
+
+
+def yolo_eval(yolo_outputs, image_shape, max_boxes=10, score_threshold=.6, iou_threshold=.5, class_ids=None,
+              per_class=True):
+    """Evaluate YOLO outputs and return filtered boxes, same as keras_yolo.yolo_eval."""
+    box_xy, box_wh, box_confidence, box_class_probs = yolo_outputs
+    boxes = yolo_boxes_to_corners(box_xy, box_wh).reshape(-1, 4)
+    box_scores = (box_confidence * box_class_probs).reshape(-1, box_class_probs.shape[-1])
+    return yolo_eval_candidates(boxes, box_scores, image_shape, max_boxes=max_boxes,
+                                score_threshold=score_threshold, iou_threshold=iou_threshold, class_ids=class_ids,
+                                per_class=per_class)
@@ -0,0 +1,110 @@
+"""Reduced-precision weights for frozen detection graphs."""
+
+import json
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+
+WEIGHTS_DTYPES = ('float32', 'float16', 'int8')
+
+
+def _const_node(name, value):
+    tensor = tf.make_tensor_proto(value)
+    node = tf.NodeDef()
+    node.op = 'Const'
+    node.name = name
+    node.attr['dtype'].type = tensor.dtype
+    node.attr['value'].tensor.CopyFrom(tensor)
+    return node
+
+
+def _cast_node(name, input_name, src_dtype):
+    node = tf.NodeDef()
+    node.op = 'Cast'
+    node.name = name
+    node.input.append(input_name)
+    node.attr['SrcT'].type = tf.as_dtype(src_dtype).as_datatype_enum
+    node.attr['DstT'].type = tf.float32.as_datatype_enum
+    node.attr['Truncate'].b = False
+    return node
+
+
+def _mul_node(name, x_name, y_name):
+    node = tf.NodeDef()
+    node.op = 'Mul'
+    node.name = name
+    node.input.extend([x_name, y_name])
+    node.attr['T'].type = tf.float32.as_datatype_enum
+    return node
+
+
+def quantize_weights(weights):
+    """Quantize weights to int8 symmetrically per channel of the last axis.
+
+    :param weights: float32 array.
+    :return: int8 values and float32 scale, weights ~= values * scale.
+    """
+    axes = tuple(range(weights.ndim - 1))
+    scale = np.max(np.abs(weights), axis=axes) / 127.
+    scale = np.where(scale > 0, scale, 1.).astype('float32')
+    values = np.clip(np.round(weights / scale), -127, 127).astype('int8')
+    return values, scale
+
+
+def quantize_graph_def(graph_def, weights_dtype, signature_node=None, min_elements=1024):
+    """Store large float32 constants of a frozen graph in reduced precision.
+
+    Each replaced constant keeps its node name on a Cast (float16) or
+    Cast and Mul by per-channel scale (int8) node, so consumers are unchanged
+    and weights are converted back to float32 inside the graph.
+
+    :param graph_def: frozen GraphDef.
+    :param weights_dtype: 'float32', 'float16' or 'int8'.
+    :param signature_node: name of JSON string constant that records weights_dtype.
+    :param min_elements: smaller constants such as anchors and shapes stay float32.
+    :return: new GraphDef.
+    """
+    if weights_dtype not in WEIGHTS_DTYPES:
+        raise ValueError('Unknown weights dtype `{}`, expected one of {}'.format(weights_dtype, WEIGHTS_DTYPES))
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op != 'Const':
+            output.node.extend([node])
+            continue
+        value = tf.make_ndarray(node.attr['value'].tensor)
+        if node.name == signature_node:
+            signature = json.loads(value.item().decode())
+            signature['weights_dtype'] = weights_dtype
+            output.node.extend([_const_node(node.name, json.dumps(signature).encode())])
+        elif weights_dtype == 'float32' or value.dtype != np.float32 or value.size < min_elements:
+            output.node.extend([node])
+        elif weights_dtype == 'float16':
+            output.node.extend([_const_node(node.name + '/float16', value.astype('float16')),
+                                _cast_node(node.name, node.name + '/float16', 'float16')])
+        else:
+            values, scale = quantize_weights(value)
+            output.node.extend([_const_node(node.name + '/int8', values),
+                                _const_node(node.name + '/scale', scale),
+                                _cast_node(node.name + '/dequantize', node.name + '/int8', 'int8'),
+                                _mul_node(node.name, node.name + '/dequantize', node.name + '/scale')])
+    return output
+
+
+def session_config(weights_dtype):
+    """Session config keeping reduced-precision weights in memory.
+
+    Grappler constant folding would convert the weights back to float32
+    constants at the first run; without it they are dequantized on every run,
+    trading a little latency for lower resident memory.
+
+    :param weights_dtype: weights dtype recorded in the graph signature.
+    :return: ConfigProto or None for float32 graphs.
+    """
+    if weights_dtype == 'float32':
+        return None
+    config = tf.ConfigProto()
+    config.graph_options.rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.OFF
+    return config
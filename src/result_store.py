@@ -0,0 +1,148 @@
+"""Network candidates persisted across restarts and shared by worker processes."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from src.metrics import REGISTRY
+
+
+def file_checksum(*paths):
+    """SHA-1 of the contents of one or more files.
+
+    :param paths: paths to files, hashed in order.
+    :return: hex digest.
+    """
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(*paths):
+    """SHA-1 of file sizes and modification times, cheap enough for large models unlike file_checksum.
+
+    It also changes when a file is rewritten with the same content, which only starts filling new rows.
+
+    :param paths: paths to files.
+    :return: hex digest.
+    """
+    sha1 = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        sha1.update('{}:{};'.format(stat.st_size, stat.st_mtime_ns).encode())
+    return sha1.hexdigest()
+
+
+class ResultStore(object):
+    """SQLite store of candidates keyed by image content, model, input size and decode mode.
+
+    Candidates are kept above score_floor, so any threshold at or above it can
+    be applied with numpy_yolo.yolo_eval_candidates. Rows of other models
+    never match, so changing the model only starts filling new rows. Drafted
+    and full JPEG decodes give slightly different inputs and are kept apart.
+    Every thread uses its own connection and WAL mode lets processes read
+    while another one writes. The oldest rows beyond max_entries are dropped.
+    Pickled copies, e.g. sent to job processes, open their own connections
+    and count lookups in the default registry.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, db_path, model_checksum, score_floor=0., max_entries=100000, metrics=REGISTRY):
+        """Open or create store.
+
+        :param db_path: path to SQLite database file.
+        :param model_checksum: fingerprint of model, anchors and classes files, see file_fingerprint.
+        :param score_floor: lowest confidence threshold that will be applied.
+        :param max_entries: maximum number of stored results.
+        :param metrics: registry for lookup counts.
+        """
+        self.db_path = db_path
+        self.model_checksum = model_checksum
+        self.score_floor = score_floor
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._puts = 0
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS candidates ('
+                               'image_sha1 TEXT, model TEXT, height INTEGER, width INTEGER, draft INTEGER, '
+                               'score_floor REAL, num_classes INTEGER, boxes BLOB, box_scores BLOB, '
+                               'PRIMARY KEY (image_sha1, model, height, width, draft))')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_local', '_lock', 'metrics'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.metrics = REGISTRY
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30.)
+            # Commits are not synced to disk, a crash loses at most recent results, never consistency.
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, image_sha1, image_size, draft=False):
+        """Stored candidates of an image.
+
+        :param image_sha1: SHA-1 of the encoded image.
+        :param image_size: model image size.
+        :param draft: whether the JPEG is decoded at reduced size, see preprocess_image.
+        :return: (boxes, box_scores) candidates or None.
+        """
+        row = self._connection().execute(
+            'SELECT num_classes, boxes, box_scores FROM candidates '
+            'WHERE image_sha1 = ? AND model = ? AND height = ? AND width = ? AND draft = ? AND score_floor <= ?',
+            (image_sha1, self.model_checksum, int(image_size[0]), int(image_size[1]), int(draft),
+             self.score_floor)).fetchone()
+        self.metrics.counter('detapp_result_store', 'Result store lookups.',
+                             labels={'result': 'miss' if row is None else 'hit'}).inc()
+        if row is None:
+            return None
+        num_classes, boxes, box_scores = row
+        return (np.frombuffer(boxes, dtype='float32').reshape(-1, 4),
+                np.frombuffer(box_scores, dtype='float32').reshape(-1, num_classes))
+
+    def put(self, image_sha1, image_size, candidates, draft=False):
+        """Store candidates of an image.
+
+        :param image_sha1: SHA-1 of the encoded image.
+        :param image_size: model image size.
+        :param candidates: (boxes, box_scores) candidates at or above score_floor.
+        :param draft: whether the JPEG was decoded at reduced size, see preprocess_image.
+        """
+        boxes, box_scores = candidates
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % self.PRUNE_EVERY == 0
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (image_sha1, self.model_checksum, int(image_size[0]), int(image_size[1]),
+                                int(draft), self.score_floor, box_scores.shape[-1],
+                                np.ascontiguousarray(boxes, dtype='float32').tobytes(),
+                                np.ascontiguousarray(box_scores, dtype='float32').tobytes()))
+            if prune:
+                connection.execute('DELETE FROM candidates WHERE rowid <= (SELECT MAX(rowid) FROM candidates) - ?',
+                                   (self.max_entries,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM candidates').fetchone()[0]
@@ -0,0 +1,123 @@
+"""Preprocessed images stored as memory-mapped .npy files."""
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from src.cache import LRUCache
+from src.yolo_utils import get_image
+
+
+class TensorStore(object):
+    """Store of preprocessed model inputs keyed by image content.
+
+    Every image is preprocessed once into '<sha1>_<height>x<width>.npy' and
+    read back as a read-only memory map, so workers share the page cache
+    instead of decoding JPEGs. An index maps image paths to their mtime and
+    hash; a changed mtime makes the image hashed and processed again. Use the
+    same draft setting as the decode it stands in for, so both give the same
+    inputs and detections.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, store_dir, model_image_size, resample=Image.BICUBIC, draft=False, max_open=256):
+        """Open or create store.
+
+        :param store_dir: directory with .npy files and index.
+        :param model_image_size: model image size, must be fixed.
+        :param resample: PIL resampling filter.
+        :param draft: decode JPEGs at reduced size, see preprocess_image.
+        :param max_open: maximum number of memory maps kept open.
+        """
+        if tuple(model_image_size) == (None, None):
+            raise ValueError('Tensor store requires a fixed model image size.')
+        self.store_dir = store_dir
+        self.model_image_size = tuple(model_image_size)
+        self.resample = resample
+        self.draft = draft
+        self._maps = LRUCache(max_open)
+        self._lock = threading.Lock()
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self._index = self._read_index()
+
+    def get(self, image_path):
+        """Get preprocessed image, processing it first if it is new or changed.
+
+        :param image_path: path to image.
+        :return: read-only float32 array of shape (1, height, width, 3).
+        """
+        mtime = os.path.getmtime(image_path)
+        entry = self._index.get(image_path)
+        if entry is None or entry['mtime'] != mtime:
+            entry = self._add(image_path, mtime)
+        image_data = self._maps.get(entry['sha1'])
+        if image_data is None:
+            try:
+                image_data = np.load(self._tensor_path(entry['sha1']), mmap_mode='r')
+            except IOError:  # Indexed at a different model image size or draft setting.
+                entry = self._add(image_path, mtime)
+                image_data = np.load(self._tensor_path(entry['sha1']), mmap_mode='r')
+            self._maps.put(entry['sha1'], image_data)
+        return image_data
+
+    def build(self, image_paths):
+        """Preprocess every new or changed image.
+
+        :param image_paths: paths to images.
+        :return: number of processed images.
+        """
+        count = 0
+        for image_path in image_paths:
+            mtime = os.path.getmtime(image_path)
+            entry = self._index.get(image_path)
+            if entry is None or entry['mtime'] != mtime:
+                self._add(image_path, mtime, save_index=False)
+                count += 1
+        if count:
+            with self._lock:
+                self._write_index()
+        return count
+
+    def _tensor_path(self, sha1):
+        return os.path.join(self.store_dir, '{}_{}x{}{}.npy'.format(sha1, self.model_image_size[0],
+                                                                   self.model_image_size[1],
+                                                                   '_draft' if self.draft else ''))
+
+    def _add(self, image_path, mtime, save_index=True):
+        with open(image_path, 'rb') as f:
+            sha1 = hashlib.sha1(f.read()).hexdigest()
+        tensor_path = self._tensor_path(sha1)
+        if not os.path.exists(tensor_path):
+            image_data, _ = get_image(os.path.basename(image_path), os.path.dirname(image_path),
+                                      self.model_image_size, resample=self.resample, draft=self.draft)
+            tmp_path = '{}.{}.{}.tmp'.format(tensor_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, image_data)
+            os.replace(tmp_path, tensor_path)
+
+        entry = {'mtime': mtime, 'sha1': sha1}
+        with self._lock:
+            self._index[image_path] = entry
+            if save_index:
+                self._write_index()
+        return entry
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.store_dir, self.INDEX_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self):
+        path = os.path.join(self.store_dir, self.INDEX_FILE)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,138 @@
+"""Tiled detection of large images."""
+
+import math
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+from src.yolo_utils import preprocess_image
+
+
+class Tiler(object):
+    """Cuts large images into overlapping tiles run as one batch.
+
+    Tile detections are mapped back to normalized full image coordinates, so
+    they can be merged with the per-class NMS of yolo_eval_candidates. When
+    an image needs more than max_tiles tiles, tiles grow until it fits, so
+    the cost of one image stays bounded.
+    """
+
+    def __init__(self, tile_size=608, overlap=.2, max_tiles=16, full_image=True, resample=Image.BICUBIC):
+        """
+        :param tile_size: tile width and height in image pixels.
+        :param overlap: fraction of tile size shared by neighbouring tiles.
+        :param max_tiles: maximum number of tiles per image, including the full image.
+        :param full_image: also detect on the whole image, which keeps objects larger than a tile.
+        :param resample: PIL resampling filter.
+        """
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1), got {}'.format(overlap))
+        if max_tiles < 1:
+            raise ValueError('max_tiles must be positive, got {}'.format(max_tiles))
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self.full_image = full_image
+        self.resample = resample
+
+    def _starts(self, length, tile_size):
+        if length <= tile_size:
+            return [0], length
+        count = int(math.ceil((length - tile_size) / (tile_size * (1. - self.overlap)))) + 1
+        return np.linspace(0, length - tile_size, count).round().astype(int).tolist(), tile_size
+
+    def tiles(self, width, height):
+        """Tile positions covering an image.
+
+        :param width: image width.
+        :param height: image height.
+        :return: list of (left, top, right, bottom) in pixels.
+        """
+        tile_size = self.tile_size
+        while True:
+            xs, tile_width = self._starts(width, tile_size)
+            ys, tile_height = self._starts(height, tile_size)
+            count = len(xs) * len(ys)
+            if count == 1 or count + self.full_image <= self.max_tiles:
+                break
+            tile_size = int(math.ceil(tile_size * 1.25))
+        tiles = [(x, y, x + tile_width, y + tile_height) for y in ys for x in xs]
+        if self.full_image and count > 1:
+            tiles.append((0, 0, width, height))
+        return tiles
+
+    def prepare(self, image, model_image_size):
+        """Cut and preprocess tiles of an image.
+
+        :param image: RGB image.
+        :param model_image_size: model image size.
+        :return: tile positions and preprocessed tiles batch.
+        """
+        tiles = self.tiles(*image.size)
+        batch = np.empty((len(tiles),) + tuple(model_image_size) + (3,), dtype='float32')
+        for i, tile in enumerate(tiles):
+            preprocess_image(image.crop(tile), model_image_size, resample=self.resample, out=batch[i:i + 1])
+        return tiles, batch
+
+    @staticmethod
+    def merge(tiles, image_size, results):
+        """Map candidates of every tile to normalized full image coordinates.
+
+        :param tiles: tile positions.
+        :param image_size: image (width, height).
+        :param results: (boxes, box_scores) candidates of every tile.
+        :return: boxes and box scores of all tiles.
+        """
+        width, height = image_size
+        all_boxes, all_scores = [], []
+        for (left, top, right, bottom), (boxes, box_scores) in zip(tiles, results):
+            scale = np.array([bottom - top, right - left] * 2, dtype='float32') / [height, width, height, width]
+            offset = np.array([top, left] * 2, dtype='float32') / [height, width, height, width]
+            all_boxes.append(boxes * scale.astype('float32') + offset.astype('float32'))
+            all_scores.append(box_scores)
+        return np.concatenate(all_boxes).astype('float32'), np.concatenate(all_scores)
+
+    def candidates(self, image, model_image_size, run_batch):
+        """Detect on tiles of an image in one batch.
+
+        :param image: RGB image.
+        :param model_image_size: model image size.
+        :param run_batch: function from image batch to list of candidates,
+                          e.g. partial(detector.candidates_batch, score_floor=.2).
+        :return: boxes and box scores in normalized full image coordinates.
+        """
+        tiles, batch = self.prepare(image, model_image_size)
+        return self.merge(tiles, image.size, run_batch(batch))
+
+    def submit(self, scheduler, image, model_image_size):
+        """Queue tiles of an image on a BatchScheduler.
+
+        Tiles join the batches of concurrent requests like any other image.
+
+        :param scheduler: BatchScheduler.
+        :param image: RGB image.
+        :param model_image_size: model image size.
+        :return: future of boxes and box scores in normalized full image coordinates.
+        """
+        tiles, batch = self.prepare(image, model_image_size)
+        futures = [scheduler.submit(batch[i:i + 1]) for i in range(len(tiles))]
+        merged = Future()
+        merged.set_running_or_notify_cancel()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                merged.set_result(self.merge(tiles, image.size, [future.result() for future in futures]))
+            except Exception as e:
+                merged.set_exception(e)
+
+        for future in futures:
+            future.add_done_callback(done)
+        return merged
@@ -0,0 +1,106 @@
+"""Box tracking and interpolation between detected keyframes."""
+
+import numpy as np
+
+from src.numpy_yolo import box_iou_matrix
+
+
+def match_boxes(boxes1, classes1, boxes2, classes2, match_iou=.3):
+    """Greedily pair boxes of the same class by highest IoU.
+
+    :param boxes1: box corners with shape (N, 4).
+    :param classes1: classes with shape (N,).
+    :param boxes2: box corners with shape (M, 4).
+    :param classes2: classes with shape (M,).
+    :param match_iou: minimum IoU of a pair.
+    :return: list of (i, j) index pairs.
+    """
+    if not len(boxes1) or not len(boxes2):
+        return []
+    iou = box_iou_matrix(np.asarray(boxes1, dtype='float32'), np.asarray(boxes2, dtype='float32'))
+    iou[np.asarray(classes1)[:, None] != np.asarray(classes2)[None, :]] = 0.
+    pairs = []
+    while iou.max() >= match_iou:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        pairs.append((i, j))
+        iou[i, :] = 0.
+        iou[:, j] = 0.
+    return pairs
+
+
+class KeyframeTracker(object):
+    """Track ids for detections of consecutive keyframes.
+
+    A box takes the id of the box of the same class it overlaps most in the
+    previous keyframe, unmatched boxes start new tracks.
+    """
+
+    def __init__(self, match_iou=.3):
+        """
+        :param match_iou: minimum IoU of boxes in consecutive keyframes to continue a track.
+        """
+        self.match_iou = match_iou
+        self.previous = None
+        self.next_id = 0
+
+    def update(self, boxes, scores, classes):
+        """Assign track ids to detections of the next keyframe.
+
+        :param boxes: box corners with shape (N, 4).
+        :param scores: confidence scores with shape (N,).
+        :param classes: classes with shape (N,).
+        :return: detections dict with boxes, scores, classes and track_ids arrays.
+        """
+        track_ids = np.full(len(boxes), -1, dtype='int64')
+        if self.previous is not None:
+            for i, j in match_boxes(self.previous['boxes'], self.previous['classes'], boxes, classes,
+                                    self.match_iou):
+                track_ids[j] = self.previous['track_ids'][i]
+        new_tracks = track_ids < 0
+        track_ids[new_tracks] = np.arange(self.next_id, self.next_id + new_tracks.sum())
+        self.next_id += int(new_tracks.sum())
+        self.previous = {'boxes': np.asarray(boxes, dtype='float32').reshape(-1, 4),
+                         'scores': np.asarray(scores, dtype='float32'),
+                         'classes': np.asarray(classes, dtype='int32'),
+                         'track_ids': track_ids}
+        return self.previous
+
+
+def interpolate_detections(start, end, t):
+    """Detections of a frame between two keyframes.
+
+    Boxes of tracks present in both keyframes move linearly, tracks only in
+    the start keyframe last until half way and tracks only in the end
+    keyframe appear from half way.
+
+    :param start: detections of the earlier keyframe, see KeyframeTracker.update.
+    :param end: detections of the later keyframe.
+    :param t: position between keyframes, 0 is start and 1 is end.
+    :return: detections dict of the frame.
+    """
+    end_index = {track_id: j for j, track_id in enumerate(end['track_ids'])}
+    start_ids = set(start['track_ids'].tolist())
+    boxes, scores, classes, track_ids = [], [], [], []
+    for i, track_id in enumerate(start['track_ids']):
+        j = end_index.get(track_id)
+        if j is not None:
+            boxes.append((1. - t) * start['boxes'][i] + t * end['boxes'][j])
+            scores.append((1. - t) * start['scores'][i] + t * end['scores'][j])
+        elif t < .5:
+            boxes.append(start['boxes'][i])
+            scores.append(start['scores'][i])
+        else:
+            continue
+        classes.append(start['classes'][i])
+        track_ids.append(track_id)
+    if t >= .5:
+        for j, track_id in enumerate(end['track_ids']):
+            if track_id not in start_ids:
+                boxes.append(end['boxes'][j])
+                scores.append(end['scores'][j])
+                classes.append(end['classes'][j])
+                track_ids.append(track_id)
+    return {'boxes': np.array(boxes, dtype='float32').reshape(-1, 4),
+            'scores': np.array(scores, dtype='float32'),
+            'classes': np.array(classes, dtype='int32'),
+            'track_ids': np.array(track_ids, dtype='int64')}
@@ -0,0 +1,102 @@
+"""Bounded reading and decoding of uploaded images."""
+
+import io
+import threading
+
+import flask
+from PIL import Image
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """Upload rejected before or during decoding."""
+
+    def __init__(self, message, status=400):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+
+class InMemoryRequest(flask.Request):
+    """Request keeping multipart file parts in memory instead of temporary files.
+
+    Use with MAX_CONTENT_LENGTH set, which bounds the size of a request.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
+class UploadDecoder(object):
+    """Decodes untrusted images with byte, pixel and concurrency limits.
+
+    The byte limit is checked while reading, the pixel limit from the header
+    before any pixel data is decoded. JPEGs are decoded directly at reduced
+    scale close to the requested size. At most max_concurrent images are
+    decoded at once, which bounds the decode memory of concurrent uploads.
+    """
+
+    def __init__(self, max_bytes=20 * 2 ** 20, max_pixels=50 * 10 ** 6, max_concurrent=4, draft=True):
+        """
+        :param max_bytes: maximum encoded size.
+        :param max_pixels: maximum width * height.
+        :param max_concurrent: maximum number of images decoded at once.
+        :param draft: decode JPEGs at reduced size.
+        """
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.draft = draft
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def check_size(self, num_bytes):
+        """Reject uploads larger than max_bytes."""
+        if num_bytes > self.max_bytes:
+            raise UploadError('Image is larger than {} bytes.'.format(self.max_bytes), status=413)
+
+    def read(self, stream):
+        """Read a stream in chunks, stopping as soon as it exceeds max_bytes.
+
+        :param stream: file-like object.
+        :return: read bytes.
+        """
+        data = io.BytesIO()
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return data.getvalue()
+            data.write(chunk)
+            self.check_size(data.tell())
+
+    def open(self, data):
+        """Check limits and read the image header, without decoding pixel data.
+
+        :param data: encoded image.
+        :return: lazily decoded PIL image.
+        """
+        self.check_size(len(data))
+        try:
+            image = Image.open(io.BytesIO(data))
+        except (IOError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise UploadError('Can not decode image: {}'.format(e))
+        if image.size[0] * image.size[1] > self.max_pixels:
+            raise UploadError('Image has more than {} pixels.'.format(self.max_pixels), status=413)
+        return image
+
+    def decode(self, data, image_size=None):
+        """Decode an image.
+
+        :param data: encoded image.
+        :param image_size: (height, width) the image is needed at, None for full size.
+        :return: RGB image, possibly smaller than the original for JPEGs,
+                 and original image (width, height).
+        """
+        image = self.open(data)
+        width, height = image.size
+        try:
+            with self._slots:
+                if self.draft and image_size is not None:
+                    image.draft('RGB', tuple(reversed(image_size)))
+                image = image.convert('RGB')
+        except (IOError, SyntaxError, ValueError) as e:
+            raise UploadError('Can not decode image: {}'.format(e))
+        return image, (width, height)
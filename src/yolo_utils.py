@@ -1,11 +1,15 @@
 import numpy as np
 import colorsys
+import functools
 import random
+import io
 import os
+import threading
 
-from keras import backend as K
 from PIL import ImageFont, ImageDraw, Image
 
+FONT_PATH = 'font/FiraMono-Medium.otf'
+
 
 def get_classes(classes_path):
     """Load classes from file.
@@ -51,6 +55,17 @@ def get_colors_for_classes(classes):
     return colors
 
 
+@functools.lru_cache(maxsize=32)
+def get_font(size, font_path=FONT_PATH):
+    """Load font once per size.
+
+    :param size: font size.
+    :param font_path: path to font file.
+    :return: font.
+    """
+    return ImageFont.truetype(font=font_path, size=int(size))
+
+
 def draw_boxes(image, out_classes, out_boxes, out_scores, classes, colors):
     """Draw boxes on image.
 
@@ -61,89 +76,179 @@ def draw_boxes(image, out_classes, out_boxes, out_scores, classes, colors):
     :param classes: classes names.
     :param colors: colors for boxes.
     """
-    font = ImageFont.truetype(
-        font='font/FiraMono-Medium.otf',
-        size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
+    font = get_font(np.floor(3e-2 * image.size[1] + 0.5))
     thickness = (image.size[0] + image.size[1]) // 300
+    draw = ImageDraw.Draw(image)
 
     for i, c in reversed(list(enumerate(out_classes))):
-        predicted_class = classes[c]
-        box = out_boxes[i]
-        score = out_scores[i]
-
-        label = '{} {:.2f}'.format(predicted_class, score)
-
-        draw = ImageDraw.Draw(image)
+        label = '{} {:.2f}'.format(classes[c], out_scores[i])
         label_size = draw.textsize(label, font)
 
-        top, left, bottom, right = box
-        top = max(0, np.floor(top + 0.5).astype('int32'))
-        left = max(0, np.floor(left + 0.5).astype('int32'))
-        bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-        right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-        print(label, (left, top), (right, bottom))
+        top, left, bottom, right = out_boxes[i]
+        top = max(0, int(np.floor(top + 0.5)))
+        left = max(0, int(np.floor(left + 0.5)))
+        bottom = min(image.size[1], int(np.floor(bottom + 0.5)))
+        right = min(image.size[0], int(np.floor(right + 0.5)))
 
         if top - label_size[1] >= 0:
-            text_origin = np.array([left, top - label_size[1]])
+            text_origin = (left, top - label_size[1])
         else:
-            text_origin = np.array([left, top + 1])
-
-        # My kingdom for a good redistributable image drawing library.
-        for i in range(thickness):
-            draw.rectangle(
-                [left + i, top + i, right - i, bottom - i],
-                outline=colors[c])
-        draw.rectangle(
-            [tuple(text_origin), tuple(text_origin + label_size)],
-            fill=colors[c])
+            text_origin = (left, top + 1)
+
+        if thickness > 0:
+            draw.rectangle([left, top, right, bottom], outline=colors[c], width=thickness)
+        draw.rectangle([text_origin, (text_origin[0] + label_size[0], text_origin[1] + label_size[1])],
+                       fill=colors[c])
         draw.text(text_origin, label, fill=(0, 0, 0), font=font)
-        del draw
 
 
-def get_image(image_name, test_path, model_image_size):
-    """Preprocess image.
+def detections_to_list(out_boxes, out_scores, out_classes, class_names):
+    """Convert detections to JSON serializable list.
+
+    :param out_boxes: boxes positions.
+    :param out_scores: confidence scores.
+    :param out_classes: detected classes.
+    :param class_names: classes names.
+    :return: list of detections with class name, score and box as [top, left, bottom, right] in pixels.
+    """
+    return [{'class': class_names[c],
+             'score': round(float(score), 4),
+             'box': [round(float(x), 2) for x in box]}
+            for box, score, c in zip(out_boxes, out_scores, out_classes)]
+
+
+RESAMPLE_FILTERS = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
+
+_input_buffers = threading.local()
+
+
+def input_buffer(model_image_size):
+    """Get preallocated model input array of the calling thread.
+
+    Each thread keeps one array per model image size. It is overwritten by
+    the next call from the same thread for the same size, so it can only be
+    reused once the previous network run of this thread has finished.
 
-    :param image_name: test image name.
-    :param test_path: path to test image directory.
     :param model_image_size: model image size.
+    :return: float32 array of shape (1, height, width, 3).
+    """
+    shape = (1,) + tuple(model_image_size) + (3,)
+    buffers = getattr(_input_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = _input_buffers.buffers = {}
+    buffer = buffers.get(shape)
+    if buffer is None:
+        buffer = buffers[shape] = np.empty(shape, dtype='float32')
+    return buffer
+
+
+def preprocess_image(image, model_image_size, resample=Image.BICUBIC, draft=False, out=None):
+    """Resize and normalize image for the model.
+
+    :param image: opened image file, not loaded yet if draft is used.
+    :param model_image_size: model image size.
+    :param resample: PIL resampling filter.
+    :param draft: let the JPEG decoder downscale by a power of two when the image is much larger than model input.
+                  The returned image is then the reduced one and boxes are in its coordinates.
+    :param out: preallocated float32 array of shape (1, height, width, 3) to write image_data into.
     :return:    image_data : preprocessed image.
 
                 image : original image.
     """
-    image = Image.open(os.path.join(test_path, image_name))
     is_fixed_size = model_image_size != (None, None)
-    if is_fixed_size:  # TODO: When resizing we can use minibatch input.
-        resized_image = image.resize(
-            tuple(reversed(model_image_size)), Image.BICUBIC)
-        image_data = np.array(resized_image, dtype='float32')
+    if is_fixed_size:
+        new_image_size = tuple(reversed(model_image_size))
+        if draft:
+            image.draft('RGB', new_image_size)
     else:
         # Due to skip connection + max pooling in YOLO_v2, inputs must have
         # width and height as multiples of 32.
         new_image_size = (image.width - (image.width % 32),
                           image.height - (image.height % 32))
-        resized_image = image.resize(new_image_size, Image.BICUBIC)
-        image_data = np.array(resized_image, dtype='float32')
-        print(image_data.shape)
+    if image.mode != 'RGB':  # Grayscale, CMYK and palette images.
+        image = image.convert('RGB')
+    resized_image = np.asarray(image.resize(new_image_size, resample))
+
+    if out is None:
+        out = np.empty((1,) + resized_image.shape, dtype='float32')
+    elif out.shape != (1,) + resized_image.shape:
+        raise ValueError('Input buffer shape {} does not match image shape {}'.format(out.shape,
+                                                                                     resized_image.shape))
+    np.divide(resized_image, np.float32(255.), out=out[0])
+    return out, image
+
+
+def get_image(image_name, test_path, model_image_size, resample=Image.BICUBIC, draft=False, out=None):
+    """Preprocess image.
+
+    :param image_name: test image name.
+    :param test_path: path to test image directory.
+    :param model_image_size: model image size.
+    :param resample: PIL resampling filter.
+    :param draft: decode JPEG at reduced size, see preprocess_image.
+    :param out: preallocated float32 array to write image_data into.
+    :return:    image_data : preprocessed image.
+
+                image : original image.
+    """
+    image = Image.open(os.path.join(test_path, image_name))
+    return preprocess_image(image, model_image_size, resample=resample, draft=draft, out=out)
+
+
+def encode_image(image, quality=90):
+    """Encode image as JPEG in memory.
+
+    :param image: image file.
+    :param quality: JPEG quality.
+    :return: encoded image bytes.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
 
-    image_data /= 255.
-    image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
-    return image_data, image
 
+def save_thumbnail(image_path, thumbnail_path, max_side=640, resample=Image.BICUBIC, quality=85):
+    """Write a downscaled JPEG copy of an image, unless an up to date one exists.
 
-def predict(sess, boxes, scores, classes, yolo_model, image_data, input_image_shape, image, image_file, class_names,
-            colors, output_path):
+    :param image_path: path to image.
+    :param thumbnail_path: path to thumbnail.
+    :param max_side: maximum thumbnail width and height.
+    :param resample: PIL resampling filter.
+    :param quality: JPEG quality.
+    :return: True if the thumbnail was written.
     """
-    Find objects on image.
+    if os.path.exists(thumbnail_path) and os.path.getmtime(thumbnail_path) >= os.path.getmtime(image_path):
+        return False
+    with Image.open(image_path) as image:
+        image.draft('RGB', (max_side, max_side))
+        thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((max_side, max_side), resample)
+    tmp_path = '{}.{}.{}.tmp'.format(thumbnail_path, os.getpid(), threading.get_ident())
+    thumbnail.save(tmp_path, format='JPEG', quality=quality)
+    os.replace(tmp_path, thumbnail_path)
+    return True
+
+
+def save_encoded_image(encoded_image, image_file, output_path):
+    """Write encoded image to output directory.
+
+    The file is written under a temporary name and renamed, so concurrent
+    requests for the same image never see a partially written file.
+
+    :param encoded_image: encoded image bytes.
+    :param image_file: output image name.
+    :param output_path: path to output directory.
     """
-    out_boxes, out_scores, out_classes = sess.run([boxes, scores, classes], feed_dict={yolo_model.input: image_data,
-                                                                                       input_image_shape: [
-                                                                                           image.size[1],
-                                                                                           image.size[0]],
-                                                                                       K.learning_phase(): 0})
-
-    print('Found {} boxes for {}'.format(len(out_boxes), image_file))
-    draw_boxes(image, out_classes, out_boxes, out_scores, class_names, colors)
-    image.save(os.path.join(output_path, image_file), quality=90)
+    path = os.path.join(output_path, image_file)
+    tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded_image)
+    os.replace(tmp_path, path)
 
 
 def create_output_dir(output_dir):
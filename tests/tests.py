@@ -1,13 +1,92 @@
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+import flask
 import numpy as np
 import tensorflow as tf
+from keras import backend as K
+from keras.layers import Conv2D, Input
+from keras.models import Model, load_model
 
-from src.keras_yolo import yolo_eval
-from src.yolo_utils import (get_classes, get_anchors, get_colors_for_classes)
+from src.api import create_api
+from src.batching import BatchScheduler
+from src.cache import DirectoryStore, LRUCache
+from src.detector import INPUT_TENSORS, OUTPUT_TENSORS, SIGNATURE_NODE, YoloDetector
+from src.jobs import JobQueue, JobQueueFull, detect_images, local_executor
+from src import numpy_yolo
+from src.keras_yolo import yolo_eval, yolo_head
+from src.metrics import Registry, stage_timer
+from src.numpy_yolo import non_max_suppression, yolo_eval_candidates
+from src.quantize import quantize_graph_def, quantize_weights
+from src.result_store import ResultStore, file_checksum, file_fingerprint
+from src.tensor_store import TensorStore
+from src.tiling import Tiler
+from src.tracking import KeyframeTracker, interpolate_detections, match_boxes
+from src.uploads import UploadDecoder, UploadError
+import detect_batch
+import detect_video
+import yad2k
+from PIL import Image
+
+from src.yolo_utils import (get_classes, get_anchors, get_colors_for_classes, encode_image, preprocess_image,
+                            get_image, draw_boxes, get_font, save_thumbnail)
+
+
+def toy_model(input_shape=(64, 64, 3)):
+    """Single convolution model with the output layout of YOLO_v2.
+
+    :param input_shape: model input shape.
+    :return: model, anchors and classes names.
+    """
+    anchors = np.array([[0.57273, 0.677385], [1.87446, 2.06253]])
+    class_names = ['person', 'car', 'dog']
+    inputs = Input(shape=input_shape)
+    model = Model(inputs, Conv2D(len(anchors) * (len(class_names) + 5), (32, 32), strides=32)(inputs))
+    return model, anchors, class_names
+
+
+class FakeDetector(object):
+    """Detector finding one car at the same normalized box on every image."""
+
+    def candidates_batch(self, image_batch, score_floor=0.):
+        return [(np.array([[.1, .2, .5, .6]], dtype='float32'), np.array([[.1, .9]], dtype='float32'))
+                for _ in image_batch]
+
+
+def encoded_jpeg(width=200, height=100):
+    """Black JPEG image."""
+    image = io.BytesIO()
+    Image.new('RGB', (width, height)).save(image, format='JPEG')
+    return image.getvalue()
+
+
+def api_client(scheduler, **kwargs):
+    """Test client of an app serving the detection API.
+
+    :param scheduler: BatchScheduler.
+    :param kwargs: keyword arguments of create_api.
+    :return: Flask test client.
+    """
+    app = flask.Flask(__name__)
+    app.register_blueprint(create_api(scheduler, ['person', 'car'], (64, 64), **kwargs))
+    return app.test_client()
 
 
 class TestYOLODetector(unittest.TestCase):
 
+    def fake_scheduler(self, detector=None):
+        """BatchScheduler of a FakeDetector, closed after the test."""
+        scheduler = BatchScheduler(detector or FakeDetector(), score_floor=.2, metrics=Registry())
+        self.addCleanup(scheduler.close)
+        return scheduler
+
     def test_get_classes(self):
         classes_path = '../object-detector-web-app/model_data/coco_classes.txt'
         num_of_classes = 80
@@ -46,6 +125,694 @@ class TestYOLODetector(unittest.TestCase):
             self.assertTrue(str(boxes.eval().shape) == str((10, 4)))
             self.assertTrue(str(classes.eval().shape) == str((10,)))
 
+    def test_detector_reuses_graph(self):
+        model, anchors, class_names = toy_model()
+        detector = YoloDetector(model, anchors, class_names)
+        image_data = np.random.RandomState(0).rand(1, 64, 64, 3).astype('float32')
+
+        boxes, scores, classes = detector.detect(image_data, [128, 256], score_threshold=0., max_boxes=3)
+        num_ops = len(K.get_session().graph.get_operations())
+        self.assertEqual(boxes.shape, (3, 4))
+        boxes, scores, classes = detector.detect(image_data, [128, 256], score_threshold=1., max_boxes=3)
+        self.assertEqual(len(K.get_session().graph.get_operations()), num_ops)
+        self.assertEqual(boxes.shape, (0, 4))
+
+    def test_frozen_graph(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        model, anchors, class_names = toy_model()
+        detector = YoloDetector(model, anchors, class_names)
+        graph_path = os.path.join(test_dir, 'test.pb')
+        with open(graph_path, 'wb') as f:
+            f.write(detector.frozen_graph_def().SerializeToString())
+
+        frozen = YoloDetector.from_frozen_graph(graph_path)
+        self.assertEqual(frozen.class_names, class_names)
+        self.assertEqual(frozen.model_image_size, (64, 64))
+        self.assertFalse(any(op.type.startswith('Variable') for op in frozen.sess.graph.get_operations()))
+        image_data = np.random.RandomState(4).rand(1, 64, 64, 3).astype('float32')
+        for a, b in zip(detector.detect(image_data, [128, 256], score_threshold=.1),
+                        frozen.detect(image_data, [128, 256], score_threshold=.1)):
+            np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+        for a, b in zip(detector.candidates(image_data, score_floor=.1), frozen.candidates(image_data, score_floor=.1)):
+            np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+
+        tensors = {name: name + ':0' for name in INPUT_TENSORS + OUTPUT_TENSORS if name != 'class_mask'}
+        with tf.Graph().as_default() as graph:
+            tf.constant(json.dumps({'tensors': tensors}), name=SIGNATURE_NODE)
+        with open(graph_path, 'wb') as f:
+            f.write(graph.as_graph_def().SerializeToString())
+        with self.assertRaisesRegex(ValueError, 'class_mask'):
+            YoloDetector.from_frozen_graph(graph_path)
+
+    def test_quantized_frozen_graph(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        model, anchors, class_names = toy_model()
+        detector = YoloDetector(model, anchors, class_names)
+        graph_def = detector.frozen_graph_def()
+        image_data = np.random.RandomState(5).rand(1, 64, 64, 3).astype('float32')
+        expected_boxes, expected_scores = detector.candidates(image_data)
+
+        for weights_dtype, tolerance in (('float16', 1e-2), ('int8', 5e-2)):
+            graph_path = os.path.join(test_dir, '{}.pb'.format(weights_dtype))
+            with open(graph_path, 'wb') as f:
+                f.write(quantize_graph_def(graph_def, weights_dtype, signature_node=SIGNATURE_NODE).SerializeToString())
+            self.assertLess(os.path.getsize(graph_path), graph_def.ByteSize())
+            quantized = YoloDetector.from_frozen_graph(graph_path)
+            self.assertIn(weights_dtype, [op.get_attr('dtype').name for op in quantized.sess.graph.get_operations()
+                                          if op.type == 'Const'])
+            boxes, scores = quantized.candidates(image_data)
+            np.testing.assert_allclose(boxes, expected_boxes, atol=tolerance)
+            np.testing.assert_allclose(scores, expected_scores, atol=tolerance)
+
+        values, scale = quantize_weights(np.array([[1., -2.], [.5, 1.]], dtype='float32'))
+        np.testing.assert_allclose(values * scale, [[1., -2.], [.5, 1.]], atol=1e-2)
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertNotIn('a', cache)
+
+    def test_directory_store(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        store = DirectoryStore(test_dir, max_bytes=10)
+        path = store.put('a.jpg', b'abcd')
+        self.assertEqual(DirectoryStore(test_dir).get('a.jpg'), b'abcd')
+        self.assertEqual(store.path('a.jpg'), path)
+        os.utime(path, (0, 0))
+        store.put('b.jpg', b'efgh')
+        store.put('c.jpg', b'ijkl')
+        self.assertNotIn('a.jpg', store)
+        self.assertIn('c.jpg', store)
+        self.assertIsNone(store.get('a.jpg'))
+        self.assertIsNone(store.path('../a.jpg'))
+        self.assertRaises(ValueError, store.put, '../a.jpg', b'')
+
+    def test_non_max_suppression(self):
+        boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [20, 20, 30, 30], [0, 0, 10, 10]], dtype='float32')
+        scores = np.array([.9, .8, .7, .95], dtype='float32')
+        self.assertEqual(non_max_suppression(boxes, scores, iou_threshold=.5).tolist(), [3, 2])
+        self.assertEqual(non_max_suppression(boxes, scores, max_boxes=1).tolist(), [3])
+
+    def test_eval_candidates_matches_detector(self):
+        model, anchors, class_names = toy_model()
+        detector = YoloDetector(model, anchors, class_names)
+        image_data = np.random.RandomState(1).rand(1, 64, 64, 3).astype('float32')
+
+        boxes, box_scores = detector.candidates(image_data, score_floor=.1)
+        for threshold in (.1, .2, .3):
+            expected = detector.detect(image_data, [128, 256], score_threshold=threshold)
+            result = yolo_eval_candidates(boxes, box_scores, [128, 256], score_threshold=threshold)
+            for a, b in zip(expected, result):
+                np.testing.assert_allclose(a, b, rtol=1e-5)
+            expected = detector.detect(image_data, [128, 256], score_threshold=threshold, class_ids=[0, 2])
+            result = yolo_eval_candidates(boxes, box_scores, [128, 256], score_threshold=threshold,
+                                          class_ids=[0, 2])
+            for a, b in zip(expected, result):
+                np.testing.assert_allclose(a, b, rtol=1e-5)
+
+    def test_per_class_non_max_suppression(self):
+        boxes = np.array([[.1, .1, .5, .5], [.1, .1, .5, .5]], dtype='float32')
+        box_scores = np.array([[.9, 0.], [0., .8]], dtype='float32')
+        _, _, classes = yolo_eval_candidates(boxes, box_scores, [100, 100], score_threshold=.5, per_class=False)
+        self.assertEqual(classes.tolist(), [0])
+        _, _, classes = yolo_eval_candidates(boxes, box_scores, [100, 100], score_threshold=.5)
+        self.assertEqual(classes.tolist(), [0, 1])
+
+    def test_class_subset(self):
+        boxes = np.array([[.1, .1, .5, .5], [.6, .6, .9, .9]], dtype='float32')
+        box_scores = np.array([[.9, .7, 0.], [.1, .2, .8]], dtype='float32')
+        _, scores, classes = yolo_eval_candidates(boxes, box_scores, [100, 100], score_threshold=.5,
+                                                  class_ids=[1, 2])
+        self.assertEqual(classes.tolist(), [2, 1])
+        np.testing.assert_allclose(scores, [.8, .7])
+        _, _, classes = yolo_eval_candidates(boxes, box_scores, [100, 100], score_threshold=.5, class_ids=[1],
+                                             max_boxes=1)
+        self.assertEqual(classes.tolist(), [1])
+
+    def test_tiler(self):
+        tiler = Tiler(tile_size=100, overlap=.5, max_tiles=16)
+        self.assertEqual(tiler.tiles(80, 60), [(0, 0, 80, 60)])
+        tiles = tiler.tiles(200, 100)
+        self.assertEqual(tiles, [(0, 0, 100, 100), (50, 0, 150, 100), (100, 0, 200, 100), (0, 0, 200, 100)])
+        self.assertLessEqual(len(tiler.tiles(2000, 1500)), 16)
+
+        results = [(np.array([[0., 0., 1., 1.]], dtype='float32'), np.array([[.9]], dtype='float32'))] * len(tiles)
+        boxes, box_scores = Tiler.merge(tiles, (200, 100), results)
+        np.testing.assert_allclose(boxes[1], [0., .25, 1., .75])
+        np.testing.assert_allclose(boxes[3], [0., 0., 1., 1.])
+        self.assertEqual(box_scores.shape, (4, 1))
+
+        tiles, batch = tiler.prepare(Image.new('RGB', (200, 100)), (64, 64))
+        self.assertEqual(batch.shape, (4, 64, 64, 3))
+
+    def test_encode_image(self):
+        image = Image.new('RGB', (64, 32), color=(255, 0, 0))
+        encoded_image = encode_image(image)
+        self.assertEqual(encoded_image[:2], b'\xff\xd8')
+        self.assertEqual(Image.open(io.BytesIO(encoded_image)).size, (64, 32))
+
+    def test_batch_scheduler(self):
+        class CountingDetector(object):
+            batch_sizes = []
+
+            def candidates_batch(self, image_batch, score_floor=0.):
+                self.batch_sizes.append(len(image_batch))
+                return [(image_data.sum(), score_floor) for image_data in image_batch]
+
+        detector = CountingDetector()
+        scheduler = BatchScheduler(detector, max_batch_size=4, max_wait=0.1, score_floor=.2)
+        futures = [scheduler.submit(np.full((1, 2, 2, 3), i, dtype='float32')) for i in range(6)]
+        self.assertEqual([future.result() for future in futures], [(12. * i, .2) for i in range(6)])
+        self.assertEqual(detector.batch_sizes, [4, 2])
+        scheduler.close()
+
+    def test_batch_scheduler_queue_depth(self):
+        class BlockingDetector(object):
+            def __init__(self):
+                self.started = threading.Event()
+                self.release = threading.Event()
+
+            def candidates_batch(self, image_batch, score_floor=0.):
+                self.started.set()
+                self.release.wait()
+                return [None] * len(image_batch)
+
+        registry = Registry()
+        detectors = [BlockingDetector(), BlockingDetector()]
+        schedulers = [BatchScheduler(detector, max_batch_size=1, metrics=registry) for detector in detectors]
+        for scheduler, num_images in zip(schedulers, (3, 2)):
+            for _ in range(num_images):
+                scheduler.submit(np.zeros((1, 2, 2, 3), dtype='float32'))
+        for detector in detectors:
+            detector.started.wait()
+        # Each worker holds its first image, the rest are queued.
+        self.assertIn('detapp_queue_depth 3.0', registry.render())
+        for scheduler, detector in zip(schedulers, detectors):
+            detector.release.set()
+            scheduler.close()
+        self.assertIn('detapp_queue_depth 0.0', registry.render())
+
+    def test_numpy_yolo_head_parity(self):
+        anchors = get_anchors('../object-detector-web-app/model_data/yolo_anchors.txt')
+        feats = np.random.RandomState(2).randn(2, 13, 13, 5 * 85).astype('float32')
+        with tf.Session() as sess:
+            expected = sess.run(yolo_head(tf.constant(feats), anchors, 80))
+        result = numpy_yolo.yolo_head(feats, anchors, 80)
+        for a, b in zip(expected, result):
+            np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+
+    def test_yolo_head_non_square(self):
+        anchors = get_anchors('../object-detector-web-app/model_data/yolo_anchors.txt')
+        feats = np.random.RandomState(6).randn(2, 10, 16, 5 * 85).astype('float32')
+        with tf.Session() as sess:
+            expected = sess.run(yolo_head(tf.constant(feats), anchors, 80))
+        result = numpy_yolo.yolo_head(feats, anchors, 80)
+        for a, b in zip(expected, result):
+            np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6)
+        box_xy = expected[0]
+        self.assertTrue(np.all(np.diff(np.floor(box_xy[0, 3, :, 0, 0] * 16)) == 1))
+        self.assertTrue(np.all(np.diff(np.floor(box_xy[0, :, 5, 0, 1] * 10)) == 1))
+
+    def test_detector_resolutions(self):
+        model, anchors, class_names = toy_model((None, None, 3))
+        detector = YoloDetector(model, anchors, class_names)
+        self.assertEqual(tuple(detector.model_image_size), (None, None))
+        detector.warmup([(64, 64), (64, 96)])
+        image_batch = np.random.RandomState(7).rand(1, 64, 96, 3).astype('float32')
+        boxes, box_scores = detector.candidates_batch(image_batch)[0]
+        self.assertEqual(boxes.shape, (2 * 3 * 2, 4))
+        numpy_detector = YoloDetector(model, anchors, class_names, backend='numpy')
+        numpy_boxes, numpy_scores = numpy_detector.candidates_batch(image_batch)[0]
+        np.testing.assert_allclose(boxes, numpy_boxes, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(box_scores, numpy_scores, rtol=1e-5, atol=1e-6)
+
+    def test_numpy_yolo_eval_parity(self):
+        with tf.Session() as sess:
+            yolo_outputs = sess.run((tf.random_normal([19, 19, 5, 2], mean=1, stddev=4, seed=1),
+                                     tf.random_normal([19, 19, 5, 2], mean=1, stddev=4, seed=1),
+                                     tf.random_normal([19, 19, 5, 1], mean=1, stddev=4, seed=1),
+                                     tf.random_normal([19, 19, 5, 80], mean=1, stddev=4, seed=1)))
+            expected = sess.run(yolo_eval(tuple(tf.constant(x) for x in yolo_outputs), image_shape=(720., 1280.)))
+        result = numpy_yolo.yolo_eval(yolo_outputs, image_shape=(720., 1280.))
+        for a, b in zip(expected, result):
+            np.testing.assert_allclose(a, b, rtol=1e-5)
+
+    def test_detector_numpy_backend(self):
+        model, anchors, class_names = toy_model()
+        image_batch = np.random.RandomState(3).rand(2, 64, 64, 3).astype('float32')
+
+        expected = YoloDetector(model, anchors, class_names).candidates_batch(image_batch, score_floor=.1)
+        result = YoloDetector(model, anchors, class_names, backend='numpy').candidates_batch(image_batch,
+                                                                                           score_floor=.1)
+        for (a_boxes, a_scores), (b_boxes, b_scores) in zip(expected, result):
+            np.testing.assert_allclose(a_boxes, b_boxes, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(a_scores, b_scores, rtol=1e-5, atol=1e-6)
+
+    def test_preprocess_image(self):
+        image = Image.fromarray(np.random.RandomState(4).randint(0, 255, (300, 400, 3), dtype='uint8'))
+        expected = np.array(image.resize((96, 64), Image.BICUBIC), dtype='float32') / 255.
+        buffer = np.empty((1, 64, 96, 3), dtype='float32')
+        image_data, _ = preprocess_image(image, (64, 96), out=buffer)
+        self.assertIs(image_data, buffer)
+        np.testing.assert_array_equal(image_data[0], expected)
+        with self.assertRaises(ValueError):
+            preprocess_image(image, (32, 32), out=buffer)
+
+    def test_preprocess_image_draft(self):
+        buffer = io.BytesIO()
+        Image.new('L', (1600, 1200), color=128).save(buffer, format='JPEG')
+        image_data, image = preprocess_image(Image.open(buffer), (64, 64), draft=True)
+        self.assertEqual(image_data.shape, (1, 64, 64, 3))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertLess(image.size[0], 1600)
+        self.assertGreaterEqual(image.size[1], 64)
+
+    def test_tensor_store(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        image_path = os.path.join(test_dir, 'test.jpg')
+        Image.fromarray(np.random.RandomState(5).randint(0, 255, (120, 160, 3), dtype='uint8')).save(image_path)
+
+        store = TensorStore(os.path.join(test_dir, 'store'), (64, 64))
+        self.assertEqual(store.build([image_path]), 1)
+        image_data = store.get(image_path)
+        self.assertIsInstance(image_data, np.memmap)
+        np.testing.assert_array_equal(image_data, get_image('test.jpg', test_dir, (64, 64))[0])
+        self.assertEqual(TensorStore(os.path.join(test_dir, 'store'), (64, 64)).build([image_path]), 0)
+
+        Image.new('RGB', (160, 120)).save(image_path)
+        os.utime(image_path, (0, 0))
+        self.assertEqual(store.get(image_path).max(), 0.)
+
+        Image.fromarray(np.random.RandomState(5).randint(0, 255, (480, 640, 3), dtype='uint8')).save(image_path)
+        draft_store = TensorStore(os.path.join(test_dir, 'store'), (64, 64), draft=True)
+        expected, image = get_image('test.jpg', test_dir, (64, 64), draft=True)
+        self.assertLess(image.size[0], 640)
+        np.testing.assert_array_equal(draft_store.get(image_path), expected)
+
+    def test_result_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        db_path = os.path.join(tmp_dir, 'results.sqlite3')
+        boxes = np.array([[.1, .2, .5, .6]], dtype='float32')
+        box_scores = np.array([[.1, .9, .3]], dtype='float32')
+
+        store = ResultStore(db_path, 'model', score_floor=.2, metrics=Registry())
+        self.assertIsNone(store.get('image', (64, 64)))
+        store.put('image', (64, 64), (boxes, box_scores))
+        reopened = ResultStore(db_path, 'model', score_floor=.2, metrics=Registry())
+        stored_boxes, stored_scores = reopened.get('image', (64, 64))
+        np.testing.assert_array_equal(stored_boxes, boxes)
+        np.testing.assert_array_equal(stored_scores, box_scores)
+        self.assertIsNone(reopened.get('image', (32, 32)))
+        self.assertIsNone(reopened.get('image', (64, 64), draft=True))
+        store.put('image', (64, 64), (boxes[:0], box_scores[:0]), draft=True)
+        self.assertEqual(len(reopened.get('image', (64, 64), draft=True)[0]), 0)
+        self.assertEqual(len(pickle.loads(pickle.dumps(store)).get('image', (64, 64))[0]), 1)
+        other_model = ResultStore(db_path, 'other model', score_floor=.2, metrics=Registry())
+        self.assertIsNone(other_model.get('image', (64, 64)))
+        # Candidates filtered at .2 can not serve a lower threshold.
+        self.assertIsNone(ResultStore(db_path, 'model', score_floor=.1, metrics=Registry()).get('image', (64, 64)))
+
+        with open(os.path.join(tmp_dir, 'a'), 'wb') as f:
+            f.write(b'abc')
+        self.assertEqual(file_checksum(os.path.join(tmp_dir, 'a')), 'a9993e364706816aba3e25717850c26c9cd0d89d')
+        fingerprint = file_fingerprint(os.path.join(tmp_dir, 'a'))
+        self.assertEqual(file_fingerprint(os.path.join(tmp_dir, 'a')), fingerprint)
+        os.utime(os.path.join(tmp_dir, 'a'), (0, 0))
+        self.assertNotEqual(file_fingerprint(os.path.join(tmp_dir, 'a')), fingerprint)
+
+    def test_save_thumbnail(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        image_path = os.path.join(tmp_dir, 'image.jpg')
+        thumbnail_path = os.path.join(tmp_dir, 'thumbnail.jpg')
+        Image.new('RGB', (400, 200)).save(image_path)
+
+        self.assertTrue(save_thumbnail(image_path, thumbnail_path, max_side=100))
+        self.assertEqual(Image.open(thumbnail_path).size, (100, 50))
+        self.assertFalse(save_thumbnail(image_path, thumbnail_path, max_side=100))
+
+    def test_draw_boxes(self):
+        class_names = ['person', 'car']
+        colors = get_colors_for_classes(class_names)
+        image = Image.new('RGB', (300, 200))
+        draw_boxes(image, np.array([0, 1]), np.array([[20., 30., 120., 150.], [-5., -5., 250., 400.]]),
+                   np.array([.9, .7]), class_names, colors)
+        draw_boxes(image, np.array([1]), np.array([[50., 50., 60., 60.]]), np.array([.5]), class_names, colors)
+        self.assertEqual(image.getpixel((30, 120)), colors[0])
+        self.assertEqual(image.getpixel((0, 199)), colors[1])
+        self.assertGreaterEqual(get_font.cache_info().hits, 1)
+
+    def test_api(self):
+        client = api_client(self.fake_scheduler())
+        image = encoded_jpeg()
+
+        response = client.post('/api/detect', data=image)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.get_data(as_text=True)),
+                         {'width': 200, 'height': 100,
+                          'detections': [{'class': 'car', 'score': .9, 'box': [10., 40., 50., 120.]}]})
+        response = client.post('/api/detect', content_type='multipart/form-data',
+                               data={'image': (io.BytesIO(image), 'a.jpg')})
+        self.assertEqual(json.loads(response.get_data(as_text=True))['width'], 200)
+        self.assertEqual(client.post('/api/detect', data=b'not an image').status_code, 400)
+        self.assertEqual(client.post('/api/detect?score_threshold=.1', data=image).status_code, 400)
+        self.assertEqual(client.post('/api/detect?max_boxes=0', data=image).status_code, 400)
+
+    def test_api_batch(self):
+        client = api_client(self.fake_scheduler())
+        response = client.post('/api/detect/batch', content_type='multipart/form-data',
+                               data={'images': [(io.BytesIO(encoded_jpeg()), 'a.jpg'),
+                                                (io.BytesIO(b'not an image'), 'b.jpg')]})
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(sorted(line['filename'] for line in lines), ['a.jpg', 'b.jpg'])
+        self.assertEqual(sum('error' in line for line in lines), 1)
+
+        class FailingDetector(object):
+            def candidates_batch(self, image_batch, score_floor=0.):
+                raise RuntimeError('session failed')
+
+        response = api_client(self.fake_scheduler(FailingDetector())).post(
+            '/api/detect/batch', content_type='multipart/form-data',
+            data={'images': [(io.BytesIO(encoded_jpeg()), 'a.jpg')]})
+        self.assertEqual([json.loads(line) for line in response.get_data(as_text=True).splitlines()],
+                         [{'index': 0, 'filename': 'a.jpg', 'error': 'session failed'}])
+
+    def test_api_resolution(self):
+        client = api_client(self.fake_scheduler(), image_sizes={32: (32, 32), 64: (64, 64)})
+        self.assertEqual(client.post('/api/detect?resolution=32', data=encoded_jpeg()).status_code, 200)
+        self.assertEqual(client.post('/api/detect?resolution=320', data=encoded_jpeg()).status_code, 400)
+
+    def test_api_tiled(self):
+        scheduler = self.fake_scheduler()
+        self.assertEqual(api_client(scheduler).post('/api/detect?tiled=1', data=encoded_jpeg()).status_code, 400)
+        client = api_client(scheduler, tiler=Tiler(tile_size=100, overlap=.5))
+        response = client.post('/api/detect?tiled=1', data=encoded_jpeg())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))['detections']), 4)
+
+    def test_api_classes(self):
+        client = api_client(self.fake_scheduler())
+        self.assertEqual(client.post('/api/detect?classes=cat', data=encoded_jpeg()).status_code, 400)
+        response = client.post('/api/detect?classes=person', data=encoded_jpeg())
+        self.assertEqual(json.loads(response.get_data(as_text=True))['detections'], [])
+        response = client.post('/api/detect?classes=person,car', data=encoded_jpeg())
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))['detections']), 1)
+
+    def test_api_upload_limits(self):
+        client = api_client(self.fake_scheduler(), decoder=UploadDecoder(max_pixels=100 * 100))
+        self.assertEqual(client.post('/api/detect', data=encoded_jpeg()).status_code, 413)
+        self.assertEqual(client.post('/api/detect', data=encoded_jpeg(100, 100)).status_code, 200)
+
+    def test_api_result_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        results = ResultStore(os.path.join(tmp_dir, 'results.sqlite3'), 'model', score_floor=.2, metrics=Registry())
+        client = api_client(self.fake_scheduler(), results=results)
+        first = client.post('/api/detect', data=encoded_jpeg()).get_data(as_text=True)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(client.post('/api/detect', data=encoded_jpeg()).get_data(as_text=True), first)
+
+    def test_upload_decoder(self):
+        image = io.BytesIO()
+        Image.new('RGB', (1000, 500)).save(image, format='JPEG')
+        data = image.getvalue()
+
+        decoder = UploadDecoder(max_bytes=len(data), max_pixels=500000)
+        self.assertEqual(decoder.read(io.BytesIO(data)), data)
+        decoded, size = decoder.decode(data, (64, 64))
+        self.assertEqual(size, (1000, 500))
+        self.assertEqual(decoded.mode, 'RGB')
+        self.assertLess(decoded.size[0], 1000)
+        self.assertEqual(decoder.decode(data)[0].size, (1000, 500))
+
+        with self.assertRaises(UploadError) as context:
+            UploadDecoder(max_bytes=len(data) - 1).read(io.BytesIO(data))
+        self.assertEqual(context.exception.status, 413)
+        with self.assertRaises(UploadError) as context:
+            UploadDecoder(max_pixels=499999).decode(data)
+        self.assertEqual(context.exception.status, 413)
+        with self.assertRaises(UploadError) as context:
+            decoder.decode(b'not an image')
+        self.assertEqual(context.exception.status, 400)
+
+    def test_job_queue(self):
+        def sleep(seconds, deadline=None):
+            time.sleep(seconds)
+            return seconds
+
+        jobs = JobQueue(local_executor(None, workers=1), max_pending=2, timeout=.5, metrics=Registry())
+        self.addCleanup(jobs.close)
+        done_id = jobs.submit(sleep, .1)
+        slow_id = jobs.submit(sleep, 1.)
+        self.assertRaises(JobQueueFull, jobs.submit, sleep, 0.)
+        self.assertEqual(jobs.wait(done_id, 5.), {'id': done_id, 'status': 'done', 'result': .1})
+        self.assertEqual(jobs.wait(slow_id, 5.)['status'], 'timeout')
+        self.assertIsNone(jobs.status('unknown'))
+
+        def bound_detector(deadline=None, detector=None):
+            return detector
+
+        for name in ('a', 'b'):
+            named_jobs = JobQueue(local_executor(name, workers=1), metrics=Registry())
+            self.addCleanup(named_jobs.close)
+            self.assertEqual(named_jobs.wait(named_jobs.submit(bound_detector), 5.)['result'], name)
+
+    def test_job_queue_records(self):
+        def sleep(seconds, deadline=None):
+            time.sleep(seconds)
+            return seconds
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        # Queues of two web worker processes sharing the job records.
+        owner = JobQueue(local_executor(None, workers=1), timeout=5., records=DirectoryStore(tmp_dir),
+                         metrics=Registry())
+        self.addCleanup(owner.close)
+        other = JobQueue(local_executor(None, workers=1), timeout=5.,
+                         records=pickle.loads(pickle.dumps(owner.records)), metrics=Registry())
+        self.addCleanup(other.close)
+        job_id = owner.submit(sleep, .3)
+        self.assertIn(other.status(job_id)['status'], ('queued', 'running'))
+        self.assertEqual(other.wait(job_id, 5.), {'id': job_id, 'status': 'done', 'result': .3})
+        self.assertIsNone(other.status('unknown'))
+        other.keep_finished = 0.
+        time.sleep(.01)
+        self.assertIsNone(other.status(job_id))
+
+    def test_jobs_api(self):
+        scheduler = self.fake_scheduler()
+        jobs = JobQueue(local_executor(scheduler), metrics=Registry())
+        self.addCleanup(jobs.close)
+        client = api_client(scheduler, jobs=jobs)
+
+        response = client.post('/api/jobs', content_type='multipart/form-data',
+                               data={'images': [(io.BytesIO(encoded_jpeg()), 'a.jpg'),
+                                                (io.BytesIO(b'not an image'), 'b.jpg')]})
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.get_data(as_text=True))['id']
+        status = json.loads(client.get('/api/jobs/{}?wait=5'.format(job_id)).get_data(as_text=True))
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['result'][0]['detections'],
+                         [{'class': 'car', 'score': .9, 'box': [10., 40., 50., 120.]}])
+        self.assertIn('error', status['result'][1])
+
+        lines = client.get('/api/jobs/{}/stream'.format(job_id)).get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(lines[0]), {'id': job_id, 'status': 'done'})
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(client.get('/api/jobs/unknown').status_code, 404)
+
+    def test_jobs_result_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        results = ResultStore(os.path.join(tmp_dir, 'results.sqlite3'), 'model', score_floor=.2, metrics=Registry())
+
+        class CountingDetector(FakeDetector):
+            runs = 0
+
+            def candidates_batch(self, image_batch, score_floor=0.):
+                self.runs += len(image_batch)
+                return super(CountingDetector, self).candidates_batch(image_batch, score_floor)
+
+        detector = CountingDetector()
+        images = [('a.jpg', encoded_jpeg())]
+        params = {'score_threshold': .5}
+        first = detect_images(images, ['person', 'car'], (64, 64), params, results=results, detector=detector)
+        second = detect_images(images, ['person', 'car'], (64, 64), params, results=results, detector=detector)
+        self.assertEqual(first, second)
+        self.assertEqual(detector.runs, 1)
+        self.assertEqual(len(results), 1)
+
+    def test_jobs_api_stream_expired(self):
+        class SlowDetector(FakeDetector):
+            def candidates_batch(self, image_batch, score_floor=0.):
+                time.sleep(.2)
+                return super(SlowDetector, self).candidates_batch(image_batch, score_floor)
+
+        scheduler = self.fake_scheduler(SlowDetector())
+        jobs = JobQueue(local_executor(scheduler), keep_finished=0., metrics=Registry())
+        self.addCleanup(jobs.close)
+        client = api_client(scheduler, jobs=jobs)
+        job_id = json.loads(client.post('/api/jobs', data=encoded_jpeg()).get_data(as_text=True))['id']
+        lines = client.get('/api/jobs/{}/stream'.format(job_id)).get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(lines[-1]), {'id': job_id, 'status': 'expired'})
+
+    def test_metrics(self):
+        registry = Registry()
+        histogram = registry.histogram('test_seconds', 'Test.', labels={'stage': 'a'}, buckets=(.1, 1.))
+        for value in (.05, .1, .5, 2.):
+            histogram.observe(value)
+        registry.counter('test_requests', 'Test.').inc()
+        registry.gauge('test_depth', 'Test.', lambda: 3)
+        with stage_timer('nms', registry):
+            pass
+        text = registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1",stage="a"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf",stage="a"} 4.0', text)
+        self.assertIn('test_seconds_count{stage="a"} 4.0', text)
+        self.assertIn('test_requests_total 1.0', text)
+        self.assertIn('test_depth 3.0', text)
+        self.assertIn('detapp_stage_seconds_count{stage="nms"} 1.0', text)
+        self.assertIs(registry.histogram('test_seconds', 'Test.', labels={'stage': 'a'}), histogram)
+
+    def test_yad2k_conversion(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        cfg_path = os.path.join(test_dir, 'test.cfg')
+        with open(cfg_path, 'w') as f:
+            f.write('[net]\nheight=32\nwidth=32\nchannels=3\ndecay=0.0005\n\n'
+                    '[convolutional]\nbatch_normalize=1\nfilters=4\nsize=3\nstride=1\npad=1\nactivation=leaky\n\n'
+                    '[maxpool]\nsize=2\nstride=2\n\n'
+                    '[convolutional]\nfilters=6\nsize=1\nstride=1\npad=1\nactivation=linear\n\n'
+                    '[region]\nanchors=1,1\nclasses=1\nnum=1\n')
+        weights = np.random.RandomState(0).uniform(.5, 1., 4 * 4 + 3 * 3 * 3 * 4 + 6 + 4 * 6).astype('float32')
+        weights_path = os.path.join(test_dir, 'test.weights')
+        with open(weights_path, 'wb') as f:
+            np.zeros(4, dtype='int32').tofile(f)
+            weights.tofile(f)
+        model_path = os.path.join(test_dir, 'test.h5')
+        yad2k._main(yad2k.parser.parse_args([cfg_path, weights_path, model_path]))
+
+        model = load_model(model_path)
+        kernel = model.layers[1].get_weights()[0]
+        np.testing.assert_array_equal(kernel, weights[16:124].reshape(4, 3, 3, 3).transpose(2, 3, 1, 0))
+        np.testing.assert_array_equal(model.layers[-1].get_weights()[1], weights[124:130])
+
+        folded_path = os.path.join(test_dir, 'folded.h5')
+        yad2k._main(yad2k.parser.parse_args([cfg_path, weights_path, folded_path, '--fold_batchnorm']))
+        with open(os.path.join(test_dir, 'folded_anchors.txt')) as f:
+            self.assertEqual(f.read(), '1,1\n')
+        folded = load_model(folded_path)
+        self.assertEqual(len(folded.layers), len(model.layers) - 1)
+        image = np.random.RandomState(1).uniform(size=(2, 32, 32, 3))
+        np.testing.assert_allclose(folded.predict(image), model.predict(image), rtol=1e-4, atol=1e-5)
+
+        with open(weights_path, 'wb') as f:
+            np.zeros(4, dtype='int32').tofile(f)
+            weights[:-1].tofile(f)
+        with self.assertRaises(ValueError):
+            yad2k._main(yad2k.parser.parse_args([cfg_path, weights_path, model_path]))
+
+    def test_detect_batch_iter_batches(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = []
+        for i in range(11):
+            paths.append(os.path.join(tmp_dir, '{:02d}.png'.format(i)))
+            if i == 4:
+                with open(paths[-1], 'wb') as f:
+                    f.write(b'not an image')
+            else:
+                Image.new('RGB', (40, 20), (i * 20,) * 3).save(paths[-1])
+
+        seen = []
+        with ThreadPoolExecutor(3) as pool:
+            for image_batch, batch in detect_batch.iter_batches(paths, pool, (32, 32), batch_size=3, prefetch=1,
+                                                                keep_image=False):
+                self.assertEqual(len(image_batch), len(batch))
+                for image_data, (image_path, _, error) in zip(image_batch, batch):
+                    seen.append(image_path)
+                    if image_path == paths[4]:
+                        self.assertIsNotNone(error)
+                        continue
+                    self.assertIsNone(error)
+                    np.testing.assert_allclose(image_data, paths.index(image_path) * 20 / 255., atol=1e-6)
+        self.assertEqual(seen, paths)
+
+    def test_detect_batch_read_done(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        paths = [os.path.join(tmp_dir, name) for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+        for path in paths:
+            Image.new('RGB', (8, 8)).save(path)
+        output_path = os.path.join(tmp_dir, 'out.jsonl')
+        self.assertEqual(detect_batch.read_done(output_path), set())
+        complete = ''.join(json.dumps({'image': path, 'detections': []}) + '\n' for path in paths[:2])
+        with open(output_path, 'w') as f:
+            f.write(complete + json.dumps({'image': paths[2], 'detections': []})[:20])
+
+        done = detect_batch.read_done(output_path)
+        self.assertEqual(done, set(paths[:2]))
+        with open(output_path) as f:
+            self.assertEqual(f.read(), complete)
+        self.assertEqual([p for p in detect_batch.iter_image_paths(tmp_dir) if p not in done], paths[2:])
+
+    def test_video_detector(self):
+        class FrameDetector(object):
+            """Detector finding a box shifted right by the frame index, read from the frame brightness."""
+            frames = []
+
+            def candidates_batch(self, image_batch, score_floor=0.):
+                indices = [int(round(image_data.mean() * 255)) for image_data in image_batch]
+                self.frames.append(indices)
+                return [(np.array([[.1, index / 100., .5, index / 100. + .4]], dtype='float32'),
+                         np.array([[0., .9]], dtype='float32')) for index in indices]
+
+        detector = FrameDetector()
+        args = detect_video.parser.parse_args(['frames', 'out.jsonl', '--stride', '3', '--batch_size', '2'])
+        emitted = []
+        video_detector = detect_video.VideoDetector(detector, (32, 32), args, lambda *item: emitted.append(item))
+        for index in range(14):
+            video_detector.add(index, np.full((100, 100, 3), index, dtype='uint8'), keep_frame=index % 2 == 0)
+        video_detector.close()
+
+        self.assertEqual(detector.frames, [[0, 3], [6, 9], [12]])
+        self.assertEqual([index for index, _, _ in emitted], list(range(14)))
+        for index, frame, detections in emitted:
+            self.assertEqual(frame is not None, index % 2 == 0)
+            self.assertEqual(detections['track_ids'].tolist(), [0])
+            # Keyframes carry their own box, frames in between one moved linearly, frames after the last keyframe
+            # keep its box.
+            np.testing.assert_allclose(detections['boxes'][0], [10., min(index, 12), 50., min(index, 12) + 40.],
+                                       atol=1e-4)
+
+    def test_keyframe_tracker(self):
+        tracker = KeyframeTracker(match_iou=.3)
+        start = tracker.update(np.array([[0., 0., 10., 10.], [50., 50., 60., 60.]]), np.array([.9, .8]),
+                               np.array([0, 1]))
+        end = tracker.update(np.array([[2., 2., 12., 12.], [100., 100., 110., 110.]]), np.array([.7, .6]),
+                             np.array([0, 1]))
+        self.assertEqual(start['track_ids'].tolist(), [0, 1])
+        self.assertEqual(end['track_ids'].tolist(), [0, 2])
+
+        frame = interpolate_detections(start, end, .25)
+        self.assertEqual(frame['track_ids'].tolist(), [0, 1])
+        np.testing.assert_allclose(frame['boxes'][0], [.5, .5, 10.5, 10.5])
+        np.testing.assert_allclose(frame['scores'][0], .85)
+        self.assertEqual(interpolate_detections(start, end, .75)['track_ids'].tolist(), [0, 2])
+        self.assertEqual(match_boxes(start['boxes'], [0, 1], end['boxes'], [1, 1]), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,44 +1,153 @@
 #! /usr/bin/env python
+import io
 import os
+import re
 import glob
 import flask
 import base64
+import hashlib
+import threading
+import numpy as np
 
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 
-from keras import backend as K
-from keras.models import load_model
+from PIL import Image
 
-from src.keras_yolo import yolo_eval, yolo_head
-from src.yolo_utils import get_image, get_classes, get_anchors, get_colors_for_classes, predict, create_output_dir
+from src.api import create_api
+from src.batching import BatchScheduler
+from src.cache import DirectoryStore, LRUCache
+from src.detector import load_detector
+from src.jobs import JobQueue, local_executor, process_executor
+from src.metrics import REGISTRY, count_request, stage_timer
+from src.result_store import ResultStore, file_checksum, file_fingerprint
+from src.numpy_yolo import yolo_eval_candidates
+from src.tensor_store import TensorStore
+from src.tiling import Tiler
+from src.uploads import InMemoryRequest, UploadDecoder, UploadError
+from src.yolo_utils import (preprocess_image, get_classes, get_anchors, get_colors_for_classes, draw_boxes,
+                            encode_image, save_encoded_image, save_thumbnail, create_output_dir, input_buffer)
 
 CLASSES_DIR = 'model_data/coco_classes.txt'
 ANCHORS_DIR = 'model_data/yolo_anchors.txt'
-MODEL_DIR = 'model_data/yolo.h5'
+MODEL_DIR = 'model_data/yolo.h5'  # Or a frozen graph from export_graph.py, e.g. 'model_data/yolo.pb'.
 IMAGES_DIR = 'images/'
 OUTPUT_DIR = 'out/'
+THUMBNAIL_DIR = 'thumbnails/'  # Downscaled previews of the gallery images.
+THUMBNAIL_SIDE = 640
+THUMBNAIL_MAX_AGE = 3600  # Seconds browsers use thumbnails before revalidating them.
+RENDERED_DIR = 'rendered/'  # Annotated images by SHA-1, shared by worker processes.
+RENDERED_DIR_BYTES = 256 * 2 ** 20  # Least recently used annotated images are deleted beyond this size.
+RENDERED_INDEX_SIZE = 1024
+SAVE_OUTPUT = False  # Also write annotated images to OUTPUT_DIR.
+MIN_SCORE_THRESHOLD = 0.2
+RESAMPLE = Image.BICUBIC
+DRAFT_DECODE = True  # Decode large JPEGs at reduced size, the result is only displayed.
+TENSOR_STORE_DIR = 'tensor_store/'  # Preprocessed gallery images, None to decode on every request.
+RESULT_STORE_PATH = 'results.sqlite3'  # Candidates persisted across restarts and workers, None to disable.
+POSTPROCESS_BACKEND = 'tensorflow'  # Or 'numpy' to decode the raw conv output outside the graph.
+RESOLUTIONS = (320, 416, 512, 608)  # Input sizes selectable with fully convolutional models.
+DEFAULT_RESOLUTION = 608
+TILE_SIZE = 608  # Tiled API detection (tiled=1) of large images, pixels per tile side.
+TILE_OVERLAP = .2
+MAX_TILES = 16
+JOB_PROCESSES = int(os.environ.get('JOB_PROCESSES', 0))  # Worker processes with own models for /api/jobs.
+JOB_THREADS = 2  # In-process job workers sharing the scheduler, used when JOB_PROCESSES is 0.
+MAX_PENDING_JOBS = 32
+JOB_TIMEOUT = 300.  # Seconds.
+WEB_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))  # Gunicorn worker processes, see gunicorn.conf.py.
+JOB_DIR = 'jobs/'  # Job status and results, shared by worker processes when WEB_WORKERS > 1.
+JOB_DIR_BYTES = 256 * 2 ** 20  # Least recently used job records are deleted beyond this size.
+MAX_BOXES = 100  # Upper bound of the max boxes input.
+MAX_UPLOAD_BYTES = 20 * 2 ** 20
+MAX_UPLOAD_PIXELS = 50 * 10 ** 6  # Checked from the image header, before decoding.
+MAX_CONCURRENT_DECODES = 4  # Bounds decode memory of concurrent uploads.
+MAX_REQUEST_BYTES = 64 * 2 ** 20  # Uploads are kept in memory, Dash uploads arrive base64 encoded.
+UPLOAD_MAX_SIDE = 1024  # Uploads selected in the app are stored at most this large.
+SHARE_UPLOADS = WEB_WORKERS > 1  # Keep uploads in UPLOAD_DIR instead of memory, so every worker can serve them.
+UPLOAD_CACHE_SIZE = 256  # Uploads kept in memory without SHARE_UPLOADS.
+UPLOAD_DIR = 'uploads/'  # Uploads selected in the app, shared by worker processes with SHARE_UPLOADS.
+UPLOAD_DIR_BYTES = 256 * 2 ** 20  # Least recently used uploads are deleted beyond this size.
+SAVE_UPLOADS = False  # Also write uploads to IMAGES_DIR.
+UPLOAD_PREFIX = 'upload-'
+UPLOAD_NAME = re.compile(r'^{}[0-9a-f]{{16}}\.jpg$'.format(UPLOAD_PREFIX))
+CANDIDATES_CACHE_SIZE = 64
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT = 0.005  # Seconds to wait for concurrent requests to join a batch.
 
 TEST_IMAGE_LIST = [os.path.basename(x) for x in glob.glob('{}*.jpg'.format(IMAGES_DIR))]
 static_image_route = '/static/'
+thumbnail_route = '/thumbnails/'
+rendered_route = '/rendered/'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
 external_stylesheets = [dbc.themes.BOOTSTRAP]
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-server = app.server
+server = app.server  # WSGI entry point, e.g. `gunicorn -c gunicorn.conf.py web_app:server`.
+server.request_class = InMemoryRequest
+server.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
-class_names = get_classes(CLASSES_DIR)
-anchors = get_anchors(ANCHORS_DIR)
+if SAVE_OUTPUT:
+    create_output_dir(OUTPUT_DIR)
+detector = load_detector(MODEL_DIR, get_anchors(ANCHORS_DIR), get_classes(CLASSES_DIR), backend=POSTPROCESS_BACKEND)
+class_names = detector.class_names
 colors = get_colors_for_classes(class_names)
+if None in detector.model_image_size:
+    image_sizes = {resolution: (resolution, resolution) for resolution in RESOLUTIONS}
+    default_resolution = DEFAULT_RESOLUTION
+else:
+    default_resolution = detector.model_image_size[0]
+    image_sizes = {default_resolution: tuple(detector.model_image_size)}
+model_image_size = image_sizes[default_resolution]
+candidates_cache = LRUCache(CANDIDATES_CACHE_SIZE)
+decoder = UploadDecoder(MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS, MAX_CONCURRENT_DECODES, draft=DRAFT_DECODE)
+# Stored uploads by name, both stores answer get and put alike.
+uploads = DirectoryStore(UPLOAD_DIR, UPLOAD_DIR_BYTES) if SHARE_UPLOADS else LRUCache(UPLOAD_CACHE_SIZE)
+rendered = DirectoryStore(RENDERED_DIR, RENDERED_DIR_BYTES)
+# Detection parameters to SHA-1 of the annotated image in rendered and number of detections.
+rendered_index = LRUCache(RENDERED_INDEX_SIZE)
+scheduler = BatchScheduler(detector, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT,
+                           score_floor=MIN_SCORE_THRESHOLD)
+# Spawned job processes re-import __main__, so they are only started when served by gunicorn.
+if JOB_PROCESSES and __name__ != '__main__':
+    job_executor = process_executor(JOB_PROCESSES, MODEL_DIR, ANCHORS_DIR, CLASSES_DIR, POSTPROCESS_BACKEND)
+else:
+    job_executor = local_executor(scheduler, JOB_THREADS)
+jobs = JobQueue(job_executor, max_pending=MAX_PENDING_JOBS, timeout=JOB_TIMEOUT,
+                records=DirectoryStore(JOB_DIR, JOB_DIR_BYTES) if WEB_WORKERS > 1 else None)
+result_store = None
+if RESULT_STORE_PATH:
+    model_files = [MODEL_DIR] if MODEL_DIR.endswith('.pb') else [MODEL_DIR, ANCHORS_DIR, CLASSES_DIR]
+    # Hashing the model contents would read it once more in every worker at startup.
+    result_store = ResultStore(RESULT_STORE_PATH, file_fingerprint(*model_files), score_floor=MIN_SCORE_THRESHOLD)
+app.server.register_blueprint(create_api(scheduler, class_names, model_image_size, draft=DRAFT_DECODE,
+                                         image_sizes=image_sizes,
+                                         tiler=Tiler(TILE_SIZE, overlap=TILE_OVERLAP, max_tiles=MAX_TILES,
+                                                     resample=RESAMPLE),
+                                         jobs=jobs,
+                                         decoder=decoder,
+                                         results=result_store))
+tensor_store = None
+if TENSOR_STORE_DIR:
+    tensor_store = TensorStore(TENSOR_STORE_DIR, model_image_size, resample=RESAMPLE, draft=DRAFT_DECODE)
+    threading.Thread(target=tensor_store.build, args=([os.path.join(IMAGES_DIR, x) for x in TEST_IMAGE_LIST],),
+                     name='tensor-store-build', daemon=True).start()
+os.makedirs(THUMBNAIL_DIR, exist_ok=True)
 
-create_output_dir(OUTPUT_DIR)
-sess = K.get_session()
-yolo_model = load_model(MODEL_DIR)
-model_image_size = yolo_model.layers[0].input_shape[1:3]
-yolo_outputs = yolo_head(yolo_model.output, anchors, len(class_names))
-input_image_shape = K.placeholder(shape=(2,))
+
+def build_thumbnails():
+    for image_name in list(TEST_IMAGE_LIST):
+        save_thumbnail(os.path.join(IMAGES_DIR, image_name), os.path.join(THUMBNAIL_DIR, image_name),
+                       THUMBNAIL_SIDE, RESAMPLE)
+
+
+threading.Thread(target=build_thumbnails, name='thumbnails-build', daemon=True).start()
+# Request threads only run the prebuilt graph, never add to it.
+detector.sess.graph.finalize()
+detector.warmup(image_sizes.values())
 
 app.title = 'DetApp'
 
@@ -93,7 +202,7 @@ app.layout = html.Div(
                          ),
                 html.Div([
                     dcc.Slider(id='my-slider',
-                               min=0.2,
+                               min=MIN_SCORE_THRESHOLD,
                                max=0.8,
                                step=None,
                                marks={
@@ -124,6 +233,92 @@ app.layout = html.Div(
                           'width': '75%',
                           'float': 'right',
                           'marginTop': 35}),
+
+                html.Div([
+                    dcc.Upload(id='upload-image',
+                               children=html.Div(['Drop an image here or ', html.A('select a file')]),
+                               accept='image/*',
+                               max_size=MAX_UPLOAD_BYTES,
+                               style={'borderWidth': '1px',
+                                      'borderStyle': 'dashed',
+                                      'borderRadius': '5px',
+                                      'padding': '10px'}
+                               ),
+                    html.Div(id='upload-error', style={'color': 'red'})
+                ], style={'padding': '0px 10px 10px 20px',
+                          'width': '75%',
+                          'float': 'right',
+                          'marginTop': 20}),
+
+                html.Div(children=["Rendering:"],
+                         style={'float': 'left',
+                                'padding': '0px 10px 10px 20px',
+                                'marginTop': 35}),
+                html.Div([
+                    dcc.RadioItems(id='render-mode',
+                                   options=[{'label': 'Server image', 'value': 'server'},
+                                            {'label': 'Browser overlay', 'value': 'overlay'}],
+                                   value='server',
+                                   labelStyle={'display': 'inline-block',
+                                               'marginRight': 20}
+                                   )
+                ], style={'padding': '0px 10px 10px 20px',
+                          'width': '75%',
+                          'float': 'right',
+                          'textAlign': 'left',
+                          'marginTop': 35}),
+
+                html.Div(children=["Resolution:"],
+                         style={'float': 'left',
+                                'padding': '0px 10px 10px 20px',
+                                'marginTop': 35}),
+                html.Div([
+                    dcc.RadioItems(id='resolution',
+                                   options=[{'label': '{}x{}'.format(*image_sizes[r]), 'value': r}
+                                            for r in sorted(image_sizes)],
+                                   value=default_resolution,
+                                   labelStyle={'display': 'inline-block',
+                                               'marginRight': 20}
+                                   )
+                ], style={'padding': '0px 10px 10px 20px',
+                          'width': '75%',
+                          'float': 'right',
+                          'textAlign': 'left',
+                          'marginTop': 35}),
+
+                html.Div(children=["Classes:"],
+                         style={'float': 'left',
+                                'padding': '0px 10px 10px 20px',
+                                'marginTop': 35}),
+                html.Div([
+                    dcc.Dropdown(id='classes',
+                                 options=[{'label': name, 'value': i} for i, name in enumerate(class_names)],
+                                 multi=True,
+                                 placeholder='All classes',
+                                 )
+                ], style={'padding': '0px 10px 10px 20px',
+                          'width': '75%',
+                          'float': 'right',
+                          'textAlign': 'left',
+                          'marginTop': 35}),
+
+                html.Div(children=["Max Boxes:"],
+                         style={'float': 'left',
+                                'padding': '0px 10px 10px 20px',
+                                'marginTop': 35}),
+                html.Div([
+                    dcc.Input(id='max-boxes',
+                              type='number',
+                              min=1,
+                              max=MAX_BOXES,
+                              step=1,
+                              value=10,
+                              )
+                ], style={'padding': '0px 10px 10px 20px',
+                          'width': '75%',
+                          'float': 'right',
+                          'textAlign': 'left',
+                          'marginTop': 35}),
             ], style={'width': '49%',
                       'float': 'left'
                       }
@@ -131,10 +326,26 @@ app.layout = html.Div(
 
             html.Div([
                 html.Br(),
-                html.Img(id='image1',
-                         style={
-                             'width': '80%'
-                         }),
+                html.Div([
+                    html.Img(id='image1',
+                             style={
+                                 'width': '100%',
+                                 'display': 'block'
+                             }),
+                    html.Div(id='image1-overlay',
+                             style={
+                                 'position': 'absolute',
+                                 'top': 0,
+                                 'left': 0,
+                                 'width': '100%',
+                                 'height': '100%'
+                             })
+                ], style={
+                    'position': 'relative',
+                    'display': 'inline-block',
+                    'width': '80%'
+                }),
+                html.Div(id='detection-error', style={'color': 'red'}),
                 html.Div([
                     dbc.Button("Learn More", id="info-button", className="mr-1")
                 ], style={
@@ -167,9 +378,28 @@ def update_image_src(test_image):
     """Show selected image.
 
     :param test_image: selected image name.
-    :return: path to selected image.
+    :return: path to thumbnail of selected image.
     """
-    return static_image_route + test_image
+    if not test_image:  # Dropdown cleared.
+        return None
+    return thumbnail_route + test_image
+
+
+def immutable_image_response(etag, get_data):
+    """Serve JPEG that never changes under its URL, answering revalidations without the data.
+
+    :param etag: entity tag, e.g. content hash.
+    :param get_data: function returning the JPEG bytes.
+    :return: response.
+    """
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(get_data(), mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    return response
 
 
 # Add a static image route that serves images from desktop
@@ -183,30 +413,319 @@ def serve_image(image_path):
     :return: test image.
     """
     image_name = '{}.jpg'.format(image_path)
+    upload = uploads.get(image_name) if UPLOAD_NAME.match(image_name) else None
+    if upload is not None:
+        # Upload names are content hashes.
+        return immutable_image_response(image_name, lambda: upload)
     if image_name not in TEST_IMAGE_LIST:
         raise Exception('"{}" is excluded from the allowed static files'.format(image_path))
     return flask.send_from_directory(IMAGES_DIR, image_name)
 
 
+@app.server.route('{}<image_path>.jpg'.format(thumbnail_route))
+def serve_thumbnail(image_path):
+    """Serve downscaled preview of a gallery image or an upload.
+
+    :param image_path: image name without extension.
+    :return: thumbnail.
+    """
+    image_name = '{}.jpg'.format(image_path)
+    upload = uploads.get(image_name) if UPLOAD_NAME.match(image_name) else None
+    if upload is not None:
+        def get_data():
+            with Image.open(io.BytesIO(upload)) as image:
+                image.draft('RGB', (THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+                thumbnail = image.convert('RGB')
+            thumbnail.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), RESAMPLE)
+            return encode_image(thumbnail)
+        return immutable_image_response(image_name, get_data)
+    if image_name not in TEST_IMAGE_LIST:
+        flask.abort(404)
+    # Only writes the thumbnail if it was not built yet or the image changed.
+    save_thumbnail(os.path.join(IMAGES_DIR, image_name), os.path.join(THUMBNAIL_DIR, image_name),
+                   THUMBNAIL_SIDE, RESAMPLE)
+    return flask.send_from_directory(THUMBNAIL_DIR, image_name, cache_timeout=THUMBNAIL_MAX_AGE)
+
+
+@app.server.route('{}<digest>.jpg'.format(rendered_route))
+def serve_rendered(digest):
+    """Serve annotated image by content hash, cacheable forever.
+
+    :param digest: SHA-1 of the image.
+    :return: annotated image.
+    """
+    data = rendered.get('{}.jpg'.format(digest))
+    if data is None:
+        flask.abort(404)
+    return immutable_image_response(digest, lambda: data)
+
+
+@app.server.route('/metrics')
+def serve_metrics():
+    """Expose latency histograms and counters in Prometheus text format."""
+    return flask.Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+def add_upload(contents, filename=None):
+    """Decode an image uploaded in the app and store it.
+
+    The image is decoded at reduced size where the format allows and stored
+    as JPEG at most UPLOAD_MAX_SIDE pixels large, in memory or, with
+    SHARE_UPLOADS, in UPLOAD_DIR for every worker process. It is also written
+    to IMAGES_DIR with SAVE_UPLOADS.
+
+    :param contents: data URL of the upload.
+    :param filename: name of the uploaded file.
+    :return: image name of the upload, usable like a gallery image name.
+    """
+    _, _, encoded = contents.partition(',')
+    decoder.check_size(len(encoded) * 3 // 4)
+    data = base64.b64decode(encoded)
+    with stage_timer('decode'):
+        image, _ = decoder.decode(data, model_image_size)
+    image.thumbnail((UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE), RESAMPLE)
+    image_name = '{}{}.jpg'.format(UPLOAD_PREFIX, hashlib.sha1(data).hexdigest()[:16])
+    encoded_image = encode_image(image)
+    if SAVE_UPLOADS and image_name not in TEST_IMAGE_LIST:
+        with open(os.path.join(IMAGES_DIR, image_name), 'wb') as f:
+            is_jpeg = (filename or '').lower().endswith(('.jpg', '.jpeg'))
+            f.write(data if is_jpeg else encoded_image)
+        TEST_IMAGE_LIST.append(image_name)
+    uploads.put(image_name, encoded_image)
+    return image_name
+
+
+@app.callback(
+    [dash.dependencies.Output('image0-dropdown', 'options'),
+     dash.dependencies.Output('image0-dropdown', 'value'),
+     dash.dependencies.Output('upload-error', 'children')],
+    [dash.dependencies.Input('upload-image', 'contents')],
+    [dash.dependencies.State('upload-image', 'filename'),
+     dash.dependencies.State('image0-dropdown', 'options'),
+     dash.dependencies.State('image0-dropdown', 'value')])
+def upload_image(contents, filename, options, value):
+    """Add uploaded image to the selectable images and select it.
+
+    :param contents: data URL of the upload.
+    :param filename: name of the uploaded file.
+    :param options: selectable images.
+    :param value: selected image.
+    :return: selectable images, selected image and error message.
+    """
+    if contents is None:
+        raise dash.exceptions.PreventUpdate
+    try:
+        image_name = add_upload(contents, filename)
+    except UploadError as e:
+        return options, value, str(e)
+    if image_name not in [option['value'] for option in options]:
+        options = options + [{'label': filename or image_name, 'value': image_name}]
+    return options, image_name, ''
+
+
+def image_file(test_image):
+    """File of a stored upload or a gallery image.
+
+    :param test_image: selected test image.
+    :return: in-memory file of an upload or path of a gallery image.
+    :raise UploadError: if the image is not available, e.g. an upload evicted from uploads.
+    """
+    if UPLOAD_NAME.match(test_image or ''):
+        upload = uploads.get(test_image)
+        if upload is not None:
+            return io.BytesIO(upload)
+    if test_image in TEST_IMAGE_LIST:
+        return os.path.join(IMAGES_DIR, test_image)
+    raise UploadError('Image {} is no longer available, upload it again.'.format(test_image), status=404)
+
+
+def image_key(test_image, image_size):
+    """Cache key of an image at a model image size, it changes when the image file does.
+
+    :param test_image: selected test image.
+    :param image_size: model image size.
+    :return: hashable key.
+    """
+    # Upload names are content hashes already.
+    if UPLOAD_NAME.match(test_image or '') or test_image not in TEST_IMAGE_LIST:
+        return test_image, None, image_size
+    return test_image, os.path.getmtime(os.path.join(IMAGES_DIR, test_image)), image_size
+
+
+def get_candidates(test_image, resolution=None):
+    """Run YOLO network on test image, reusing cached candidates.
+
+    Candidates are cached per image file and resolution, so moving the slider
+    only re-runs filtering and NMS.
+
+    :param test_image: selected test image.
+    :param resolution: key of model image size in image_sizes, defaults to default_resolution.
+    :return: boxes and box scores above minimum slider threshold.
+    """
+    image_size = image_sizes[resolution or default_resolution]
+    key = image_key(test_image, image_size)
+    candidates = candidates_cache.get(key)
+    REGISTRY.counter('detapp_candidates_cache', 'Candidates cache lookups.',
+                     labels={'result': 'miss' if candidates is None else 'hit'}).inc()
+    if candidates is None:
+        candidates = compute_candidates(test_image, image_size)
+        candidates_cache.put(key, candidates)
+    return candidates
+
+
+def compute_candidates(test_image, image_size):
+    """Read candidates of an image from the result store or run the network.
+
+    :param test_image: selected test image.
+    :param image_size: model image size.
+    :return: boxes and box scores above minimum slider threshold.
+    """
+    source = image_file(test_image)
+    in_gallery = not isinstance(source, io.BytesIO)
+    image_sha1 = None
+    if result_store is not None:
+        # Uploads are keyed by the stored JPEG, the network sees its decode, not the original upload.
+        image_sha1 = file_checksum(source) if in_gallery else hashlib.sha1(source.getvalue()).hexdigest()
+        with stage_timer('result_store'):
+            candidates = result_store.get(image_sha1, image_size, draft=DRAFT_DECODE)
+        if candidates is not None:
+            return candidates
+    if tensor_store is not None and in_gallery and image_size == model_image_size:
+        with stage_timer('tensor_store'):
+            image_data = tensor_store.get(source)
+    else:
+        image = open_image(test_image, image_size)
+        with stage_timer('resize'):
+            image_data, _ = preprocess_image(image, image_size, resample=RESAMPLE, out=input_buffer(image_size))
+    candidates = scheduler.candidates(image_data)
+    if image_sha1 is not None:
+        result_store.put(image_sha1, image_size, candidates, draft=DRAFT_DECODE)
+    return candidates
+
+
+def warm_up_results():
+    """Fill the result store for every gallery image, so first views skip the network."""
+    for test_image in list(TEST_IMAGE_LIST):
+        try:
+            compute_candidates(test_image, model_image_size)
+        except Exception as e:
+            app.logger.warning('Result store warm-up failed for %s: %s', test_image, e)
+
+
+def open_image(test_image, image_size=None):
+    """Decode test image for the network or for drawing.
+
+    :param test_image: selected test image.
+    :param image_size: model image size the image is decoded for, defaults to model_image_size.
+    :return: RGB image.
+    """
+    with stage_timer('decode'):
+        image = Image.open(image_file(test_image))
+        if DRAFT_DECODE:
+            image.draft('RGB', tuple(reversed(image_size or model_image_size)))
+        return image.convert('RGB')
+
+
+def detections_overlay(out_boxes, out_scores, out_classes):
+    """Build boxes drawn by the browser on top of the original image.
+
+    :param out_boxes: boxes positions normalized to image size.
+    :param out_scores: confidence scores.
+    :param out_classes: detected classes.
+    :return: overlay components.
+    """
+    overlay = []
+    for box, score, c in reversed(list(zip(out_boxes, out_scores, out_classes))):
+        top, left, bottom, right = np.clip(box, 0., 1.) * 100
+        color = 'rgb({}, {}, {})'.format(*colors[c])
+        overlay.append(html.Div(
+            html.Span('{} {:.2f}'.format(class_names[c], score),
+                      style={'position': 'absolute',
+                             'left': '-3px',
+                             'bottom': '100%',
+                             'padding': '0px 2px',
+                             'backgroundColor': color,
+                             'color': 'black',
+                             'fontFamily': 'monospace',
+                             'whiteSpace': 'nowrap'}),
+            style={'position': 'absolute',
+                   'top': '{:.2f}%'.format(top),
+                   'left': '{:.2f}%'.format(left),
+                   'width': '{:.2f}%'.format(right - left),
+                   'height': '{:.2f}%'.format(bottom - top),
+                   'border': '3px solid {}'.format(color),
+                   'boxSizing': 'border-box'}))
+    return overlay
+
+
 @app.callback(
-    dash.dependencies.Output('image1', 'src'),
+    [dash.dependencies.Output('image1', 'src'),
+     dash.dependencies.Output('image1-overlay', 'children'),
+     dash.dependencies.Output('detection-error', 'children')],
     [dash.dependencies.Input('image0-dropdown', 'value'),
-     dash.dependencies.Input('my-slider', 'value')])
-def run_script(test_image, slider):
+     dash.dependencies.Input('my-slider', 'value'),
+     dash.dependencies.Input('render-mode', 'value'),
+     dash.dependencies.Input('resolution', 'value'),
+     dash.dependencies.Input('classes', 'value'),
+     dash.dependencies.Input('max-boxes', 'value')])
+def run_script(test_image, slider, render_mode, resolution, classes=None, max_boxes=10):
     """Run YOLO detector with params.
 
     :param test_image: selected test image.
     :param slider: minimum confidence threshold.
-    :return: image after prediction.
+    :param render_mode: 'server' to draw boxes into the image, 'overlay' to let the browser draw them.
+    :param resolution: model input resolution.
+    :param classes: indices of detected classes, empty for every class.
+    :param max_boxes: maximum number of drawn boxes.
+    :return: URL of image after prediction, boxes overlay and error message.
     """
-    boxes, scores, classes = yolo_eval(yolo_outputs, input_image_shape, score_threshold=slider, iou_threshold=.6)
-    image_data, image = get_image(test_image, IMAGES_DIR, model_image_size)
-    predict(sess, boxes, scores, classes, yolo_model, image_data, input_image_shape, image, test_image, class_names,
-            colors, OUTPUT_DIR)
+    if not test_image:  # Dropdown cleared.
+        return None, [], ''
+    # Candidates are cached for every class, the subset only changes filtering and NMS.
+    params = {'score_threshold': slider,
+              'iou_threshold': .6,
+              'max_boxes': int(np.clip(max_boxes or 10, 1, MAX_BOXES)),
+              'class_ids': classes or None}
+    if render_mode == 'server':
+        render_key = image_key(test_image, image_sizes[resolution or default_resolution]) + (
+            slider, tuple(sorted(classes or ())), params['max_boxes'])
+        digest, num_detections = rendered_index.get(render_key, (None, 0))
+        if digest is not None and '{}.jpg'.format(digest) in rendered:
+            count_request('dash', num_detections)
+            return rendered_route + digest + '.jpg', [], ''
+
+    try:
+        boxes, box_scores = get_candidates(test_image, resolution)
+        image = open_image(test_image) if render_mode == 'server' else None
+    except UploadError as e:
+        return None, [], str(e)
+    if render_mode == 'overlay':
+        # Boxes stay normalized, IoU does not depend on the image scale.
+        with stage_timer('nms'):
+            out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, [1., 1.], **params)
+        count_request('dash_overlay', len(out_boxes))
+        return static_image_route + test_image, detections_overlay(out_boxes, out_scores, out_classes), ''
+
+    with stage_timer('nms'):
+        out_boxes, out_scores, out_classes = yolo_eval_candidates(boxes, box_scores, [image.size[1], image.size[0]],
+                                                                  **params)
+    count_request('dash', len(out_boxes))
+    with stage_timer('draw_boxes'):
+        draw_boxes(image, out_classes, out_boxes, out_scores, class_names, colors)
+    with stage_timer('encode'):
+        encoded_image = encode_image(image)
+    if SAVE_OUTPUT:
+        save_encoded_image(encoded_image, test_image, OUTPUT_DIR)
+
+    # Only the URL goes through the callback, the browser fetches and caches the image.
+    digest = hashlib.sha1(encoded_image).hexdigest()
+    rendered.put('{}.jpg'.format(digest), encoded_image)
+    rendered_index.put(render_key, (digest, len(out_boxes)))
+    return rendered_route + digest + '.jpg', [], ''
 
-    encoded_image = base64.b64encode(open('out/' + str(test_image), 'rb').read())
-    return 'data:image/jpg;base64,{}'.format(encoded_image.decode())
 
+if result_store is not None:
+    threading.Thread(target=warm_up_results, name='result-store-warm-up', daemon=True).start()
 
 if __name__ == '__main__':
-    app.run_server(debug=False, threaded=False)
+    app.run_server(debug=False, threaded=True)
@@ -36,7 +36,13 @@ parser.add_argument(
     '-flcl',
     '--fully_convolutional',
     help='Model is fully convolutional so set input shape to (None, None, 3). '
-         'WARNING: This experimental option does not work properly for YOLO_v2.',
+         'Input height and width must be multiples of 32.',
+    action='store_true')
+parser.add_argument(
+    '-fbn',
+    '--fold_batchnorm',
+    help='Fold batch normalization into convolution kernels and biases and '
+         'check outputs against the unfolded model.',
     action='store_true')
 
 
@@ -77,36 +83,71 @@ def unique_config_sections(config_file):
     return output_stream
 
 
-# %%
-def _main(args):
-    config_path = os.path.expanduser(args.config_path)
-    weights_path = os.path.expanduser(args.weights_path)
-    assert config_path.endswith('.cfg'), '{} is not a .cfg file'.format(
-        config_path)
-    assert weights_path.endswith(
-        '.weights'), '{} is not a .weights file'.format(weights_path)
+def conv_weight_shapes(cfg_parser):
+    """List shapes of weights of every convolutional section in config.
 
-    output_path = os.path.expanduser(args.output_path)
-    assert output_path.endswith(
-        '.h5'), 'output path {} is not a .h5 file'.format(output_path)
-    output_root = os.path.splitext(output_path)[0]
+    Follows the number of channels through convolutional, maxpool, avgpool,
+    route and reorg sections the same way the Keras model is built.
 
-    # Load weights and config.
-    print('Loading weights.')
-    weights_file = open(weights_path, 'rb')
-    weights_header = np.ndarray(
-        shape=(4,), dtype='int32', buffer=weights_file.read(16))
-    print('Weights Header: ', weights_header)
-    # TODO: Check transpose flag when implementing fully connected layers.
-    # transpose = (weight_header[0] > 1000) or (weight_header[1] > 1000)
+    :param cfg_parser: parsed config with unique section names.
+    :return: list of (section, filters, in_channels, size, batch_normalize).
+    """
+    channels = [3]
+    shapes = []
+    for section in cfg_parser.sections():
+        if section.startswith('convolutional'):
+            filters = int(cfg_parser[section]['filters'])
+            shapes.append((section, filters, channels[-1],
+                           int(cfg_parser[section]['size']),
+                           'batch_normalize' in cfg_parser[section]))
+            channels.append(filters)
+        elif section.startswith('maxpool') or section.startswith('avgpool'):
+            channels.append(channels[-1])
+        elif section.startswith('route'):
+            ids = [int(i) for i in cfg_parser[section]['layers'].split(',')]
+            channels.append(sum(channels[i] for i in ids))
+        elif section.startswith('reorg'):
+            channels.append(4 * channels[-1])
+    return shapes
 
-    print('Parsing Darknet config.')
-    unique_config_file = unique_config_sections(config_path)
-    cfg_parser = configparser.ConfigParser()
-    cfg_parser.read_file(unique_config_file)
 
-    print('Creating Keras model.')
-    if args.fully_convolutional:
+def count_weights(cfg_parser):
+    """Count float32 values a Darknet weights file must hold for config.
+
+    :param cfg_parser: parsed config with unique section names.
+    :return: number of weights.
+    """
+    count = 0
+    for _, filters, in_channels, size, batch_normalize in conv_weight_shapes(
+            cfg_parser):
+        count += filters * (4 if batch_normalize else 1)
+        count += size * size * in_channels * filters
+    return count
+
+
+def write_anchors(cfg_parser, output_root):
+    """Write anchors of region sections next to the converted model.
+
+    :param cfg_parser: parsed config with unique section names.
+    :param output_root: path prefix of anchors file.
+    """
+    for section in cfg_parser.sections():
+        if section.startswith('region'):
+            with open('{}_anchors.txt'.format(output_root), 'w') as f:
+                print(cfg_parser[section]['anchors'], file=f)
+
+
+def build_model(cfg_parser, weights, fully_convolutional=False,
+                fold_batchnorm=False):
+    """Create Keras model from parsed Darknet config and weights.
+
+    :param cfg_parser: parsed config with unique section names.
+    :param weights: float32 Darknet weights without header.
+    :param fully_convolutional: set input shape to (None, None, 3).
+    :param fold_batchnorm: fold batch normalization into conv kernel and bias.
+    :return: Keras model and number of used weights.
+    """
+    if fully_convolutional:
         image_height, image_width = None, None
     else:
         image_height = int(cfg_parser['net_0']['height'])
@@ -138,22 +179,17 @@ def _main(args):
             # TODO: This assumes channel last dim_ordering.
             weights_shape = (size, size, prev_layer_shape[-1], filters)
             darknet_w_shape = (filters, weights_shape[2], size, size)
-            weights_size = np.product(weights_shape)
+            weights_size = size * size * weights_shape[2] * filters
 
             print('conv2d', 'bn'
                   if batch_normalize else '  ', activation, weights_shape)
 
-            conv_bias = np.ndarray(
-                shape=(filters,),
-                dtype='float32',
-                buffer=weights_file.read(filters * 4))
+            conv_bias = weights[count:count + filters]
             count += filters
 
             if batch_normalize:
-                bn_weights = np.ndarray(
-                    shape=(3, filters),
-                    dtype='float32',
-                    buffer=weights_file.read(filters * 12))
+                bn_weights = weights[count:count + 3 * filters].reshape(
+                    3, filters)
                 count += 3 * filters
 
                 # TODO: Keras BatchNormalization mistakenly refers to var
@@ -165,10 +201,8 @@ def _main(args):
                     bn_weights[2]  # running var
                 ]
 
-            conv_weights = np.ndarray(
-                shape=darknet_w_shape,
-                dtype='float32',
-                buffer=weights_file.read(weights_size * 4))
+            conv_weights = weights[count:count + weights_size].reshape(
+                darknet_w_shape)
             count += weights_size
 
             # DarkNet conv_weights are serialized Caffe-style:
@@ -177,9 +211,18 @@ def _main(args):
             # (height, width, in_dim, out_dim)
             # TODO: Add check for Theano dim ordering.
             conv_weights = np.transpose(conv_weights, [2, 3, 1, 0])
-            conv_weights = [conv_weights] if batch_normalize else [
-                conv_weights, conv_bias
-            ]
+            if batch_normalize and fold_batchnorm:
+                # Same epsilon as the Keras BatchNormalization layer.
+                bn_scale = bn_weights[0] / np.sqrt(bn_weights[2] + 1e-3)
+                conv_weights = [
+                    conv_weights * bn_scale,
+                    conv_bias - bn_weights[1] * bn_scale
+                ]
+            elif batch_normalize:
+                conv_weights = [conv_weights]
+            else:
+                conv_weights = [conv_weights, conv_bias]
+            use_bias = not batch_normalize or fold_batchnorm
 
             # Handle activation.
             act_fn = None
@@ -195,12 +238,12 @@ def _main(args):
                 filters, (size, size),
                 strides=(stride, stride),
                 kernel_regularizer=l2(weight_decay),
-                use_bias=not batch_normalize,
+                use_bias=use_bias,
                 weights=conv_weights,
                 activation=act_fn,
                 padding=padding))(prev_layer)
 
-            if batch_normalize:
+            if batch_normalize and not fold_batchnorm:
                 conv_layer = (BatchNormalization(
                     weights=bn_weight_list))(conv_layer)
             prev_layer = conv_layer
@@ -251,26 +294,96 @@ def _main(args):
                     name='space_to_depth_x2')(prev_layer))
             prev_layer = all_layers[-1]
 
-        elif section.startswith('region'):
-            with open('{}_anchors.txt'.format(output_root), 'w') as f:
-                print(cfg_parser[section]['anchors'], file=f)
-
         elif (section.startswith('net') or section.startswith('cost') or
-              section.startswith('softmax')):
+              section.startswith('softmax') or section.startswith('region')):
             pass  # Configs not currently handled during model definition.
 
         else:
             raise ValueError(
                 'Unsupported section header type: {}'.format(section))
 
+    return Model(inputs=all_layers[0], outputs=all_layers[-1]), count
+
+
+def check_folded_model(model, cfg_parser, weights, fully_convolutional=False,
+                       tolerance=1e-3):
+    """Compare model with folded batch normalization to the unfolded one.
+
+    :param model: model created with fold_batchnorm=True.
+    :param cfg_parser: parsed config with unique section names.
+    :param weights: float32 Darknet weights without header.
+    :param fully_convolutional: model input shape is (None, None, 3).
+    :param tolerance: allowed difference relative to largest output.
+    :return: maximum absolute difference of outputs.
+    """
+    reference, _ = build_model(cfg_parser, weights,
+                               fully_convolutional=fully_convolutional)
+    image_size = (int(cfg_parser['net_0']['height']),
+                  int(cfg_parser['net_0']['width']))
+    image = np.random.RandomState(0).uniform(size=(1, ) + image_size + (3, ))
+    expected = reference.predict(image)
+    difference = np.abs(model.predict(image) - expected).max()
+    print('Folded batch normalization max difference: {}'.format(difference))
+    if difference > tolerance * max(np.abs(expected).max(), 1.):
+        raise ValueError(
+            'Folded model differs from unfolded by {}.'.format(difference))
+    return difference
+
+
+# %%
+def _main(args):
+    config_path = os.path.expanduser(args.config_path)
+    weights_path = os.path.expanduser(args.weights_path)
+    assert config_path.endswith('.cfg'), '{} is not a .cfg file'.format(
+        config_path)
+    assert weights_path.endswith(
+        '.weights'), '{} is not a .weights file'.format(weights_path)
+
+    output_path = os.path.expanduser(args.output_path)
+    assert output_path.endswith(
+        '.h5'), 'output path {} is not a .h5 file'.format(output_path)
+    output_root = os.path.splitext(output_path)[0]
+
+    # Load weights and config.
+    print('Loading weights.')
+    # Memory map the file once, every layer gets a zero-copy view of it.
+    weights_map = np.memmap(weights_path, dtype='uint8', mode='r')
+    weights_header = weights_map[:16].view('int32')
+    print('Weights Header: ', weights_header)
+    # TODO: Check transpose flag when implementing fully connected layers.
+    # transpose = (weight_header[0] > 1000) or (weight_header[1] > 1000)
+    weights_bytes = (len(weights_map) - 16) // 4 * 4
+    weights = weights_map[16:16 + weights_bytes].view('float32')
+
+    print('Parsing Darknet config.')
+    unique_config_file = unique_config_sections(config_path)
+    cfg_parser = configparser.ConfigParser()
+    cfg_parser.read_file(unique_config_file)
+
+    expected_weights = count_weights(cfg_parser)
+    if len(weights) < expected_weights:
+        raise ValueError(
+            '{} holds {} weights but {} requires {}.'.format(
+                weights_path, len(weights), config_path, expected_weights))
+
+    print('Creating Keras model.')
+    model, count = build_model(
+        cfg_parser,
+        weights,
+        fully_convolutional=args.fully_convolutional,
+        fold_batchnorm=args.fold_batchnorm)
+    if args.fold_batchnorm:
+        check_folded_model(model, cfg_parser, weights,
+                           args.fully_convolutional)
+    write_anchors(cfg_parser, output_root)
+
     # Create and save model.
-    model = Model(inputs=all_layers[0], outputs=all_layers[-1])
     print(model.summary())
     model.save('{}'.format(output_path))
     print('Saved Keras model to {}'.format(output_path))
     # Check to see if all weights have been read.
-    remaining_weights = len(weights_file.read()) / 4
-    weights_file.close()
+    remaining_weights = len(weights) - count
+    del weights, weights_map
     print('Read {} of {} from Darknet weights.'.format(count, count +
                                                        remaining_weights))
     if remaining_weights > 0: